@@ -1,14 +1,36 @@
 import argparse
+import contextlib
 import yaml
 import os
 import sys
 import datetime
+import fnmatch
 import subprocess
 import gzip
+import hashlib
+import io
 import shutil
+import shlex
+import re
+import json
+import queue
+import threading
+import tarfile
+import tempfile
+import time
+import posixpath
+import sqlite3
+import paramiko
 from fabric import Connection
 from invoke import UnexpectedExit
 
+import planner
+import retention
+import throttle
+from catalog import LOCATIONS, Catalog, base_prefix, split_filename
+from chunkstore import ChunkStore
+from metrics import MetricsRecorder
+
 def load_config(config_path=None):
     # Nếu user chỉ định rõ file config, dùng trực tiếp — không fallback
     if config_path is not None and config_path != 'config.yaml':
@@ -34,7 +56,7 @@ def load_config(config_path=None):
     with open(config_path, 'r') as f:
         return yaml.safe_load(f)
 
-def get_connection(server_config):
+def _new_connection(server_config):
     connect_kwargs = {
         "key_filename": server_config['ssh_key_path'],
     }
@@ -50,7 +72,81 @@ def get_connection(server_config):
     )
 
 
-def _db_prefix(conf, interactive: bool = False) -> str:
+# Khoảng thời gian (giây) gửi keepalive để giữ kết nối SSH không bị NAT/firewall cắt
+SSH_KEEPALIVE_DEFAULT = 30
+
+class SessionManager:
+    """Process-wide SSH session cache: one authenticated transport per host.
+
+    ``get_connection`` hands out the cached fabric ``Connection`` for a
+    ``user@host:port`` so the handshake (and key decryption) is paid once per
+    run instead of once per step. Dead transports are replaced transparently.
+    """
+
+    def __init__(self):
+        self._sessions = {}
+        self._handshake = {}
+        self._lock = threading.Lock()
+        self.saved = 0.0
+
+    def get(self, server_config):
+        key = (server_config['user'], server_config['host'], server_config.get('port', 22))
+        with self._lock:
+            conn = self._sessions.get(key)
+            if conn is not None and conn.is_connected:
+                self.saved += self._handshake[key]
+                print(f"  [SESSION] Reusing connection to {key[1]} (saved ~{self._handshake[key]:.2f}s handshake, {self.saved:.2f}s total)")
+                return conn
+            if conn is not None:
+                # Transport đã chết (mạng chập chờn, server restart...) -> mở lại
+                print(f"  [SESSION] Connection to {key[1]} was lost, reconnecting...")
+                conn.close()
+
+            conn = _new_connection(server_config)
+            start = time.time()
+            try:
+                conn.open()
+            except Exception as e:
+                raise ConnectionError(f"SSH connection to {key[1]}:{key[2]} failed: {e}") from e
+            self._handshake[key] = time.time() - start
+            keepalive = server_config.get('ssh_keepalive', SSH_KEEPALIVE_DEFAULT)
+            if keepalive:
+                conn.client.get_transport().set_keepalive(int(keepalive))
+            self._sessions[key] = conn
+            return conn
+
+    def release(self, conn):
+        """Forget ``conn`` if its transport died during the step; live ones stay cached."""
+        if conn is None or conn.is_connected:
+            return
+        with self._lock:
+            for key, cached in list(self._sessions.items()):
+                if cached is conn:
+                    del self._sessions[key]
+                    self._handshake.pop(key, None)
+        conn.close()
+
+    def close_all(self):
+        with self._lock:
+            for conn in self._sessions.values():
+                conn.close()
+            self._sessions.clear()
+        if self.saved:
+            print(f"[SESSION] Connection reuse saved ~{self.saved:.2f}s of SSH handshakes.")
+
+SESSIONS = SessionManager()
+METRICS = MetricsRecorder()
+
+def get_connection(server_config):
+    """Return the shared, already authenticated connection for this server."""
+    return SESSIONS.get(server_config)
+
+def release_connection(conn):
+    """End of a step. A live connection stays open for the next step (see
+    ``SESSIONS.close_all``); a dead one is closed and dropped from the cache."""
+    SESSIONS.release(conn)
+
+def _db_prefix(conf, interactive: bool = False, pgoptions: str = "") -> str:
     """Return a command prefix for running Postgres tools on the remote host.
 
     The helper handles two modes:
@@ -63,6 +159,9 @@ def _db_prefix(conf, interactive: bool = False) -> str:
        empty.  In that case the prefix is simply the ``PGPASSWORD`` environment
        variable (if any) which will be prepended before the actual command.
 
+    ``pgoptions`` (e.g. ``-c synchronous_commit=off``) is passed the same way
+    as ``PGOPTIONS`` to tune the server session of the tool.
+
     The returned string always ends with a space so callers can append the
     actual ``pg_dump``/``psql`` invocation directly.
     """
@@ -71,6 +170,8 @@ def _db_prefix(conf, interactive: bool = False) -> str:
         env = ""
         if 'db_password' in conf and conf['db_password']:
             env = f"-e PGPASSWORD='{conf['db_password']}' "
+        if pgoptions:
+            env += f"-e PGOPTIONS='{pgoptions}' "
         # docker exec prefix; include -i nếu cần pipe data vào container
         # env (-e PGPASSWORD) phải đặt SAU "docker exec" và các flag của nó
         prefix = f"docker exec {'-i ' if interactive else ''}{env}{docker} "
@@ -79,6 +180,8 @@ def _db_prefix(conf, interactive: bool = False) -> str:
         env = ""
         if 'db_password' in conf and conf['db_password']:
             env = f"PGPASSWORD='{conf['db_password']}' "
+        if pgoptions:
+            env += f"PGOPTIONS='{pgoptions}' "
         return env
 
 def _db_host_arg(conf) -> str:
@@ -97,6 +200,412 @@ def _db_host_arg(conf) -> str:
     port = conf.get('db_port', 5432)
     return f"-h {host} -p {port} "
 
+# Định dạng dump được hỗ trợ và đuôi file tương ứng
+DUMP_FORMATS = ('plain', 'custom', 'directory')
+DUMP_SUFFIXES = {
+    'plain': '.sql.gz',
+    'custom': '.dump',
+    'directory': '.dir.tar',
+}
+
+# Codec nén cho plain dump. "magic" là các byte đầu file dùng để nhận diện
+# codec khi restore (không dựa vào đuôi file).
+COMPRESSION_CODECS = {
+    'gzip': {'suffix': '.gz', 'magic': b'\x1f\x8b', 'decompress': 'gzip -dc'},
+    'pigz': {'suffix': '.gz', 'magic': b'\x1f\x8b', 'decompress': 'gzip -dc'},
+    'zstd': {'suffix': '.zst', 'magic': b'\x28\xb5\x2f\xfd', 'decompress': 'zstd -dc -q'},
+    'lz4': {'suffix': '.lz4', 'magic': b'\x04\x22\x4d\x18', 'decompress': 'lz4 -dc -q'},
+}
+PLAIN_SUFFIXES = ('.sql.gz', '.sql.zst', '.sql.lz4', '.sql')
+# Backup vật lý (pg_basebackup -Ft, nén bằng codec của production)
+PHYSICAL_SUFFIX = '.base.tar'
+PHYSICAL_SUFFIXES = (PHYSICAL_SUFFIX,) + tuple(PHYSICAL_SUFFIX + info['suffix'] for info in COMPRESSION_CODECS.values())
+
+def _compression_settings(conf):
+    """Read the ``compression`` block of an environment (codec, level, threads).
+
+    Missing block means the historical behaviour: single-threaded ``gzip``.
+    """
+    comp = dict(conf.get('compression') or {})
+    codec = comp.get('codec', 'gzip')
+    if codec not in COMPRESSION_CODECS:
+        print(f"Error: Unknown compression codec '{codec}'. Use one of: {', '.join(COMPRESSION_CODECS)}")
+        sys.exit(1)
+    return {
+        'codec': codec,
+        'level': comp.get('level'),
+        'threads': comp.get('threads', 0),
+    }
+
+def _compressor_command(comp):
+    """Shell command that compresses stdin to stdout according to ``comp``."""
+    codec = comp['codec']
+    level = f" -{comp['level']}" if comp.get('level') is not None else ""
+    threads = int(comp.get('threads') or 0)
+    if codec == 'pigz':
+        # pigz mặc định dùng tất cả core nếu không truyền -p
+        return f"pigz{level}" + (f" -p {threads}" if threads else "")
+    if codec == 'zstd':
+        # -T0 = dùng tất cả core
+        return f"zstd -q{level} -T{threads}"
+    if codec == 'lz4':
+        return f"lz4 -q{level}"
+    return f"gzip{level}"
+
+def _codec_from_magic(head):
+    """Return the codec name matching the first bytes of a file, or None for raw SQL."""
+    for codec, info in COMPRESSION_CODECS.items():
+        if head.startswith(info['magic']):
+            return codec
+    return None
+
+def _decompressor_command(codec):
+    return COMPRESSION_CODECS[codec]['decompress'] if codec else "cat"
+
+def _remote_codec(conn, remote_path):
+    """Sniff the codec of a remote file from its magic bytes (one small round trip)."""
+    result = conn.run(_remote_pipeline(f"head -c 4 {remote_path} | od -An -tx1"), hide=True)
+    head = bytes.fromhex(result.stdout.replace(' ', '').strip())
+    return _codec_from_magic(head)
+
+def _container_exec(conf, interactive: bool = False) -> str:
+    """Prefix for plain shell commands (tar, mkdir, rm...) next to the database.
+
+    Same idea as ``_db_prefix`` but without the PGPASSWORD environment: inside
+    the container for Docker setups, nothing at all for host installs.
+    """
+    docker = conf.get('docker_container')
+    if docker:
+        return f"docker exec {'-i ' if interactive else ''}{docker} "
+    return ""
+
+def _dump_settings(conf, fmt=None, jobs=None):
+    """Resolve dump format / job count: CLI value first, then config, then defaults."""
+    fmt = fmt or conf.get('dump_format') or 'plain'
+    if fmt not in DUMP_FORMATS:
+        print(f"Error: Unknown dump format '{fmt}'. Use one of: {', '.join(DUMP_FORMATS)}")
+        sys.exit(1)
+    jobs = int(jobs or conf.get('jobs') or 1)
+    return fmt, max(jobs, 1)
+
+def _dump_format_of(filename):
+    """Detect the dump format from the backup filename."""
+    if filename.endswith(PHYSICAL_SUFFIXES):
+        return 'physical'
+    if filename.endswith(DUMP_SUFFIXES['directory']):
+        return 'directory'
+    if filename.endswith(DUMP_SUFFIXES['custom']):
+        return 'custom'
+    return 'plain'
+
+def _strip_dump_suffix(filename):
+    suffixes = set(DUMP_SUFFIXES.values()) | set(PLAIN_SUFFIXES) | set(PHYSICAL_SUFFIXES)
+    for suffix in sorted(suffixes, key=len, reverse=True):
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    if '.' in filename:
+        return filename.split('.', 1)[0]
+    return filename
+
+def _filename_for_format(filename, fmt, codec='gzip'):
+    """Swap the extension of a (timestamped) backup filename to match ``fmt``/``codec``."""
+    if fmt == 'plain':
+        if codec == 'gzip' and filename.endswith(DUMP_SUFFIXES['plain']):
+            return filename
+        return _strip_dump_suffix(filename) + '.sql' + COMPRESSION_CODECS[codec]['suffix']
+    return _strip_dump_suffix(filename) + DUMP_SUFFIXES[fmt]
+
+def _dump_command(conf, remote_path, fmt='plain', jobs=1, source=None):
+    """Build the remote shell command that dumps ``conf``'s database to ``remote_path``.
+
+    ``source`` replaces ``pg_dump`` as the command printing the plain SQL
+    (used by subset dumps).
+    """
+    pg_dump = f"{_dump_tool_prefix(conf)}pg_dump {_db_host_arg(conf)}-U {conf['db_user']}"
+    if fmt == 'custom':
+        # Custom format đã nén sẵn; pg_dump không hỗ trợ -j với -Fc
+        if jobs > 1:
+            print("  [INFO] pg_dump only parallelises the directory format; --jobs is ignored for custom.")
+        return _niced(conf, _remote_pipeline(f"{pg_dump} -Fc {conf['db_name']} | {_checksum_tee(remote_path)}"))
+    if fmt == 'directory':
+        # pg_dump -Fd ghi ra thư mục (bên trong container nếu dùng Docker),
+        # sau đó đóng gói bằng tar thành 1 file để tải về / upload
+        work_dir = f"/tmp/{os.path.basename(_strip_dump_suffix(remote_path))}.dir"
+        cexec = _container_exec(conf)
+        return _niced(conf, _remote_pipeline(
+            f"{cexec}rm -rf {work_dir} && "
+            f"{pg_dump} -Fd -j {jobs} -f {work_dir} {conf['db_name']} && "
+            f"{cexec}tar -C {work_dir} -cf - . | {_checksum_tee(remote_path)}; "
+            f"rc=$?; {cexec}rm -rf {work_dir}; exit $rc"
+        ))
+    # dd đếm số byte SQL chưa nén (ghi vào file .stat ẩn) để báo cáo tỉ lệ nén
+    compressor = _compressor_command(_compression_settings(conf))
+    source = source or f"{pg_dump} {conf['db_name']}"
+    return _niced(conf, _remote_pipeline(
+        f"{source} | dd bs=1M 2>{_stat_path(remote_path)} | {compressor} | {_checksum_tee(remote_path)}"
+    ))
+
+CHECKSUM_SUFFIX = '.sha256'
+
+def _checksum_path(path):
+    """``sha256sum``-format sidecar next to a backup (``<hex>  <name>``)."""
+    return path + CHECKSUM_SUFFIX
+
+def _checksum_tee(remote_path):
+    """Pipeline tail writing stdin to ``remote_path`` and hashing it in the same pass."""
+    name = posixpath.basename(remote_path)
+    return (
+        f"tee {remote_path} | sha256sum | "
+        f"awk '{{print $1 \"  {name}\"}}' > {_checksum_path(remote_path)}"
+    )
+
+def _parse_checksum(text):
+    """Hex digest from the first line of a ``sha256sum`` output / sidecar, or None."""
+    fields = text.split()
+    if fields and re.fullmatch(r'[0-9a-f]{64}', fields[0]):
+        return fields[0]
+    return None
+
+def _read_local_checksum(local_path):
+    try:
+        with open(_checksum_path(local_path), 'r') as f:
+            return _parse_checksum(f.read())
+    except OSError:
+        return None
+
+def _write_local_checksum(local_path, digest):
+    with open(_checksum_path(local_path), 'w') as f:
+        f.write(f"{digest}  {os.path.basename(local_path)}\n")
+
+def _read_remote_checksum(sftp, remote_path):
+    try:
+        with sftp.open(_checksum_path(remote_path), 'r') as f:
+            return _parse_checksum(f.read().decode(errors='replace'))
+    except IOError:
+        return None
+
+def _write_remote_checksum(sftp, remote_path, digest):
+    with sftp.open(_checksum_path(remote_path), 'w') as f:
+        f.write(f"{digest}  {posixpath.basename(remote_path)}\n")
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(TRANSFER_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _verify_remote_checksum(conn, remote_path):
+    """Re-hash a remote backup against its sidecar (``sha256sum -c``) before a restore.
+
+    Returns False on a mismatch; backups without a sidecar only get a warning.
+    """
+    sidecar = _checksum_path(remote_path)
+    directory, name = posixpath.split(remote_path)
+    result = conn.run(
+        f"test -f {shlex.quote(sidecar)} || exit 3; "
+        f"cd {shlex.quote(directory or '/')} && sha256sum -c --quiet {shlex.quote(posixpath.basename(sidecar))}",
+        hide=True, warn=True,
+    )
+    if result.exited == 3:
+        print(f"  [VERIFY] Warning: no checksum for {name}, skipping integrity check.")
+        return True
+    if result.exited != 0:
+        print(f"Error: {remote_path} does not match its checksum ({(result.stdout + result.stderr).strip()}).")
+        return False
+    print(f"  [VERIFY] {name}: SHA-256 OK")
+    return True
+
+def _stat_path(remote_path):
+    """Hidden sidecar next to a remote dump holding dd's byte count."""
+    directory, name = os.path.split(remote_path)
+    return f"{directory}/.{name}.stat"
+
+def _report_compression(conn, conf, remote_path, elapsed):
+    """Print raw/compressed size, ratio and throughput of a plain dump just written.
+
+    Returns ``(raw, packed)`` byte counts, ``(None, None)`` if unavailable.
+    """
+    stat_file = _stat_path(remote_path)
+    cmd = f"tail -n 1 {stat_file}; stat -c %s {remote_path}; rm -f {stat_file}"
+    try:
+        lines = conn.run(cmd, hide=True, warn=True).stdout.strip().splitlines()
+        raw = int(lines[0].split()[0])
+        packed = int(lines[-1])
+    except (IndexError, ValueError):
+        return None, None
+    codec = _compression_settings(conf)['codec']
+    ratio = raw / packed if packed else 0
+    METRICS.note(bytes_in=raw, bytes_out=packed, compression_ratio=round(ratio, 2), codec=codec)
+    print(
+        f"  [COMPRESSION] {codec}: {_format_size(raw)} -> {_format_size(packed)} "
+        f"(ratio {ratio:.1f}x), {_format_rate(raw, elapsed)} raw / {_format_rate(packed, elapsed)} compressed"
+    )
+    return raw, packed
+
+def _remote_size(conn, remote_path):
+    """Size of a remote file in bytes, or None if it cannot be read."""
+    result = conn.run(f"stat -c %s {shlex.quote(remote_path)}", hide=True, warn=True)
+    try:
+        return int(result.stdout.strip())
+    except ValueError:
+        return None
+
+def _restore_command(conf, remote_path, jobs=1, codec='gzip'):
+    """Build the remote shell command that restores ``remote_path`` into ``conf``'s database.
+
+    ``codec`` is only used for plain dumps, see ``_remote_codec``.
+    """
+    fmt = _dump_format_of(remote_path)
+    if fmt == 'plain':
+        return _remote_pipeline(
+            f"{_decompressor_command(codec)} < {remote_path} | "
+            f"{_db_prefix(conf, interactive=True)}psql {_db_host_arg(conf)}-U {conf['db_user']} -d {conf['db_name']}"
+        )
+
+    pg_restore = f"{_db_prefix(conf)}pg_restore {_db_host_arg(conf)}-U {conf['db_user']} -d {conf['db_name']} -j {jobs}"
+    setup, target, cleanup = _archive_target(conf, remote_path)
+    if not setup:
+        return f"{pg_restore} {target}"
+    return f"{setup} && {pg_restore} {target}; rc=$?; {cleanup}; exit $rc"
+
+def _archive_target(conf, remote_path):
+    """Make a custom/directory archive readable by ``pg_restore -j`` next to the database.
+
+    Returns ``(setup_cmd, target, cleanup_cmd)``; the commands are empty when
+    ``pg_restore`` can read ``remote_path`` as is (custom format on the host).
+    """
+    cexec = _container_exec(conf)
+    cexec_i = _container_exec(conf, interactive=True)
+    work_dir = f"/tmp/{os.path.basename(_strip_dump_suffix(remote_path))}.restore"
+    if _dump_format_of(remote_path) == 'custom':
+        if not conf.get('docker_container'):
+            return "", remote_path, ""
+        # pg_restore -j cần file seekable -> copy archive vào trong container trước
+        staged = f"{work_dir}.dump"
+        return f"{cexec_i}sh -c 'cat > {staged}' < {remote_path}", staged, f"{cexec}rm -f {staged}"
+    setup = (
+        f"{cexec}rm -rf {work_dir} && {cexec}mkdir -p {work_dir} && "
+        f"{cexec_i}tar -C {work_dir} -xf - < {remote_path}"
+    )
+    return setup, work_dir, f"{cexec}rm -rf {work_dir}"
+
+# --- Fast restore: tách dump thành 3 pha pre-data / data / post-data ---------
+RESTORE_PHASES = ('pre-data', 'data', 'post-data')
+# Loại TOC entry (comment "-- Name: ...; Type: X;" trong plain dump) mở đầu pha data / post-data
+DATA_TOC_TYPES = ('TABLE DATA', 'SEQUENCE SET', 'BLOB', 'BLOBS', 'BLOB DATA', 'LARGE OBJECT')
+POST_DATA_TOC_TYPES = (
+    'INDEX', 'INDEX ATTACH', 'CONSTRAINT', 'FK CONSTRAINT', 'CHECK CONSTRAINT', 'TRIGGER',
+    'EVENT TRIGGER', 'RULE', 'POLICY', 'ROW SECURITY', 'STATISTICS', 'MATERIALIZED VIEW DATA',
+    'PUBLICATION TABLE', 'PUBLICATION TABLES IN SCHEMA',
+)
+FAST_RESTORE_DEFAULTS = {
+    'synchronous_commit': 'off',
+    'maintenance_work_mem': '1GB',
+}
+# Lọc plain SQL theo pha trên server. Các dòng header (SET ...) trước TOC entry
+# đầu tiên được giữ cho cả 3 pha; pha chỉ tiến lên, không lùi.
+SQL_PHASE_AWK = (
+    'BEGIN { n = split("' + '|'.join(DATA_TOC_TYPES) + '", a, "|"); for (i = 1; i <= n; i++) d[a[i]] = 1; '
+    'n = split("' + '|'.join(POST_DATA_TOC_TYPES) + '", a, "|"); for (i = 1; i <= n; i++) q[a[i]] = 1; cur = 0 } '
+    '/^-- (Data for )?Name: .*; Type: / { t = $0; sub(/.*; Type: /, "", t); sub(/;.*/, "", t); '
+    'p = (t in q) ? 3 : ((t in d) ? 2 : 1); if (p > cur) cur = p } '
+    'cur == 0 || cur == phase'
+)
+_TOC_TYPE_RE = re.compile(rb'^-- (?:Data for )?Name: .*; Type: ([^;]+);')
+
+def _sql_phase_filter(stream, phase):
+    """Yield the lines of a plain SQL dump belonging to ``phase`` (1, 2 or 3)."""
+    current = 0
+    for line in stream:
+        if line.startswith(b'-- '):
+            match = _TOC_TYPE_RE.match(line)
+            if match:
+                toc_type = match.group(1).decode(errors='replace')
+                if toc_type in POST_DATA_TOC_TYPES:
+                    current = max(current, 3)
+                elif toc_type in DATA_TOC_TYPES:
+                    current = max(current, 2)
+                else:
+                    current = max(current, 1)
+        if current == 0 or current == phase:
+            yield line
+
+def _fast_restore_settings(conf, jobs):
+    """Session settings (as a PGOPTIONS string) and job count for a fast restore.
+
+    ``jobs`` is the CLI ``--jobs``: it wins over ``fast_restore.jobs``, then
+    the environment's ``jobs``.
+    """
+    settings = dict(FAST_RESTORE_DEFAULTS)
+    settings.update(conf.get('fast_restore') or {})
+    fast_jobs = settings.pop('jobs', 0)
+    jobs = int(jobs or fast_jobs or conf.get('jobs') or 1)
+    pgoptions = " ".join(f"-c {name}={value}" for name, value in settings.items())
+    return pgoptions, max(jobs, 1)
+
+def _fast_restore_remote(conn, conf, remote_path, jobs, codec):
+    """Restore in three timed phases with relaxed durability settings.
+
+    Plain dumps are split on the server with awk; archives use
+    ``pg_restore --section`` with ``-j`` for the data and post-data phases.
+    """
+    pgoptions, jobs = _fast_restore_settings(conf, jobs)
+    print(f"  [FAST] Session settings: {pgoptions}")
+    fmt = _dump_format_of(remote_path)
+    setup = cleanup = ""
+    if fmt == 'plain':
+        psql = f"{_db_prefix(conf, interactive=True, pgoptions=pgoptions)}psql {_db_host_arg(conf)}-U {conf['db_user']} -d {conf['db_name']}"
+        phases = [
+            (name, _remote_pipeline(
+                f"{_decompressor_command(codec)} < {remote_path} | "
+                f"awk -v phase={number} {shlex.quote(SQL_PHASE_AWK)} | {psql}"
+            ))
+            for number, name in enumerate(RESTORE_PHASES, 1)
+        ]
+    else:
+        setup, target, cleanup = _archive_target(conf, remote_path)
+        pg_restore = f"{_db_prefix(conf, pgoptions=pgoptions)}pg_restore {_db_host_arg(conf)}-U {conf['db_user']} -d {conf['db_name']}"
+        phases = [
+            ('pre-data', f"{pg_restore} --section=pre-data {target}"),
+            ('data', f"{pg_restore} --section=data -j {jobs} {target}"),
+            ('post-data', f"{pg_restore} --section=post-data -j {jobs} {target}"),
+        ]
+
+    total_start = time.time()
+    try:
+        if setup:
+            conn.run(setup, hide=True)
+        for name, cmd in phases:
+            start = time.time()
+            conn.run(cmd)
+            print(f"  [FAST] Phase {name} finished in {time.time() - start:.1f}s")
+    finally:
+        if cleanup:
+            conn.run(cleanup, hide=True, warn=True)
+    print(f"  [FAST] All phases finished in {time.time() - total_start:.1f}s")
+
+def _remote_pipeline(cmd) -> str:
+    """Wrap a shell pipeline so that a failure in ANY stage fails the command.
+
+    Plain ``a | b`` only reports the exit status of ``b`` - a ``pg_dump`` that
+    dies halfway through would otherwise look like a successful backup.
+    """
+    return f"bash -o pipefail -c {shlex.quote(cmd)}"
+
+def _format_size(num_bytes):
+    """Human readable byte count (e.g. ``1.5 GB``)."""
+    size = float(num_bytes)
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+def _format_rate(num_bytes, seconds):
+    """Throughput in MB/s, safe for very short runs."""
+    return f"{num_bytes / (1024 * 1024) / max(seconds, 1e-6):.1f} MB/s"
+
 def get_timestamped_filename(base_filename):
     """Appends a timestamp to the filename before the extensions."""
     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -106,30 +615,731 @@ def get_timestamped_filename(base_filename):
     else:
         return f"{base_filename}_{timestamp}"
 
-def backup_prod(config, filename):
+# Thư mục nhận file upload trên Staging (override bằng "remote_dir" trong config staging)
+STAGING_REMOTE_DIR_DEFAULT = '/home/anderson'
+
+def _staging_remote_path(staging_conf, filename):
+    return posixpath.join(staging_conf.get('remote_dir') or STAGING_REMOTE_DIR_DEFAULT, filename)
+
+# Catalog đã mở theo đường dẫn: schema/migration chỉ chạy một lần mỗi process
+CATALOGS = {}
+
+def _get_catalog(config):
+    """Backup catalog of this config (``local.catalog``, default ``<backup_dir>/catalog.sqlite3``)."""
+    local_conf = config['local']
+    path = os.path.abspath(local_conf.get('catalog') or os.path.join(local_conf['backup_dir'], 'catalog.sqlite3'))
+    catalog = CATALOGS.get(path)
+    if catalog is None:
+        catalog = CATALOGS.setdefault(path, Catalog(path))
+    return catalog
+
+def _catalog_add(config, filename, location, path, size=None, **fields):
+    """Record a copy in the catalog. A catalog problem never fails the step itself."""
+    try:
+        _get_catalog(config).add_copy(filename, location, path, size, **fields)
+    except sqlite3.Error as e:
+        print(f"  [CATALOG] Warning: cannot record {filename} ({location}): {e}")
+
+def _catalog_remove(config, filename, location):
+    try:
+        _get_catalog(config).remove_copy(filename, location)
+    except sqlite3.Error as e:
+        print(f"  [CATALOG] Warning: cannot update {filename} ({location}): {e}")
+
+@METRICS.timed('backup_prod')
+def backup_prod(config, filename, fmt=None, jobs=None, subset=None):
     print(f"--- [STEP 1] Backing up Production Database (File: {filename}) ---")
     prod_conf = config['production']
     conn = get_connection(prod_conf)
     
     remote_path = f"/tmp/{filename}"
     
-    # build command prefix that may or may not use a docker container
-    prefix = _db_prefix(prod_conf)
-    dump_cmd = (
-        f"{prefix}pg_dump {_db_host_arg(prod_conf)}-U {prod_conf['db_user']} {prod_conf['db_name']} "
-        f"| gzip > {remote_path}"
-    )
+    # build command that may or may not use a docker container
+    fmt, jobs = _dump_settings(prod_conf, fmt, jobs)
+    subset = _subset_enabled(prod_conf, subset)
+    if subset and fmt != 'plain':
+        print(f"  [INFO] Subset dumps are plain SQL; --format {fmt} is ignored.")
+        fmt = 'plain'
+    script_path = f"{remote_path}.subset.sql"
     
-    print(f"Executing: {dump_cmd}")
     try:
+        # Kiểm tra chỗ trống trên /tmp TRƯỚC khi dump (đầy đĩa giữa chừng = dump hỏng)
+        need, db_size = (0, None) if subset else _estimate_dump_size(config, conn, prod_conf, filename, fmt)
+        _ensure_space(config, 'production', need, conn)
+        source = _prepare_subset(conn, prod_conf, script_path) if subset else None
+        dump_cmd = _dump_command(prod_conf, remote_path, fmt, jobs, source=source)
+        print(f"Executing: {dump_cmd}")
+        start = time.time()
         conn.run(dump_cmd)
         print(f"Backup successful on remote: {remote_path}")
+        raw = codec = None
+        if fmt == 'plain':
+            raw, packed = _report_compression(conn, prod_conf, remote_path, time.time() - start)
+            codec = _compression_settings(prod_conf)['codec']
+        else:
+            packed = _remote_size(conn, remote_path)
+            METRICS.note(bytes_out=packed, format=fmt)
+            if packed:
+                print(f"  [DUMP] {fmt}: {_format_size(packed)} in {time.time() - start:.1f}s ({_format_rate(packed, time.time() - start)})")
+        METRICS.note(subset=subset)
+        checksum = _read_remote_checksum(conn.sftp(), remote_path)
+        print(f"  [CHECKSUM] SHA-256 {checksum}")
+        _catalog_add(
+            config, filename, 'production', remote_path, packed,
+            source='production', db_name=prod_conf['db_name'], format=fmt, codec=codec, raw_size=raw,
+            db_size=db_size, checksum=checksum,
+        )
     except UnexpectedExit as e:
         print(f"Backup failed: {e}")
+        conn.run(f"rm -f {_stat_path(remote_path)} {_checksum_path(remote_path)}", hide=True, warn=True)
         sys.exit(1)
     finally:
-        conn.close()
+        if subset:
+            conn.run(f"rm -f {script_path}", hide=True, warn=True)
+        release_connection(conn)
+
+# Cấu hình mặc định cho transfer engine (override bằng block "transfer" trong config)
+TRANSFER_DEFAULTS = {
+    'streams': 4,
+    'chunk_mb': 8,
+}
+TRANSFER_BLOCK_SIZE = 1024 * 1024
+
+def _transfer_settings(conf):
+    settings = dict(TRANSFER_DEFAULTS)
+    settings.update(conf.get('transfer') or {})
+    return {
+        'streams': max(int(settings['streams']), 1),
+        'chunk_size': max(int(float(settings['chunk_mb']) * 1024 * 1024), TRANSFER_BLOCK_SIZE),
+    }
+
+def _transport(conn):
+    """Open the fabric connection (if needed) and return its paramiko transport."""
+    conn.open()
+    return conn.client.get_transport()
+
+def _throttle_settings(conf):
+    try:
+        return throttle.throttle_settings(conf)
+    except ValueError as e:
+        print(f"Error: throttle: {e}")
+        sys.exit(1)
+
+def _niced(conf, cmd):
+    """``cmd`` (a remote pipeline) run with the environment's ``throttle.nice`` / ``ionice``."""
+    return throttle.nice_command(_throttle_settings(conf)) + cmd
+
+def _dump_tool_prefix(conf):
+    """``_db_prefix`` for pg_dump / pg_basebackup; a ``docker exec`` does not inherit nice/ionice."""
+    nice = throttle.nice_command(_throttle_settings(conf)) if conf.get('docker_container') else ''
+    return _db_prefix(conf) + nice
+
+class _ServerProbe:
+    """Round trip time of the SSH transport and load average per CPU of a server."""
+
+    def __init__(self, conn):
+        self.transport = _transport(conn)
+        result = conn.run("nproc", hide=True, warn=True)
+        self.cpus = int(result.stdout.strip()) if result.ok and result.stdout.strip().isdigit() else 1
+        # Channel riêng: không tranh lock với SFTP của các stream đang truyền
+        self.sftp = paramiko.SFTPClient.from_transport(self.transport)
+
+    def __call__(self):
+        start = time.monotonic()
+        # Request bị xếp hàng sau dữ liệu đang truyền -> RTT tăng khi đường truyền bị nghẽn
+        self.transport.global_request('keepalive@openssh.com', wait=True)
+        rtt = time.monotonic() - start
+        with self.sftp.open('/proc/loadavg', 'r') as f:
+            load = float(f.read().split()[0]) / self.cpus
+        return rtt, load
+
+    def close(self):
+        self.sftp.close()
+
+def _start_throttle(conn, conf, measured):
+    """Rate limiter (plus adaptive controller) for a transfer with ``conf``'s server.
+
+    ``measured()`` gives the transfer's current bytes/s. Returns ``(limiter, controller)``; ``(None, None)`` without ``throttle.max_mb_s``
+    or ``throttle.adaptive``.
+    """
+    settings = _throttle_settings(conf)
+    if not settings or (settings['max_rate'] is None and not settings['adaptive']):
+        return None, None
+    limiter = throttle.RateLimiter(settings['max_rate'])
+    controller = None
+    if settings['adaptive']:
+        controller = throttle.AdaptiveController(limiter, settings, _ServerProbe(conn), measured).start()
+    return limiter, controller
+
+def _finish_throttle(limiter, controller, moved, elapsed):
+    """Stop the controller, print and record the effective rate of a throttled transfer."""
+    if limiter is None:
+        return
+    if controller is not None:
+        controller.stop()
+        controller.probe.close()
+    effective = moved / max(elapsed, 1e-6)
+    cap = controller.max_rate if controller is not None else limiter.rate
+    fields = {
+        'effective_rate_mb_s': round(effective / throttle.MB, 2),
+        'rate_limit_mb_s': round(cap / throttle.MB, 2) if cap else None,
+        # Tổng thời gian chờ token của mọi stream
+        'throttle_wait_s': round(limiter.waited, 1),
+    }
+    line = (
+        f"  [THROTTLE] effective {_format_rate(moved, elapsed)}"
+        f" (cap {f'{cap / throttle.MB:.1f} MB/s' if cap else 'none'})"
+    )
+    if controller is not None:
+        lowest = controller.lowest
+        fields.update(backoffs=controller.backoffs, min_rate_limit_mb_s=round(lowest / throttle.MB, 2) if lowest else None)
+        line += f", adaptive: {controller.backoffs} backoff(s)"
+        if controller.backoffs:
+            line += f", down to {lowest / throttle.MB:.1f} MB/s (last: {controller.last_reason})"
+    METRICS.note(**fields)
+    print(line)
+
+class TransferProgress:
+    """Aggregate progress/throughput display shared by all transfer streams."""
+
+    def __init__(self, label, total, streams=1, already_done=0):
+        self.label = label
+        self.total = total
+        self.streams = streams
+        self.done = already_done
+        self.start_done = already_done
+        self.start = time.time()
+        self._last_print = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, num_bytes):
+        with self._lock:
+            self.done += num_bytes
+            now = time.time()
+            if now - self._last_print >= 0.5 or self.done >= self.total:
+                self._last_print = now
+                self._print(now)
+
+    def _print(self, now):
+        percent = (self.done / self.total) * 100 if self.total else 100.0
+        rate = _format_rate(self.done - self.start_done, now - self.start)
+        sys.stdout.write(
+            f"\r{self.label}: {self.done} / {self.total} bytes ({percent:.1f}%) "
+            f"{rate} over {self.streams} stream(s)"
+        )
+        sys.stdout.flush()
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def rate(self):
+        """Average bytes/s moved so far in this run."""
+        return (self.done - self.start_done) / max(self.elapsed(), 1e-6)
+
+class OrderedHasher:
+    """SHA-256 of a file whose chunks finish out of order on several streams.
+
+    Chunks are fed to the hash in index order as soon as they are contiguous,
+    so the digest is ready when the last chunk lands and the file never has to
+    be read again.  Chunks finished by an earlier (resumed) run are read back
+    with ``read_chunk``.  A worker that gets too far ahead of the hash waits,
+    bounding the memory held to about ``max_pending`` chunks.
+    """
+
+    def __init__(self, chunks, already_done, read_chunk, max_pending=8):
+        self.chunks = chunks
+        self.already_done = set(already_done)
+        self.read_chunk = read_chunk
+        self.max_pending = max_pending
+        self.next_index = 0
+        self.pending = {}
+        self.aborted = False
+        self._digest = hashlib.sha256()
+        self._cond = threading.Condition()
+
+    def add(self, index, data):
+        with self._cond:
+            # Hash trước các chunk của lần chạy trước, nếu không worker sẽ chờ mãi khi resume nhiều chunk
+            self._advance()
+            # Chờ khi chunk này còn quá xa chunk tiếp theo cần hash (giới hạn RAM)
+            while index >= self.next_index + self.max_pending and not self.aborted:
+                self._cond.wait()
+            self.pending[index] = data
+            self._advance()
+            self._cond.notify_all()
+
+    def abort(self):
+        with self._cond:
+            self.aborted = True
+            self._cond.notify_all()
+
+    def _advance(self):
+        while self.next_index < len(self.chunks):
+            index = self.next_index
+            if index in self.pending:
+                data = self.pending.pop(index)
+            elif index in self.already_done:
+                _, offset, length = self.chunks[index]
+                data = self.read_chunk(offset, length)
+            else:
+                return
+            self._digest.update(data)
+            self.next_index += 1
+
+    def hexdigest(self):
+        with self._cond:
+            self._advance()
+            if self.next_index != len(self.chunks):
+                raise IOError(f"checksum incomplete: {self.next_index}/{len(self.chunks)} chunks hashed")
+            return self._digest.hexdigest()
+
+def _read_range(path, offset, length):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+def _read_remote_range(f, offset, length):
+    """``length`` bytes at ``offset`` of the open SFTP file ``f``."""
+    blocks = [(pos, min(TRANSFER_BLOCK_SIZE, offset + length - pos)) for pos in range(offset, offset + length, TRANSFER_BLOCK_SIZE)]
+    return b''.join(f.readv(blocks))
+
+def _can_wait_for_writes(f):
+    """True when paramiko exposes the pending write acks of SFTP file ``f``.
+
+    Both are internals (see requirements.txt for the tested range); without
+    them uploads write unpipelined, so every write waits for its ack.
+    """
+    return hasattr(f, '_reqs') and hasattr(f.sftp, '_read_response')
+
+def _wait_for_writes(f):
+    """Block until the server has acknowledged every pipelined write of SFTP file ``f``.
+
+    Raises the server's error (disk full, ...) if one of them failed.
+    """
+    f.flush()
+    # paramiko chỉ đọc ack của write pipelined khi đóng file, lỗi nằm trong ack bị bỏ qua nếu đọc qua request khác
+    if not f.pipelined:
+        return
+    while f._reqs:
+        f.sftp._read_response(f._reqs.popleft())
+
+def _load_transfer_state(state_path, expected):
+    """Return the list of finished chunk indexes from a previous interrupted run."""
+    if not os.path.exists(state_path):
+        return []
+    try:
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return []
+    # Chỉ resume khi file nguồn và cách chia chunk không đổi
+    for key, value in expected.items():
+        if state.get(key) != value:
+            return []
+    return state.get('done', [])
+
+def _save_transfer_state(state_path, expected, done):
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(dict(expected, done=sorted(done)), f)
+    os.replace(tmp_path, state_path)
+
+def transfer_file(conn, conf, direction, remote_path, local_path):
+    """Copy a file over several concurrent SFTP channels, resumable.
+
+    ``direction`` is ``'get'`` (remote -> local) or ``'put'`` (local -> remote).
+    The file is split into ``chunk_mb`` ranges that ``streams`` workers move
+    in parallel, each on its own SFTP channel of the same SSH transport, into
+    a ``.part`` file. Finished ranges (uploads: once the server acknowledged
+    their writes) are recorded in a local ``<local_path>.transfer.json``
+    sidecar so a re-run only moves what is missing, as long as the source's
+    size and mtime are unchanged.
+
+    The data is SHA-256 hashed in order while it streams (chunks of an
+    earlier run are read back from the destination ``.part``) and compared
+    with the source's ``.sha256`` sidecar (for a resumed upload without one,
+    a hash of the local file) before the rename; the destination gets
+    the sidecar too.  If the destination already holds a file with the same
+    checksum nothing is copied.  Returns the hex digest.
+    """
+    settings = _transfer_settings(conf)
+    transport = _transport(conn)
+    sftp = conn.sftp()
+
+    if direction == 'get':
+        source_stat = sftp.stat(remote_path)
+        source_digest = _read_remote_checksum(sftp, remote_path)
+    else:
+        source_stat = os.stat(local_path)
+        source_digest = _read_local_checksum(local_path)
+    size = source_stat.st_size
+
+    existing = _existing_digest(conn, sftp, direction, remote_path, local_path, size, source_digest)
+    if existing is not None:
+        if source_digest is None and direction == 'put':
+            source_digest = _sha256_file(local_path)
+        if existing == source_digest:
+            # Đích đã có đúng file này -> chỉ bổ sung sidecar nếu thiếu
+            if direction == 'get':
+                _write_local_checksum(local_path, existing)
+            else:
+                _write_remote_checksum(sftp, remote_path, existing)
+            METRICS.note(bytes_in=0, bytes_out=0, file_size=size, skipped=True)
+            print(f"  [SKIP] Destination already has this file (SHA-256 {existing[:12]}...), nothing to transfer.")
+            return existing
+
+    chunk_size = settings['chunk_size']
+    chunks = [(i, offset, min(chunk_size, size - offset)) for i, offset in enumerate(range(0, size, chunk_size))]
+
+    part_local = local_path + '.part'
+    part_remote = remote_path + '.part'
+    state_path = local_path + '.transfer.json'
+    expected = {
+        'direction': direction,
+        'remote_path': remote_path,
+        'size': size,
+        'mtime': int(source_stat.st_mtime),
+        'chunk_size': chunk_size,
+    }
+    done = set(_load_transfer_state(state_path, expected))
+
+    # File .part phải còn tồn tại với đúng kích thước thì mới resume được
+    try:
+        if direction == 'get':
+            part_ok = os.path.getsize(part_local) == size
+        else:
+            part_ok = sftp.stat(part_remote).st_size == size
+    except (OSError, IOError):
+        part_ok = False
+    if not part_ok:
+        done = set()
+    if not done:
+        if direction == 'get':
+            with open(part_local, 'wb') as f:
+                f.truncate(size)
+        else:
+            with sftp.open(part_remote, 'w') as f:
+                f.truncate(size)
+    else:
+        print(f"  [RESUME] {len(done)}/{len(chunks)} chunks already transferred, continuing...")
+        if direction == 'put' and source_digest is None:
+            # Phần đã upload được hash lại từ server -> cần checksum nguồn để so
+            source_digest = _sha256_file(local_path)
+
+    pending = queue.Queue()
+    for chunk in chunks:
+        if chunk[0] not in done:
+            pending.put(chunk)
+
+    streams = max(min(settings['streams'], pending.qsize()), 1)
+    label = "Downloaded" if direction == 'get' else "Uploaded"
+    progress = TransferProgress(label, size, streams, already_done=sum(c[2] for c in chunks if c[0] in done))
+    limiter, controller = _start_throttle(conn, conf, progress.rate)
+    state_lock = threading.Lock()
+    errors = []
+    # Chunk đã xong từ lần chạy trước được đọc lại từ chính bản đích (.part local khi get, .part trên server khi put)
+    # -> checksum cuối cùng phản ánh dữ liệu thật sự nằm ở đích
+    if direction == 'get':
+        read_resumed = lambda offset, length: _read_range(part_local, offset, length)
+    else:
+        resumed_part = sftp.open(part_remote, 'rb') if done else None
+        read_resumed = lambda offset, length: _read_remote_range(resumed_part, offset, length)
+    hasher = OrderedHasher(chunks, done, read_resumed, max_pending=streams * 2)
+
+    def worker():
+        channel_sftp = paramiko.SFTPClient.from_transport(transport)
+        try:
+            if direction == 'get':
+                src = channel_sftp.open(remote_path, 'rb')
+                dst = open(part_local, 'r+b')
+            else:
+                src = open(local_path, 'rb')
+                dst = channel_sftp.open(part_remote, 'r+b')
+                dst.set_pipelined(_can_wait_for_writes(dst))
+            with src, dst:
+                while not errors:
+                    try:
+                        index, offset, length = pending.get_nowait()
+                    except queue.Empty:
+                        return
+                    dst.seek(offset)
+                    received = []
+                    if direction == 'get':
+                        # readv gửi nhiều request song song trên cùng channel -> đỡ bị latency
+                        blocks = [(pos, min(TRANSFER_BLOCK_SIZE, offset + length - pos))
+                                  for pos in range(offset, offset + length, TRANSFER_BLOCK_SIZE)]
+                        # Có giới hạn tốc độ -> xin token trước từng block thay vì gửi hết request một lượt
+                        batches = [blocks] if limiter is None else [[block] for block in blocks]
+                        for batch in batches:
+                            if limiter is not None:
+                                limiter.acquire(batch[0][1])
+                            for data in src.readv(batch):
+                                dst.write(data)
+                                received.append(data)
+                                progress(len(data))
+                    else:
+                        src.seek(offset)
+                        remaining = length
+                        while remaining:
+                            if limiter is not None:
+                                limiter.acquire(min(TRANSFER_BLOCK_SIZE, remaining))
+                            data = src.read(min(TRANSFER_BLOCK_SIZE, remaining))
+                            dst.write(data)
+                            received.append(data)
+                            remaining -= len(data)
+                            progress(len(data))
+                    if direction == 'get':
+                        dst.flush()
+                    else:
+                        # Chỉ ghi nhận chunk khi server đã xác nhận mọi write của nó
+                        _wait_for_writes(dst)
+                    with state_lock:
+                        done.add(index)
+                        _save_transfer_state(state_path, expected, done)
+                    hasher.add(index, b''.join(received))
+        except Exception as e:
+            errors.append(e)
+            hasher.abort()
+        finally:
+            channel_sftp.close()
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(streams)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    print()
+    _finish_throttle(limiter, controller, progress.done - progress.start_done, progress.elapsed())
+    try:
+        if errors:
+            raise errors[0]
+        # .part được tạo sẵn đủ kích thước nên chỉ số chunk mới cho biết còn thiếu gì;
+        # nội dung thì do checksum (tính trên dữ liệu ở đích) kiểm tra
+        if len(done) != len(chunks):
+            raise IOError(f"transfer incomplete: {len(done)}/{len(chunks)} chunks")
+        digest = hasher.hexdigest()
+    finally:
+        if direction == 'put' and resumed_part is not None:
+            resumed_part.close()
+    if source_digest is not None and digest != source_digest:
+        # Bỏ luôn .part và state: resume từ dữ liệu hỏng chỉ cho ra file hỏng tiếp
+        if direction == 'get':
+            os.remove(part_local)
+        else:
+            sftp.remove(part_remote)
+        os.remove(state_path)
+        raise IOError(f"checksum mismatch: source {source_digest}, received {digest}")
+    if direction == 'get':
+        os.replace(part_local, local_path)
+        _write_local_checksum(local_path, digest)
+    else:
+        sftp.posix_rename(part_remote, remote_path)
+        _write_remote_checksum(sftp, remote_path, digest)
+        if source_digest is None:
+            _write_local_checksum(local_path, digest)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+
+    elapsed = progress.elapsed()
+    moved = size - progress.start_done
+    METRICS.note(bytes_in=moved, bytes_out=moved, file_size=size, streams=streams, checksum=digest)
+    print(
+        f"  [TRANSFER] {_format_size(size)} in {elapsed:.1f}s ({_format_rate(moved, elapsed)}, {streams} stream(s)), "
+        f"SHA-256 {'verified' if source_digest else 'computed'}: {digest[:12]}..."
+    )
+    return digest
+
+def _existing_digest(conn, sftp, direction, remote_path, local_path, size, source_digest):
+    """Checksum of the file already at the transfer destination, or None.
+
+    Only a destination of the same size is considered.  Its sidecar is
+    trusted when present; otherwise the file is hashed where it lives
+    (``sha256sum`` on the server for uploads).
+    """
+    if direction == 'get':
+        if not os.path.exists(local_path) or os.path.getsize(local_path) != size:
+            return None
+        if source_digest is None:
+            return None
+        return _read_local_checksum(local_path) or _sha256_file(local_path)
+    try:
+        if sftp.stat(remote_path).st_size != size:
+            return None
+    except IOError:
+        return None
+    digest = _read_remote_checksum(sftp, remote_path)
+    if digest is None:
+        result = conn.run(f"sha256sum {shlex.quote(remote_path)}", hide=True, warn=True)
+        digest = _parse_checksum(result.stdout) if result.ok else None
+    return digest
+
+def _get_store(config):
+    """Return the local dedup ChunkStore if ``local.store.enabled`` is set, else None."""
+    store_conf = config['local'].get('store') or {}
+    if not store_conf.get('enabled'):
+        return None
+    path = store_conf.get('path') or os.path.join(config['local']['backup_dir'], 'store')
+    return ChunkStore(path, store_conf.get('avg_chunk_kb', 1024), store_conf.get('level', 6))
+
+@METRICS.timed('store_backup')
+def store_backup(config, filename, keep_file=None):
+    """Ingest a local plain backup into the dedup store (``store`` action / after download)."""
+    store = _get_store(config)
+    if store is None:
+        print("Error: local.store.enabled is not set in config.")
+        sys.exit(1)
+    if _dump_format_of(filename) != 'plain':
+        print(f"  [STORE] Skipping {filename}: only plain SQL dumps can be deduplicated.")
+        return
+    local_path = os.path.join(config['local']['backup_dir'], filename)
+    if not os.path.exists(local_path):
+        print(f"Error: Local backup file not found at {local_path}")
+        sys.exit(1)
+
+    print(f"  [STORE] Adding {filename} to {store.path}...")
+    start = time.time()
+    with open(local_path, 'rb') as f_head:
+        codec = _codec_from_magic(f_head.read(4))
+    try:
+        # Đóng stream = kiểm tra exit code của CLI giải nén (dump hỏng giữa chừng -> lỗi, không phải file ngắn)
+        with _open_decompressed(local_path, codec) as f_in:
+            result = store.add(filename, f_in)
+    except (OSError, EOFError) as e:
+        # Manifest của dữ liệu thiếu không được dùng để restore
+        if store.has(filename):
+            store.remove(filename)
+        print(f"  [STORE] Failed to read {local_path}: {e}")
+        sys.exit(1)
+    elapsed = time.time() - start
+    METRICS.note(bytes_in=result['raw_size'], bytes_out=result['new_bytes'], chunks=result['chunks'], new_chunks=result['new_chunks'])
+    _catalog_add(config, filename, 'store', store.path, raw_size=result['raw_size'], codec=codec)
+    print(
+        f"  [STORE] {result['chunks']} chunks, {result['new_chunks']} new "
+        f"({_format_size(result['new_bytes'])} stored for {_format_size(result['raw_size'])} of SQL) "
+        f"in {elapsed:.1f}s ({_format_rate(result['raw_size'], elapsed)})"
+    )
+    if keep_file is None:
+        keep_file = (config['local'].get('store') or {}).get('keep_files', False)
+    if not keep_file:
+        # Bản phẳng chỉ bị xóa khi store đọc lại ra đúng dữ liệu vừa thêm
+        try:
+            stored = store.read_back(filename)
+        except (OSError, EOFError) as e:
+            stored = (None, str(e))
+        if stored != (result['raw_size'], result['sha256']):
+            store.remove(filename)
+            _catalog_remove(config, filename, 'store')
+            print(f"  [STORE] Read-back check failed ({stored[1]}), keeping the flat copy {local_path}.")
+            sys.exit(1)
+        os.remove(local_path)
+        if os.path.exists(_checksum_path(local_path)):
+            os.remove(_checksum_path(local_path))
+        print(f"  [STORE] Removed flat copy {local_path} (restore/upload read from the store).")
+        _catalog_remove(config, filename, 'local')
+
+def store_list(config):
+    store = _get_store(config)
+    if store is None:
+        print("Error: local.store.enabled is not set in config.")
+        sys.exit(1)
+    print(f"--- Backup store: {store.path} ---")
+    for name in store.names():
+        manifest = store.manifest(name)
+        print(f"  {name}  {_format_size(manifest['raw_size'])} SQL, {len(manifest['chunks'])} chunks, created {manifest['created']}")
+    stats = store.stats()
+    ratio = stats['logical'] / stats['physical'] if stats['physical'] else 0
+    print(
+        f"Total: {stats['backups']} backups, {_format_size(stats['logical'])} of SQL stored in "
+        f"{_format_size(stats['physical'])} ({stats['chunks']} unique chunks, {ratio:.1f}x)"
+    )
+
+def _upload_from_store(conn, conf, store, filename, remote_path):
+    """Upload a stored backup sending only the chunks the remote store lacks.
 
+    Chunks live flat in ``store_path`` on the server (default
+    ``.backup_store`` next to ``remote_path``); the backup is rebuilt there with
+    ``xargs cat``. The result is always a gzip stream, whatever the suffix of
+    ``filename`` (restores detect the codec from the magic bytes). It is hashed
+    in the same pass into a fresh ``.sha256`` sidecar; returns the digest.
+    """
+    remote_store = conf.get('store_path') or f"{posixpath.dirname(remote_path)}/.backup_store"
+    conn.run(f"mkdir -p {remote_store}", hide=True)
+    existing = set(conn.run(f"ls -1 {remote_store}", hide=True).stdout.split())
+
+    digests = store.chunk_digests(filename)
+    missing = [d for d in dict.fromkeys(digests) if d not in existing]
+    missing_bytes = sum(os.path.getsize(store.chunk_path(d)) for d in missing)
+    print(f"  [STORE] {len(missing)} of {len(set(digests))} chunks missing on remote ({_format_size(missing_bytes)} to send)")
+
+    transport = _transport(conn)
+    settings = _transfer_settings(conf)
+    streams = max(min(settings['streams'], len(missing)), 1)
+    progress = TransferProgress("Uploaded", missing_bytes, streams)
+    limiter, controller = _start_throttle(conn, conf, progress.rate)
+    pending = queue.Queue()
+    for digest in missing:
+        pending.put(digest)
+    errors = []
+
+    def worker():
+        channel_sftp = paramiko.SFTPClient.from_transport(transport)
+        try:
+            while not errors:
+                try:
+                    digest = pending.get_nowait()
+                except queue.Empty:
+                    return
+                local_chunk = store.chunk_path(digest)
+                target = f"{remote_store}/{digest}"
+                if limiter is not None:
+                    limiter.acquire(os.path.getsize(local_chunk))
+                channel_sftp.put(local_chunk, target + '.tmp')
+                channel_sftp.posix_rename(target + '.tmp', target)
+                progress(os.path.getsize(local_chunk))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            channel_sftp.close()
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(streams)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if missing:
+        print()
+    _finish_throttle(limiter, controller, progress.done, progress.elapsed())
+    if errors:
+        raise errors[0]
+
+    # Ghép lại file (gzip) trên server theo thứ tự chunk trong manifest, băm SHA-256 cùng lượt.
+    # Sidecar cũ (của lần upload thường trước đó) bị xóa trước, sidecar mới chỉ xuất hiện cùng file hoàn chỉnh
+    list_path = f"{remote_store}/{filename}.list"
+    sidecar = _checksum_path(remote_path)
+    name = posixpath.basename(remote_path)
+    with conn.sftp().open(list_path, 'w') as f:
+        f.write("\n".join(f"{remote_store}/{d}" for d in digests) + "\n")
+    result = conn.run(
+        _remote_pipeline(
+            f"rm -f {sidecar} && "
+            f"xargs cat < {list_path} | tee {remote_path}.part | sha256sum | "
+            f"awk '{{print $1 \"  {name}\"}}' > {sidecar}.part && "
+            f"mv {remote_path}.part {remote_path} && mv {sidecar}.part {sidecar} && cat {sidecar}; "
+            f"rc=$?; rm -f {list_path} {remote_path}.part {sidecar}.part; exit $rc"
+        ),
+        hide=True,
+    )
+    digest = _parse_checksum(result.stdout)
+    if not digest:
+        raise IOError(f"no SHA-256 for the rebuilt {remote_path}")
+    elapsed = progress.elapsed()
+    METRICS.note(bytes_in=missing_bytes, bytes_out=missing_bytes, from_store=True)
+    print(f"  [TRANSFER] {_format_size(missing_bytes)} sent in {elapsed:.1f}s ({_format_rate(missing_bytes, elapsed)})")
+    if not filename.endswith(COMPRESSION_CODECS['gzip']['suffix']):
+        print(f"  [STORE] Note: {remote_path} holds a gzip stream rebuilt from the store (recorded as gzip in the catalog).")
+    return digest
+
+@METRICS.timed('download_backup')
 def download_backup(config, filename):
     print(f"--- [STEP 2] Downloading Backup to Local (File: {filename}) ---")
     prod_conf = config['production']
@@ -145,67 +1355,91 @@ def download_backup(config, filename):
     
     print(f"Downloading {remote_path} to {local_path}...")
     try:
-        conn.get(remote_path, local_path)
+        _ensure_space(config, 'local', _transfer_need(conn, 'get', remote_path, local_path))
+        checksum = transfer_file(conn, prod_conf, 'get', remote_path, local_path)
+        _catalog_add(config, filename, 'local', local_path, os.path.getsize(local_path), source='production', db_name=prod_conf['db_name'], checksum=checksum)
         print("Download successful.")
     except Exception as e:
         print(f"Download failed: {e}")
         sys.exit(1)
     finally:
-        conn.close()
+        release_connection(conn)
+
+    if _get_store(config) is not None:
+        store_backup(config, filename)
 
-def upload_progress(transferred, total):
-    percent = (transferred / total) * 100
-    sys.stdout.write(f"\rUploaded: {transferred} / {total} bytes ({percent:.1f}%)")
-    sys.stdout.flush()
 
+@METRICS.timed('upload_backup')
 def upload_backup(config, filename):
     print(f"--- [STEP 3] Uploading Backup to Staging (File: {filename}) ---")
     staging_conf = config['staging']
     local_conf = config['local']
     
     local_path = os.path.join(local_conf['backup_dir'], filename)
-    if not os.path.exists(local_path):
+    store = _get_store(config)
+    from_store = not os.path.exists(local_path) and store is not None and store.has(filename)
+    if not os.path.exists(local_path) and not from_store:
         print(f"Error: Local backup file not found at {local_path}")
         sys.exit(1)
     
-    remote_path = f"/home/anderson/{filename}"
+    remote_path = _staging_remote_path(staging_conf, filename)
         
     conn = get_connection(staging_conf)
     
-    print(f"Uploading {local_path} to {remote_path}...")
+    print(f"Uploading {'store:' + filename if from_store else local_path} to {remote_path}...")
     try:
-        sftp = conn.sftp()
-        sftp.put(local_path, remote_path, callback=upload_progress)
-        print("\nUpload successful.")
+        _ensure_space(config, 'staging', _transfer_need(conn, 'put', remote_path, local_path, store if from_store else None), conn)
+        if from_store:
+            checksum = _upload_from_store(conn, staging_conf, store, filename, remote_path)
+            # File dựng lại từ store luôn là gzip, kể cả khi bản gốc là zstd/lz4
+            _catalog_add(config, filename, 'staging', remote_path, _remote_size(conn, remote_path), checksum=checksum, codec='gzip')
+        else:
+            checksum = transfer_file(conn, staging_conf, 'put', remote_path, local_path)
+            _catalog_add(config, filename, 'staging', remote_path, os.path.getsize(local_path), checksum=checksum)
+        print("Upload successful.")
     except Exception as e:
         print(f"\nUpload failed: {e}")
         sys.exit(1)
     finally:
-        conn.close()
+        release_connection(conn)
 
-def backup_staging(config, filename):
+@METRICS.timed('backup_staging')
+def backup_staging(config, filename, fmt=None, jobs=None):
     print(f"--- [STEP 0] Backing up Staging Database (File: {filename}) ---")
     staging_conf = config['staging']
     conn = get_connection(staging_conf)
     
     remote_path = f"/tmp/{filename}"
     
-    prefix = _db_prefix(staging_conf)
-    dump_cmd = (
-        f"{prefix}pg_dump {_db_host_arg(staging_conf)}-U {staging_conf['db_user']} {staging_conf['db_name']} "
-        f"| gzip > {remote_path}"
-    )
+    fmt, jobs = _dump_settings(staging_conf, fmt, jobs)
+    dump_cmd = _dump_command(staging_conf, remote_path, fmt, jobs)
 
     print(f"Executing: {dump_cmd}")
     try:
+        start = time.time()
         conn.run(dump_cmd)
         print(f"Backup successful on staging remote: {remote_path}")
+        raw = codec = None
+        if fmt == 'plain':
+            raw, packed = _report_compression(conn, staging_conf, remote_path, time.time() - start)
+            codec = _compression_settings(staging_conf)['codec']
+        else:
+            packed = _remote_size(conn, remote_path)
+            METRICS.note(bytes_out=packed, format=fmt)
+        checksum = _read_remote_checksum(conn.sftp(), remote_path)
+        print(f"  [CHECKSUM] SHA-256 {checksum}")
+        _catalog_add(
+            config, filename, 'staging', remote_path, packed,
+            source='staging', db_name=staging_conf['db_name'], format=fmt, codec=codec, raw_size=raw, checksum=checksum,
+        )
     except UnexpectedExit as e:
         print(f"Backup failed: {e}")
+        conn.run(f"rm -f {_stat_path(remote_path)} {_checksum_path(remote_path)}", hide=True, warn=True)
         sys.exit(1)
     finally:
-        conn.close()
+        release_connection(conn)
 
+@METRICS.timed('download_staging')
 def download_staging(config, filename):
     print(f"--- [STEP 0.5] Downloading Staging Backup to Local (File: {filename}) ---")
     staging_conf = config['staging']
@@ -221,14 +1455,17 @@ def download_staging(config, filename):
     
     print(f"Downloading {remote_path} to {local_path}...")
     try:
-        conn.get(remote_path, local_path)
+        _ensure_space(config, 'local', _transfer_need(conn, 'get', remote_path, local_path))
+        checksum = transfer_file(conn, staging_conf, 'get', remote_path, local_path)
+        _catalog_add(config, filename, 'local', local_path, os.path.getsize(local_path), source='staging', db_name=staging_conf['db_name'], checksum=checksum)
         print("Download successful.")
     except Exception as e:
         print(f"Download failed: {e}")
         sys.exit(1)
     finally:
-        conn.close()
+        release_connection(conn)
 
+@METRICS.timed('upload_prod')
 def upload_prod(config, filename):
     # Vietnamese comment: Tải file backup từ máy local lên server Production (vào thư mục /tmp)
     print(f"--- [STEP 3] Uploading Backup to Production (File: {filename}) ---")
@@ -236,7 +1473,9 @@ def upload_prod(config, filename):
     local_conf = config['local']
     
     local_path = os.path.join(local_conf['backup_dir'], filename)
-    if not os.path.exists(local_path):
+    store = _get_store(config)
+    from_store = not os.path.exists(local_path) and store is not None and store.has(filename)
+    if not os.path.exists(local_path) and not from_store:
         print(f"Error: Local backup file not found at {local_path}")
         sys.exit(1)
     
@@ -244,231 +1483,2039 @@ def upload_prod(config, filename):
         
     conn = get_connection(prod_conf)
     
-    print(f"Uploading {local_path} to {remote_path}...")
+    print(f"Uploading {'store:' + filename if from_store else local_path} to {remote_path}...")
     try:
-        sftp = conn.sftp()
-        sftp.put(local_path, remote_path, callback=upload_progress)
-        print("\nUpload successful.")
+        _ensure_space(config, 'production', _transfer_need(conn, 'put', remote_path, local_path, store if from_store else None), conn)
+        if from_store:
+            checksum = _upload_from_store(conn, prod_conf, store, filename, remote_path)
+            # File dựng lại từ store luôn là gzip, kể cả khi bản gốc là zstd/lz4
+            _catalog_add(config, filename, 'production', remote_path, _remote_size(conn, remote_path), checksum=checksum, codec='gzip')
+        else:
+            checksum = transfer_file(conn, prod_conf, 'put', remote_path, local_path)
+            _catalog_add(config, filename, 'production', remote_path, os.path.getsize(local_path), checksum=checksum)
+        print("Upload successful.")
     except Exception as e:
         print(f"\nUpload failed: {e}")
         sys.exit(1)
     finally:
-        conn.close()
+        release_connection(conn)
 
-def restore_prod(config, filename, clean=False):
-    # Vietnamese comment: Khôi phục database trên server Production từ file backup trong /tmp
-    prod_conf = config['production']
-    conn = get_connection(prod_conf)
-    remote_path = f"/tmp/{filename}"
-    print(f"--- [STEP 4] Restoring Production Database (File: {filename}) ---")
-    
-    # Build prefix for commands; may or may not include docker exec
-    prefix = _db_prefix(prod_conf)
-    
-    # Clean DB if requested
-    if clean:
-        print("  [CLEAN] Dropping & Recreating 'public' schema to ensure a clean restore...")
-        # 1. Terminate connections
-        kill_cmd = (
-            f"{prefix}psql {_db_host_arg(prod_conf)}-U {prod_conf['db_user']} -d {prod_conf['db_name']} "
-            f"-c \"SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = '{prod_conf['db_name']}' AND pid <> pg_backend_pid();\""
-        )
-        # 2. Dùng superuser nếu có để DROP SCHEMA hoàn toàn (bypass ownership restrictions)
-        #    Nếu không có superuser, fallback về DROP OWNED BY current_user
-        su_user = prod_conf.get('db_superuser')
-        if su_user:
-            su_pass = prod_conf.get('db_superuser_password', '')
-            docker = prod_conf.get('docker_container')
-            if docker:
-                su_env_flag = f"-e PGPASSWORD='{su_pass}' " if su_pass else ""
-                su_prefix = f"docker exec {su_env_flag}{docker} "
-            else:
-                su_prefix = f"PGPASSWORD='{su_pass}' " if su_pass else ""
-            reset_schema_cmd = (
-                f"{su_prefix}psql -v ON_ERROR_STOP=1 {_db_host_arg(prod_conf)}-U {su_user} -d {prod_conf['db_name']} "
-                f"-c \"DROP SCHEMA public CASCADE; CREATE SCHEMA public; "
-                f"GRANT ALL ON SCHEMA public TO {prod_conf['db_user']}; "
-                f"GRANT ALL ON SCHEMA public TO public;\""
-            )
-        else:
-            # Fallback: DROP OWNED BY chỉ xóa objects owned bởi db_user
-            reset_schema_cmd = (
-                f"{prefix}psql -v ON_ERROR_STOP=1 {_db_host_arg(prod_conf)}-U {prod_conf['db_user']} -d {prod_conf['db_name']} "
-                f"-c \"DROP OWNED BY current_user CASCADE; "
-                f"DROP SCHEMA IF EXISTS public CASCADE; CREATE SCHEMA public; "
-                f"GRANT ALL ON SCHEMA public TO {prod_conf['db_user']}; "
-                f"GRANT ALL ON SCHEMA public TO public;\""
-            )
+# --- Relay: file đi thẳng giữa hai server, máy chạy tool chỉ điều phối ---
+RELAY_ENVS = ('production', 'staging')
+RELAY_MODES = ('pull', 'push')
+RELAY_DEFAULTS = {
+    'mode': 'pull',
+    'forward_agent': True,
+    'ssh_key_path': None,
+    'ssh_options': ['BatchMode=yes', 'StrictHostKeyChecking=accept-new'],
+    'hosts': {},
+}
+RELAY_POLL_INTERVAL = 1.0
 
-        try:
-            conn.run(kill_cmd, hide=True, warn=True) # warn=True because it might fail if we kill ourself or no perms, but worth trying
-            conn.run(reset_schema_cmd)
-            print("  [CLEAN] Schema reset successful.")
-        except Exception as e:
-            print(f"  [CLEAN] Warning: Failed to reset schema: {e}")
-            print("  Continuing with restore (might fail if conflicts exist)...")
-    
-    restore_cmd = (
-        f"gunzip -c {remote_path} | "
-        f"{_db_prefix(prod_conf, interactive=True)}psql {_db_host_arg(prod_conf)}-U {prod_conf['db_user']} -d {prod_conf['db_name']}"
-    )
-    
-    print(f"Executing restore on production... (This might take a while)")
-    try:
-        conn.run(restore_cmd)
+def _relay_settings(config, mode=None):
+    settings = dict(RELAY_DEFAULTS)
+    settings.update(config.get('relay') or {})
+    if mode:
+        settings['mode'] = mode
+    if settings['mode'] not in RELAY_MODES:
+        print(f"Error: relay.mode must be one of {', '.join(RELAY_MODES)}, got '{settings['mode']}'.")
+        sys.exit(1)
+    return settings
+
+def _env_backup_path(config, env, filename):
+    """Where backups are put on ``env``: ``/tmp`` on Production, ``remote_dir`` on Staging."""
+    if env == 'staging':
+        return _staging_remote_path(config['staging'], filename)
+    return f"/tmp/{filename}"
+
+def _remote_sha256(conn, remote_path):
+    result = conn.run(f"sha256sum {shlex.quote(remote_path)}", hide=True, warn=True)
+    return _parse_checksum(result.stdout) if result.ok else None
+
+def _relay_ssh(config, settings, peer, command):
+    """``ssh`` command line that one server runs to execute ``command`` on ``peer``.
+
+    ``relay.hosts.<peer>`` (``host`` or ``host:port``) is the peer's address
+    as seen from the other server, e.g. a private network address.
+    """
+    conf = config[peer]
+    host, port = conf['host'], conf.get('port', 22)
+    address = str(settings['hosts'].get(peer) or '')
+    if address:
+        host, _, custom_port = address.partition(':')
+        port = custom_port or port
+    parts = ['ssh', '-p', str(port)]
+    if settings.get('ssh_key_path'):
+        parts += ['-i', settings['ssh_key_path']]
+    for option in settings['ssh_options'] or []:
+        parts += ['-o', option]
+    parts += [f"{conf['user']}@{host}", command]
+    return ' '.join(shlex.quote(part) for part in parts)
+
+def _relay_copy(config, settings, src_conn, dst_conn, source, dest, src_path, part_path, size):
+    """Run the server-to-server copy into ``part_path`` and return its SHA-256.
+
+    pull: Destination runs ``ssh source cat <file> | tee <part> | sha256sum``.
+    push: Source runs ``cat <file> | ssh dest 'tee <part> | sha256sum'``.
+    Either way the digest is of the bytes written on the destination; the
+    ``.part`` size is polled over SFTP for the progress display.
+    """
+    if settings['mode'] == 'pull':
+        runner = dst_conn
+        cmd = _remote_pipeline(
+            f"{_relay_ssh(config, settings, source, f'cat {shlex.quote(src_path)}')} | "
+            f"tee {shlex.quote(part_path)} | sha256sum"
+        )
+    else:
+        runner = src_conn
+        cmd = _remote_pipeline(
+            f"cat {shlex.quote(src_path)} | "
+            f"{_relay_ssh(config, settings, dest, f'tee {shlex.quote(part_path)} | sha256sum')}"
+        )
+    dst_sftp = dst_conn.sftp()
+    channel = _transport(runner).open_session()
+    # Agent forwarding: server chạy ssh dùng key trong ssh-agent của máy này, không cần copy key lên server
+    agent = paramiko.agent.AgentRequestHandler(channel) if settings['forward_agent'] else None
+    out, err = [], []
+    progress = TransferProgress("Relayed", size)
+    try:
+        channel.exec_command(cmd)
+        while not channel.exit_status_ready():
+            channel.status_event.wait(RELAY_POLL_INTERVAL)
+            while channel.recv_ready():
+                out.append(channel.recv(STREAM_CHUNK_SIZE))
+            _drain_stderr(channel, err)
+            try:
+                written = dst_sftp.stat(part_path).st_size
+            except IOError:
+                continue
+            if written > progress.done:
+                progress(written - progress.done)
+        status = channel.recv_exit_status()
+        while True:
+            data = channel.recv(STREAM_CHUNK_SIZE)
+            if not data:
+                break
+            out.append(data)
+        _drain_stderr(channel, err)
+    finally:
+        channel.close()
+        if agent is not None:
+            agent.close()
+    print()
+    if status != 0:
+        message = b"".join(err).decode(errors='replace').strip()
+        raise IOError(f"relay ({settings['mode']}) exited with code {status}: {message}")
+    written = dst_sftp.stat(part_path).st_size
+    if written != size:
+        raise IOError(f"relay incomplete: {written} of {size} bytes")
+    return _parse_checksum(b"".join(out).decode(errors='replace')), progress.elapsed()
+
+@METRICS.timed('relay_backup')
+def relay_backup(config, filename, source='production', dest='staging', mode=None):
+    """Copy a backup between two servers without passing it through this machine.
+
+    The file goes from the backup directory of ``source`` (``/tmp`` on
+    Production, ``remote_dir`` on Staging, or where the catalog has it) to
+    the one of ``dest`` over a direct SSH connection between the servers,
+    into a ``.part`` file renamed once its SHA-256 matches the source's.
+    Skipped when ``dest`` already has the same file.
+    """
+    if source == dest:
+        print("Error: relay needs two different servers (--from / --to).")
+        sys.exit(1)
+    settings = _relay_settings(config, mode)
+    print(f"--- [RELAY] {source.capitalize()} -> {dest.capitalize()} ({settings['mode']}, File: {filename}) ---")
+    src_conn = get_connection(config[source])
+    dst_conn = get_connection(config[dest])
+    copy = _get_catalog(config).copies(filename).get(source)
+    src_path = copy['path'] if copy else _env_backup_path(config, source, filename)
+    dst_path = _env_backup_path(config, dest, filename)
+    part_path = dst_path + '.part'
+    try:
+        src_sftp = src_conn.sftp()
+        dst_sftp = dst_conn.sftp()
+        try:
+            size = src_sftp.stat(src_path).st_size
+        except IOError:
+            print(f"Error: {src_path} not found on {source}.")
+            sys.exit(1)
+        source_digest = _read_remote_checksum(src_sftp, src_path)
+        existing = _existing_digest(dst_conn, dst_sftp, 'put', dst_path, None, size, source_digest)
+        if existing is not None and existing == (source_digest or _remote_sha256(src_conn, src_path)):
+            _write_remote_checksum(dst_sftp, dst_path, existing)
+            _catalog_add(config, filename, dest, dst_path, size, checksum=existing)
+            METRICS.note(bytes_in=0, bytes_out=0, file_size=size, skipped=True)
+            print(f"  [SKIP] {dest} already has this file (SHA-256 {existing[:12]}...), nothing to relay.")
+            return existing
+
+        _ensure_space(config, dest, size, dst_conn)
+        print(f"Relaying {source}:{src_path} -> {dest}:{dst_path} ({_format_size(size)})...")
+        digest, elapsed = _relay_copy(
+            config, settings, src_conn, dst_conn, source, dest, src_path, part_path, size)
+        if source_digest is None:
+            source_digest = _remote_sha256(src_conn, src_path)
+        if digest is None or digest != source_digest:
+            raise IOError(f"checksum mismatch: source {source_digest}, received {digest}")
+        dst_sftp.posix_rename(part_path, dst_path)
+        _write_remote_checksum(dst_sftp, dst_path, digest)
+        _catalog_add(config, filename, dest, dst_path, size, checksum=digest)
+        METRICS.note(bytes_in=size, bytes_out=size, file_size=size, mode=settings['mode'], checksum=digest)
+        print(f"  [RELAY] {_format_size(size)} in {elapsed:.1f}s ({_format_rate(size, elapsed)}), SHA-256 verified: {digest[:12]}...")
+        print("Relay successful.")
+        return digest
+    except (IOError, UnexpectedExit) as e:
+        print(f"Relay failed: {e}")
+        dst_conn.run(f"rm -f {shlex.quote(part_path)}", hide=True, warn=True)
+        sys.exit(1)
+    finally:
+        release_connection(src_conn)
+        release_connection(dst_conn)
+
+def _reject_physical(filename):
+    if _dump_format_of(filename) == 'physical':
+        print(f"Error: {filename} is a physical backup (pg_basebackup); use restore_physical.")
+        sys.exit(1)
+
+def _superuser_prefix(conf):
+    """Like ``_db_prefix`` but with the password of ``db_superuser``."""
+    su_pass = conf.get('db_superuser_password', '')
+    docker = conf.get('docker_container')
+    if docker:
+        su_env_flag = f"-e PGPASSWORD='{su_pass}' " if su_pass else ""
+        return f"docker exec {su_env_flag}{docker} "
+    return f"PGPASSWORD='{su_pass}' " if su_pass else ""
+
+def _clean_remote_db(conn, conf):
+    """Terminate sessions and reset the 'public' schema before a restore (--clean)."""
+    prefix = _db_prefix(conf)
+    print("  [CLEAN] Dropping & Recreating 'public' schema to ensure a clean restore...")
+    # 1. Terminate connections
+    kill_cmd = (
+        f"{prefix}psql {_db_host_arg(conf)}-U {conf['db_user']} -d {conf['db_name']} "
+        f"-c \"SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = '{conf['db_name']}' AND pid <> pg_backend_pid();\""
+    )
+    # 2. Dùng superuser nếu có để DROP SCHEMA hoàn toàn (bypass ownership restrictions)
+    #    Nếu không có superuser, fallback về DROP OWNED BY current_user
+    su_user = conf.get('db_superuser')
+    if su_user:
+        su_prefix = _superuser_prefix(conf)
+        reset_schema_cmd = (
+            f"{su_prefix}psql -v ON_ERROR_STOP=1 {_db_host_arg(conf)}-U {su_user} -d {conf['db_name']} "
+            f"-c \"DROP SCHEMA public CASCADE; CREATE SCHEMA public; "
+            f"GRANT ALL ON SCHEMA public TO {conf['db_user']}; "
+            f"GRANT ALL ON SCHEMA public TO public;\""
+        )
+    else:
+        # Fallback: DROP OWNED BY chỉ xóa objects owned bởi db_user
+        reset_schema_cmd = (
+            f"{prefix}psql -v ON_ERROR_STOP=1 {_db_host_arg(conf)}-U {conf['db_user']} -d {conf['db_name']} "
+            f"-c \"DROP OWNED BY current_user CASCADE; "
+            f"DROP SCHEMA IF EXISTS public CASCADE; CREATE SCHEMA public; "
+            f"GRANT ALL ON SCHEMA public TO {conf['db_user']}; "
+            f"GRANT ALL ON SCHEMA public TO public;\""
+        )
+
+    try:
+        conn.run(kill_cmd, hide=True, warn=True) # warn=True because it might fail if we kill ourself or no perms, but worth trying
+        conn.run(reset_schema_cmd)
+        print("  [CLEAN] Schema reset successful.")
+    except Exception as e:
+        print(f"  [CLEAN] Warning: Failed to reset schema: {e}")
+        print("  Continuing with restore (might fail if conflicts exist)...")
+
+@METRICS.timed('restore_prod')
+def restore_prod(config, filename, clean=False, jobs=None, fast=False):
+    # Vietnamese comment: Khôi phục database trên server Production từ file backup trong /tmp
+    prod_conf = config['production']
+    print(f"--- [STEP 4] Restoring Production Database (File: {filename}) ---")
+    _reject_physical(filename)
+    conn = get_connection(prod_conf)
+    remote_path = f"/tmp/{filename}"
+    
+    _, restore_jobs = _dump_settings(prod_conf, jobs=jobs)
+    codec = None
+    if _dump_format_of(filename) == 'plain':
+        # Nhận diện codec từ magic bytes TRƯỚC khi --clean xóa schema
+        try:
+            codec = _remote_codec(conn, remote_path)
+        except UnexpectedExit as e:
+            print(f"Error: Cannot read backup file {remote_path}: {e.result.stderr.strip()}")
+            release_connection(conn)
+            sys.exit(1)
+    restore_cmd = _restore_command(prod_conf, remote_path, restore_jobs, codec)
+    METRICS.note(bytes_in=_remote_size(conn, remote_path), format=_dump_format_of(filename), codec=codec, fast=fast)
+
+    # Kiểm tra checksum TRƯỚC khi --clean xóa schema: file hỏng thì dừng, DB giữ nguyên
+    if not _verify_remote_checksum(conn, remote_path):
+        print("Restore aborted: the backup is corrupted, the database was not touched.")
+        release_connection(conn)
+        sys.exit(1)
+
+    # Clean DB if requested
+    if clean:
+        _clean_remote_db(conn, prod_conf)
+    
+    print(f"Executing restore on production... (This might take a while)")
+    try:
+        if fast:
+            _fast_restore_remote(conn, prod_conf, remote_path, jobs, codec)
+        else:
+            conn.run(restore_cmd)
         print("Restore successful.")
     except UnexpectedExit as e:
         print(f"Restore failed: {e}")
         sys.exit(1)
     finally:
-        conn.close()
+        release_connection(conn)
 
-def restore_staging(config, filename, clean=False):
+@METRICS.timed('restore_staging')
+def restore_staging(config, filename, clean=False, jobs=None, fast=False):
     staging_conf = config['staging']
-    conn = get_connection(staging_conf)
-    remote_path = f"/home/anderson/{filename}"
     print(f"--- [STEP 4] Restoring Staging Database (File: {filename}) ---")
+    _reject_physical(filename)
+    conn = get_connection(staging_conf)
+    remote_path = _staging_remote_path(staging_conf, filename)
     
-    prefix = _db_prefix(staging_conf)
+    _, restore_jobs = _dump_settings(staging_conf, jobs=jobs)
+    codec = None
+    if _dump_format_of(filename) == 'plain':
+        # Nhận diện codec từ magic bytes TRƯỚC khi --clean xóa schema
+        try:
+            codec = _remote_codec(conn, remote_path)
+        except UnexpectedExit as e:
+            print(f"Error: Cannot read backup file {remote_path}: {e.result.stderr.strip()}")
+            release_connection(conn)
+            sys.exit(1)
+    restore_cmd = _restore_command(staging_conf, remote_path, restore_jobs, codec)
+    METRICS.note(bytes_in=_remote_size(conn, remote_path), format=_dump_format_of(filename), codec=codec, fast=fast)
+
+    # Kiểm tra checksum TRƯỚC khi --clean xóa schema: file hỏng thì dừng, DB giữ nguyên
+    if not _verify_remote_checksum(conn, remote_path):
+        print("Restore aborted: the backup is corrupted, the database was not touched.")
+        release_connection(conn)
+        sys.exit(1)
+
+    # Clean DB if requested
+    if clean:
+        _clean_remote_db(conn, staging_conf)
+
     
+    print(f"Executing restore on staging... (This might take a while)")
+    try:
+        if fast:
+            _fast_restore_remote(conn, staging_conf, remote_path, jobs, codec)
+        else:
+            conn.run(restore_cmd)
+        print("Restore successful.")
+    except UnexpectedExit as e:
+        print(f"Restore failed: {e}")
+        sys.exit(1)
+    finally:
+        release_connection(conn)
+
+def _checked_members(tar, root):
+    """Members of ``tar`` (also in stream mode), refusing any that would land outside ``root``."""
+    root = os.path.realpath(root)
+    for member in tar:
+        target = os.path.realpath(os.path.join(root, member.name))
+        links = []
+        if member.issym():
+            links.append(os.path.realpath(os.path.join(os.path.dirname(target), member.linkname)))
+        elif member.islnk():
+            links.append(os.path.realpath(os.path.join(root, member.linkname)))
+        for path in [target] + links:
+            if os.path.isabs(member.linkname or '') or (path != root and not path.startswith(root + os.sep)):
+                raise tarfile.TarError(f"refusing to extract {member.name!r} outside {root}")
+        if member.isdev():
+            raise tarfile.TarError(f"refusing to extract device file {member.name!r}")
+        yield member
+
+def _extract_tar(tar, path):
+    """``tar.extractall(path)`` that never writes outside ``path``.
+
+    Uses the ``data`` extraction filter where Python has it (3.8.17+ /
+    3.11.4+), otherwise checks every member itself.
+    """
+    if hasattr(tarfile, 'data_filter'):
+        tar.extractall(path, filter='data')
+    else:
+        tar.extractall(path, members=_checked_members(tar, path))
+
+def _restore_local_archive(backup_path, fmt, auth_args, env, jobs, fast=False):
+    """Restore a custom/directory format backup locally with ``pg_restore -j``.
+
+    With ``fast`` the archive is restored section by section (pre-data, data,
+    post-data) and each phase is timed.
+    """
+    work_dir = None
+    target = backup_path
+    try:
+        if fmt == 'directory':
+            # Giải nén file .dir.tar ra thư mục tạm cạnh file backup
+            work_dir = tempfile.mkdtemp(prefix='restore_', dir=os.path.dirname(backup_path))
+            with tarfile.open(backup_path) as tar:
+                _extract_tar(tar, work_dir)
+            target = work_dir
+
+        if fast:
+            phases = [
+                ('pre-data', ['--section=pre-data']),
+                ('data', ['--section=data', '-j', str(jobs)]),
+                ('post-data', ['--section=post-data', '-j', str(jobs)]),
+            ]
+        else:
+            phases = [(None, ['-j', str(jobs)])]
+        total_start = time.time()
+        for name, extra_args in phases:
+            start = time.time()
+            result = subprocess.run(['pg_restore'] + auth_args + extra_args + [target], env=env)
+            if result.returncode != 0:
+                print(f"Restore failed with exit code {result.returncode}")
+                sys.exit(1)
+            if name:
+                print(f"  [FAST] Phase {name} finished in {time.time() - start:.1f}s")
+        if fast:
+            print(f"  [FAST] All phases finished in {time.time() - total_start:.1f}s")
+        print("Restore successful.")
+    except (OSError, tarfile.TarError) as e:
+        print(f"Restore failed: {e}")
+        sys.exit(1)
+    finally:
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+class _ProcessReader(io.RawIOBase):
+    """stdout of a decompressor process as a stream whose ``close()`` checks the exit code.
+
+    A CLI that fails midway only ends its output early; closing after the
+    whole stream was read raises IOError for a non-zero exit status.
+    Closing before the end (the caller gave up) just stops the process.
+    """
+
+    def __init__(self, proc, name):
+        self.proc = proc
+        self.name = name
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = self.proc.stdout.readinto(buffer)
+        if not count:
+            self._eof = True
+        return count
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        if not self._eof:
+            self.proc.kill()
+        self.proc.stdout.close()
+        status = self.proc.wait()
+        if self._eof and status != 0:
+            raise IOError(f"{self.name} exited with code {status}, the decompressed data is incomplete")
+
+def _open_decompressed(path, codec):
+    """Open a local backup as a decompressed binary stream.
+
+    gzip uses the standard library. zstd / lz4 use the optional ``zstandard``
+    / ``lz4`` packages when installed, otherwise the ``zstd`` / ``lz4`` CLI
+    (a failed run raises IOError when the stream is closed).
+    """
+    if codec is None:
+        return open(path, 'rb')
+    if codec in ('gzip', 'pigz'):
+        return gzip.open(path, 'rb')
+    try:
+        if codec == 'zstd':
+            import zstandard
+            return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+        import lz4.frame
+        return lz4.frame.open(path, 'rb')
+    except ImportError:
+        command = COMPRESSION_CODECS[codec]['decompress'].split()
+        proc = subprocess.Popen(command + [path], stdout=subprocess.PIPE)
+        return io.BufferedReader(_ProcessReader(proc, command[0]), STREAM_CHUNK_SIZE)
+
+# --- restore_local: decompressor | psql ----------------------------------------
+# native: decompressor (và awk cho --fast) nối thẳng vào psql bằng pipe của OS,
+# dữ liệu không đi qua Python. python: giải nén trong process với buffer lớn dùng lại.
+RESTORE_PIPE_MODES = ('auto', 'native', 'python')
+RESTORE_PIPE_DEFAULTS = {'mode': 'auto', 'pipe_buffer_kb': 1024, 'buffer_mb': 4}
+# CLI giải nén local theo thứ tự ưu tiên (pigz giải nén gzip nhanh hơn gzip)
+LOCAL_DECOMPRESSORS = {
+    'gzip': (['pigz', '-dc'], ['gzip', '-dc']),
+    'pigz': (['pigz', '-dc'], ['gzip', '-dc']),
+    'zstd': (['zstd', '-dc', '-q'],),
+    'lz4': (['lz4', '-dc', '-q'],),
+}
+# fcntl.F_SETPIPE_SZ (Linux >= 2.6.35, Python >= 3.10 mới có hằng số)
+F_SETPIPE_SZ = 1031
+
+def _restore_pipe_settings(local_conf, mode=None):
+    """``local.restore_pipe`` block merged with the defaults; ``mode`` overrides it."""
+    settings = dict(RESTORE_PIPE_DEFAULTS)
+    settings.update(local_conf.get('restore_pipe') or {})
+    if mode:
+        settings['mode'] = mode
+    if settings['mode'] not in RESTORE_PIPE_MODES:
+        print(f"Error: Unknown restore_pipe mode '{settings['mode']}'. Use one of: {', '.join(RESTORE_PIPE_MODES)}")
+        sys.exit(1)
+    settings['pipe_buffer'] = int(float(settings['pipe_buffer_kb']) * 1024)
+    settings['buffer'] = max(int(float(settings['buffer_mb']) * 1024 * 1024), 64 * 1024)
+    return settings
+
+def _local_decompressor(codec):
+    """argv of the first installed CLI able to decompress ``codec``, or None."""
+    for argv in LOCAL_DECOMPRESSORS.get(codec, ()):
+        if shutil.which(argv[0]):
+            return argv
+    return None
+
+def _set_pipe_size(fd, size):
+    """Grow the pipe behind ``fd`` to ``size`` bytes where the OS allows it.
+
+    Returns the size actually set, or None (not Linux, not a pipe, or the
+    kernel refused). The kernel caps unprivileged sizes at
+    ``/proc/sys/fs/pipe-max-size``, so ask for at most that.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return None
+    try:
+        with open('/proc/sys/fs/pipe-max-size') as f:
+            size = min(size, int(f.read()))
+    except (OSError, ValueError):
+        pass
+    try:
+        return fcntl.fcntl(fd, getattr(fcntl, 'F_SETPIPE_SZ', F_SETPIPE_SZ), size)
+    except OSError:
+        return None
+
+def _native_pipe_to_psql(backup_path, decompressor, psql_cmd, env, pipe_size, phase=None):
+    """Run ``decompressor [| awk phase filter] | psql`` joined by OS pipes.
+
+    Python only starts the processes and waits; without ``decompressor``
+    (raw SQL) the file itself is psql's stdin. Returns the pipe size in
+    effect (None when unchanged).
+    """
+    commands = []
+    if decompressor:
+        commands.append(decompressor + [backup_path])
+    if phase:
+        commands.append(['awk', '-v', f'phase={phase}', SQL_PHASE_AWK])
+    procs = []
+    effective = None
+    with open(backup_path, 'rb') as raw:
+        stdin = subprocess.DEVNULL if decompressor else raw
+        try:
+            for argv in commands:
+                proc = subprocess.Popen(argv, stdin=stdin, stdout=subprocess.PIPE)
+                effective = _set_pipe_size(proc.stdout.fileno(), pipe_size) or effective
+                if procs:
+                    # Đóng đầu đọc của parent để process trước nhận SIGPIPE khi process sau chết
+                    stdin.close()
+                procs.append(proc)
+                stdin = proc.stdout
+            psql = subprocess.Popen(psql_cmd, stdin=stdin, env=env)
+            if procs:
+                stdin.close()
+        except OSError:
+            for proc in procs:
+                proc.kill()
+                proc.wait()
+            raise
+        psql.wait()
+        codes = [proc.wait() for proc in procs]
+    if psql.returncode != 0:
+        raise RuntimeError(f"psql exited with code {psql.returncode}")
+    for argv, code in zip(commands, codes):
+        if code != 0:
+            raise RuntimeError(f"{argv[0]} exited with code {code}")
+    return effective
+
+def _python_pipe_to_psql(source, psql_cmd, env, settings, phase=None):
+    """Feed ``source`` into psql from Python through one reusable buffer.
+
+    Returns ``(decompressed bytes, pipe size in effect)``.
+    """
+    total = 0
+    with subprocess.Popen(psql_cmd, stdin=subprocess.PIPE, env=env, bufsize=0) as p:
+        effective = _set_pipe_size(p.stdin.fileno(), settings['pipe_buffer'])
+        try:
+            if phase:
+                # Lọc theo dòng: gom các dòng vào buffer rồi mới ghi 1 lần
+                if not hasattr(source, 'peek'):
+                    # zstandard stream_reader không hỗ trợ đọc theo dòng
+                    source = io.BufferedReader(source, settings['buffer'])
+                batch = bytearray()
+                for line in _sql_phase_filter(source, phase):
+                    batch += line
+                    if len(batch) >= settings['buffer']:
+                        _write_all(p.stdin, batch)
+                        total += len(batch)
+                        batch.clear()
+                _write_all(p.stdin, batch)
+                total += len(batch)
+            else:
+                buf = bytearray(settings['buffer'])
+                view = memoryview(buf)
+                while True:
+                    n = source.readinto(buf)
+                    if not n:
+                        break
+                    _write_all(p.stdin, view[:n])
+                    total += n
+        except BrokenPipeError:
+            pass  # psql đã thoát, mã lỗi được báo ở dưới
+        finally:
+            try:
+                p.stdin.close() # Signal EOF
+            except BrokenPipeError:
+                pass
+        p.wait()
+    if p.returncode != 0:
+        raise RuntimeError(f"psql exited with code {p.returncode}")
+    return total, effective
+
+def _write_all(fileobj, data):
+    """``write`` on an unbuffered pipe may be partial: loop until all is written."""
+    view = memoryview(data)
+    while view:
+        view = view[fileobj.write(view):]
+
+@METRICS.timed('restore_local')
+def restore_local(config, filename, clean=False, jobs=None, fast=False, pipe=None):
+    print(f"--- [RESTORE LOCAL] Restoring to Local Database (File: {filename}) ---")
+    _reject_physical(filename)
+    local_conf = config['local']
+    
+    backup_path = os.path.join(local_conf['backup_dir'], filename)
+    store = _get_store(config)
+    from_store = not os.path.exists(backup_path) and store is not None and store.has(filename)
+    if not os.path.exists(backup_path) and not from_store:
+        print(f"Error: Backup file not found at {backup_path}")
+        sys.exit(1)
+
+    # Prepare environment for psql
+    env = os.environ.copy()
+    if 'db_password' in local_conf and local_conf['db_password']:
+        env['PGPASSWORD'] = local_conf['db_password']
+    
+    # Base connection args
+    auth_args = [
+        '-U', local_conf['db_user'],
+        '-h', local_conf['host'],
+        '-p', str(local_conf.get('port', 5432)),
+        '-d', local_conf['db_name']
+    ]
+
     # Clean DB if requested
     if clean:
-        print("  [CLEAN] Dropping & Recreating 'public' schema to ensure a clean restore...")
-        # 1. Terminate connections
-        kill_cmd = (
-            f"{prefix}psql {_db_host_arg(staging_conf)}-U {staging_conf['db_user']} -d {staging_conf['db_name']} "
-            f"-c \"SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = '{staging_conf['db_name']}' AND pid <> pg_backend_pid();\""
-        )
-        # 2. Dùng superuser nếu có để DROP SCHEMA hoàn toàn (bypass ownership restrictions)
-        #    Nếu không có superuser, fallback về DROP OWNED BY current_user
-        su_user = staging_conf.get('db_superuser')
-        if su_user:
-            su_pass = staging_conf.get('db_superuser_password', '')
-            docker = staging_conf.get('docker_container')
-            if docker:
-                su_env_flag = f"-e PGPASSWORD='{su_pass}' " if su_pass else ""
-                su_prefix = f"docker exec {su_env_flag}{docker} "
+        print("  [CLEAN] Dropping & Recreating 'public' schema locally...")
+        try:
+            # 1. Terminate connections
+            kill_sql = f"SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = '{local_conf['db_name']}' AND pid <> pg_backend_pid();"
+            subprocess.run(['psql'] + auth_args + ['-c', kill_sql], env=env, check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            
+            # 2. Dùng superuser nếu có để DROP SCHEMA hoàn toàn (bypass ownership restrictions)
+            #    Nếu không có superuser, fallback về DROP OWNED BY current_user
+            su_user = local_conf.get('db_superuser')
+            if su_user:
+                su_pass = local_conf.get('db_superuser_password', '')
+                su_env = os.environ.copy()
+                if su_pass:
+                    su_env['PGPASSWORD'] = su_pass
+                su_auth = ['-U', su_user, '-h', local_conf['host'], '-p', str(local_conf.get('port', 5432)), '-d', local_conf['db_name']]
+                reset_sql = (
+                    f"DROP SCHEMA public CASCADE; CREATE SCHEMA public; "
+                    f"GRANT ALL ON SCHEMA public TO {local_conf['db_user']}; "
+                    f"GRANT ALL ON SCHEMA public TO public;"
+                )
+                # ON_ERROR_STOP=1: psql exit non-zero khi SQL error → CalledProcessError được raise
+                subprocess.run(['psql', '-v', 'ON_ERROR_STOP=1'] + su_auth + ['-c', reset_sql], env=su_env, check=True)
+            else:
+                # Fallback: DROP OWNED BY chỉ xóa objects owned bởi db_user
+                reset_sql = (
+                    f"DROP OWNED BY current_user CASCADE; "
+                    f"DROP SCHEMA IF EXISTS public CASCADE; CREATE SCHEMA public; "
+                    f"GRANT ALL ON SCHEMA public TO {local_conf['db_user']}; "
+                    f"GRANT ALL ON SCHEMA public TO public;"
+                )
+                subprocess.run(['psql', '-v', 'ON_ERROR_STOP=1'] + auth_args + ['-c', reset_sql], env=env, check=True)
+            print("  [CLEAN] Schema reset successful.")
+        except subprocess.CalledProcessError as e:
+            print(f"  [CLEAN] Warning: Failed to reset schema: {e}")
+            print("  Continuing with restore...")
+
+    print(f"Restoring {backup_path} to local db {local_conf['db_name']}...")
+
+    if fast:
+        pgoptions, jobs = _fast_restore_settings(local_conf, jobs)
+        env['PGOPTIONS'] = pgoptions
+        print(f"  [FAST] Session settings: {pgoptions}")
+    else:
+        _, jobs = _dump_settings(local_conf, jobs=jobs)
+
+    fmt = _dump_format_of(filename)
+    if fmt != 'plain':
+        METRICS.note(bytes_in=os.path.getsize(backup_path), format=fmt, fast=fast)
+        _restore_local_archive(backup_path, fmt, auth_args, env, jobs, fast=fast)
+        return
+    
+    try:
+        if from_store:
+            print(f"  [STORE] Streaming {filename} out of {store.path}")
+            codec = 'store'
+            packed = sum(os.path.getsize(store.chunk_path(d)) for d in store.chunk_digests(filename))
+        else:
+            # Nhận diện codec từ magic bytes, file .sql.gz cũ vẫn restore được như trước
+            with open(backup_path, 'rb') as f_head:
+                codec = _codec_from_magic(f_head.read(4))
+            packed = os.path.getsize(backup_path)
+
+        settings = _restore_pipe_settings(local_conf, pipe)
+        # native cần CLI giải nén (và awk cho --fast); store luôn đọc trong Python
+        decompressor = _local_decompressor(codec) if codec and not from_store else None
+        missing = []
+        if from_store:
+            missing.append('a flat backup file, not the chunk store')
+        elif codec and not decompressor:
+            missing.append(' or '.join(argv[0] for argv in LOCAL_DECOMPRESSORS[codec]))
+        if fast and not shutil.which('awk'):
+            missing.append('awk')
+        if settings['mode'] == 'native' and missing:
+            print(f"Error: restore_pipe mode 'native' needs {', '.join(missing)}. Use 'auto' or 'python'.")
+            sys.exit(1)
+        mode = 'python' if settings['mode'] == 'python' or missing else 'native'
+
+        METRICS.note(bytes_in=packed, format=fmt, codec=codec, fast=fast, pipe=mode)
+        # Fast profile: đọc lại dump 3 lần, mỗi lần chỉ đẩy các dòng của 1 pha vào psql
+        phases = list(enumerate(RESTORE_PHASES, 1)) if fast else [(0, None)]
+        psql_cmd = ['psql'] + auth_args
+        raw_bytes = 0
+        pipe_size = None
+        start = time.time()
+        for number, name in phases:
+            phase_start = time.time()
+            if mode == 'native':
+                pipe_size = _native_pipe_to_psql(backup_path, decompressor, psql_cmd, env, settings['pipe_buffer'], number)
             else:
-                su_prefix = f"PGPASSWORD='{su_pass}' " if su_pass else ""
-            reset_schema_cmd = (
-                f"{su_prefix}psql -v ON_ERROR_STOP=1 {_db_host_arg(staging_conf)}-U {su_user} -d {staging_conf['db_name']} "
-                f"-c \"DROP SCHEMA public CASCADE; CREATE SCHEMA public; "
-                f"GRANT ALL ON SCHEMA public TO {staging_conf['db_user']}; "
-                f"GRANT ALL ON SCHEMA public TO public;\""
+                source = store.open_raw(filename) if from_store else _open_decompressed(backup_path, codec)
+                with source as f_in:
+                    written, pipe_size = _python_pipe_to_psql(f_in, psql_cmd, env, settings, number)
+                raw_bytes += written
+            if name:
+                print(f"  [FAST] Phase {name} finished in {time.time() - phase_start:.1f}s")
+        elapsed = time.time() - start
+
+        if mode == 'native':
+            # Dữ liệu không qua Python nên không đếm được; lấy raw_size từ catalog nếu có
+            try:
+                raw_bytes = ((_get_catalog(config).get(filename) or {}).get('raw_size') or 0) if not fast else 0
+            except sqlite3.Error:
+                raw_bytes = 0
+            chain = ' | '.join(filter(None, [decompressor and decompressor[0], fast and 'awk', 'psql']))
+        else:
+            chain = f"{_format_size(settings['buffer'])} buffer"
+        pipes = f", {_format_size(pipe_size)} pipes" if pipe_size else ""
+        rates = f"{_format_rate(packed, elapsed)} compressed input"
+        if raw_bytes:
+            rates += f", {_format_rate(raw_bytes, elapsed)} SQL"
+        METRICS.note(bytes_out=raw_bytes or None, pipe_buffer=pipe_size)
+        print(f"  [PIPE] {mode} ({chain}{pipes}): {_format_size(packed)} in {elapsed:.1f}s")
+        print(f"Restore successful ({codec or 'uncompressed'}, {rates}).")
+
+    except Exception as e:
+        print(f"Restore failed: {e}")
+        sys.exit(1)
+
+
+# --- Quản trị database: CREATE / DROP / đổi tên DB trên server của 1 môi trường ---
+MAINTENANCE_DB_DEFAULT = 'postgres'
+SWAP_RETRIES = 10
+
+def _quote_ident(name):
+    return '"' + name.replace('"', '""') + '"'
+
+def _sql_literal(text):
+    return "'" + text.replace("'", "''") + "'"
+
+class DatabaseAdmin:
+    """Database-level statements on the server of one environment.
+
+    ``target`` is ``local``, ``staging`` or ``production``. Statements run on
+    ``maintenance_db`` (default ``postgres``) as ``db_superuser`` when
+    configured, otherwise as ``db_user`` (which then needs CREATEDB).
+    """
+
+    def __init__(self, config, target):
+        self.config = config
+        self.target = target
+        self.conf = config[target]
+        self.admin_user = self.conf.get('db_superuser') or self.conf['db_user']
+        self.conn = None if target == 'local' else get_connection(self.conf)
+
+    def sql(self, query, db=None):
+        """Run ``query`` and return psql's unaligned output; RuntimeError on failure."""
+        db = db or self.conf.get('maintenance_db') or MAINTENANCE_DB_DEFAULT
+        if self.conn is None:
+            env = os.environ.copy()
+            password = self.conf.get('db_superuser_password' if self.conf.get('db_superuser') else 'db_password')
+            if password:
+                env['PGPASSWORD'] = password
+            cmd = [
+                'psql', '-X', '-q', '-At', '-v', 'ON_ERROR_STOP=1', '-h', self.conf['host'],
+                '-p', str(self.conf.get('port', 5432)), '-U', self.admin_user, '-d', db, '-c', query,
+            ]
+            result = subprocess.run(cmd, env=env, capture_output=True, text=True)
+            if result.returncode != 0:
+                raise RuntimeError(result.stderr.strip())
+            return result.stdout
+        prefix = _superuser_prefix(self.conf) if self.conf.get('db_superuser') else _db_prefix(self.conf)
+        result = self.conn.run(
+            f"{prefix}psql -X -q -At -v ON_ERROR_STOP=1 {_db_host_arg(self.conf)}-U {self.admin_user} -d {shlex.quote(db)} "
+            f"-c {shlex.quote(query)}",
+            hide=True, warn=True,
+        )
+        if result.failed:
+            raise RuntimeError(result.stderr.strip())
+        return result.stdout
+
+    def exists(self, db_name):
+        return bool(self.sql(f"SELECT 1 FROM pg_database WHERE datname = {_sql_literal(db_name)}").strip())
+
+    def create(self, db_name, template=None):
+        """Empty database ``db_name`` (or a copy of ``template``) owned by ``db_user``."""
+        source = f" TEMPLATE {_quote_ident(template)}" if template else ""
+        self.sql(f"CREATE DATABASE {_quote_ident(db_name)}{source} OWNER {_quote_ident(self.conf['db_user'])}")
+
+    def drop(self, db_name, template=False, force=False):
+        """``DROP DATABASE IF EXISTS``; with ``force`` its sessions are terminated first, retried like ``swap``."""
+        if template:
+            # DB template không DROP được trực tiếp
+            self.sql(f"ALTER DATABASE {_quote_ident(db_name)} WITH IS_TEMPLATE false")
+        statement = f"DROP DATABASE IF EXISTS {_quote_ident(db_name)}"
+        if not force:
+            self.sql(statement)
+            return
+        for attempt in range(SWAP_RETRIES):
+            try:
+                self.sql(self._terminate_sql(db_name))
+                self.sql(statement)
+                return
+            except RuntimeError as e:
+                if 'being accessed by other users' not in str(e) or attempt == SWAP_RETRIES - 1:
+                    raise
+                time.sleep(0.5)
+
+    @staticmethod
+    def _terminate_sql(db_name):
+        return (
+            f"SELECT count(pg_terminate_backend(pid)) FROM pg_stat_activity "
+            f"WHERE datname = {_sql_literal(db_name)} AND pid <> pg_backend_pid()"
+        )
+
+    def restore(self, filename, db_name, jobs=None, fast=False):
+        """Restore ``filename`` into ``db_name`` with the usual restore step of the target."""
+        override = dict(self.config, **{self.target: dict(self.conf, db_name=db_name)})
+        if self.target == 'local':
+            restore_local(override, filename, jobs=jobs, fast=fast)
+        elif self.target == 'staging':
+            restore_staging(override, filename, jobs=jobs, fast=fast)
+        else:
+            restore_prod(override, filename, jobs=jobs, fast=fast)
+
+    def swap(self, fresh, db_name, old=None):
+        """Put database ``fresh`` in place of ``db_name``, which becomes ``old``.
+
+        Sessions of ``db_name`` are terminated, then both renames run in one
+        transaction (``db_name`` never disappears), retried while terminated
+        sessions are still exiting. With ``old`` None the target must not
+        exist yet. Returns the seconds ``db_name`` was unavailable.
+        """
+        statement = f"ALTER DATABASE {_quote_ident(fresh)} RENAME TO {_quote_ident(db_name)}"
+        if old:
+            # 2 lệnh trong 1 query = 1 transaction
+            statement = f"ALTER DATABASE {_quote_ident(db_name)} RENAME TO {_quote_ident(old)}; {statement}"
+        terminate = self._terminate_sql(db_name)
+        start = time.time()
+        for attempt in range(SWAP_RETRIES):
+            try:
+                if old:
+                    self.sql(terminate)
+                self.sql(statement)
+                return time.time() - start
+            except RuntimeError as e:
+                # Session bị kill chưa thoát hẳn, hoặc app kết nối lại ngay -> thử lại
+                if 'being accessed by other users' not in str(e) or attempt == SWAP_RETRIES - 1:
+                    raise
+                time.sleep(0.5)
+
+def _admin_failed(message, error):
+    print(f"{message}: {' '.join(str(error).split())}")
+    sys.exit(1)
+
+# --- Snapshot: DB template dựng sẵn từ 1 backup --------------------------------
+# Restore 1 lần vào DB template; mỗi lần refresh chỉ còn CREATE DATABASE ... TEMPLATE
+# rồi đổi tên, không phải chạy lại cả file SQL.
+SNAPSHOT_TARGETS = ('local', 'staging')
+# COMMENT ON DATABASE của snapshot = tiền tố này + JSON {"file": ..., "created": ...}
+SNAPSHOT_COMMENT = 'backuptool snapshot '
+SNAPSHOT_LIST_SQL = (
+    "SELECT coalesce(json_agg(json_build_object('name', datname, 'comment', shobj_description(oid, 'pg_database'), "
+    "'size', pg_database_size(oid)) ORDER BY datname), '[]') FROM pg_database "
+    f"WHERE shobj_description(oid, 'pg_database') LIKE '{SNAPSHOT_COMMENT}%'"
+)
+
+def snapshot_db_name(filename):
+    """Template database of backup ``filename`` (within the 63 chars PostgreSQL allows)."""
+    stem = re.sub(r'[^a-z0-9_]+', '_', filename.split('.', 1)[0].lower())
+    return f"snap_{stem[:50]}_{hashlib.sha1(filename.encode()).hexdigest()[:6]}"
+
+def _snapshots(admin):
+    """``[{'name', 'file', 'created', 'size'}]`` of the snapshots on ``admin``'s server."""
+    found = []
+    for row in json.loads(admin.sql(SNAPSHOT_LIST_SQL) or '[]'):
+        try:
+            meta = json.loads(row['comment'][len(SNAPSHOT_COMMENT):])
+        except ValueError:
+            continue
+        found.append({'name': row['name'], 'file': meta.get('file'), 'created': meta.get('created'), 'size': row['size']})
+    return found
+
+@METRICS.timed('snapshot_create')
+def snapshot_create(config, filename, target='local', jobs=None, fast=False):
+    """Restore ``filename`` once into a template database for ``snapshot_refresh``."""
+    print(f"--- [SNAPSHOT] Creating snapshot of {filename} on {target} ---")
+    admin = DatabaseAdmin(config, target)
+    name = snapshot_db_name(filename)
+    try:
+        if any(snap['name'] == name for snap in _snapshots(admin)):
+            print(f"  [SNAPSHOT] {name} already exists.")
+            return name
+        # DB cùng tên nhưng chưa có comment = lần tạo trước bị dừng giữa chừng
+        admin.drop(name)
+        admin.create(name)
+    except RuntimeError as e:
+        _admin_failed("Snapshot failed", e)
+
+    start = time.time()
+    try:
+        admin.restore(filename, name, jobs=jobs, fast=fast)
+    except BaseException:
+        print(f"  [SNAPSHOT] Restore failed, dropping the unfinished {name}.")
+        try:
+            admin.drop(name)
+        except RuntimeError as e:
+            print(f"  [SNAPSHOT] Warning: cannot drop {name}: {e}")
+        raise
+
+    comment = SNAPSHOT_COMMENT + json.dumps({'file': filename, 'created': datetime.datetime.now().isoformat(timespec='seconds')})
+    try:
+        # Không cho kết nối vào template: CREATE DATABASE ... TEMPLATE không bao giờ bị chặn
+        admin.sql(f"ALTER DATABASE {_quote_ident(name)} WITH IS_TEMPLATE true ALLOW_CONNECTIONS false")
+        admin.sql(f"COMMENT ON DATABASE {_quote_ident(name)} IS {_sql_literal(comment)}")
+        METRICS.note(snapshot=name)
+        print(f"  [SNAPSHOT] {name} ready in {time.time() - start:.1f}s.")
+
+        keep = int((admin.conf.get('snapshots') or {}).get('keep') or 0)
+        if keep:
+            snaps = sorted(_snapshots(admin), key=lambda s: s['created'] or '', reverse=True)
+            for snap in snaps[keep:]:
+                admin.drop(snap['name'], template=True)
+                print(f"  [SNAPSHOT] Dropped {snap['name']} ({snap['file']}), keep={keep}.")
+    except RuntimeError as e:
+        _admin_failed("Snapshot failed", e)
+    return name
+
+@METRICS.timed('snapshot_refresh')
+def snapshot_refresh(config, filename, target='local', jobs=None, fast=False):
+    """Replace the target database by a fresh copy of the snapshot of ``filename``.
+
+    The copy is made under a temporary name while the old database stays
+    usable, then swapped in (see ``DatabaseAdmin.swap``). A missing snapshot
+    is created first.
+    """
+    admin = DatabaseAdmin(config, target)
+    name = snapshot_db_name(filename)
+    db_name = admin.conf['db_name']
+    try:
+        if not any(snap['name'] == name for snap in _snapshots(admin)):
+            print(f"  [SNAPSHOT] No snapshot of {filename} on {target} yet: creating it (one full restore).")
+            snapshot_create(config, filename, target, jobs=jobs, fast=fast)
+    except RuntimeError as e:
+        _admin_failed("Refresh failed", e)
+
+    print(f"--- [SNAPSHOT] Refreshing {target} database {db_name} from {filename} ---")
+    fresh = f"{db_name[:50]}__snap_new"
+    old = f"{db_name[:50]}__snap_old"
+    start = time.time()
+    try:
+        admin.drop(fresh)
+        admin.drop(old)
+        admin.create(fresh, template=name)
+        cloned = time.time()
+        replace = admin.exists(db_name)
+        try:
+            downtime = admin.swap(fresh, db_name, old if replace else None)
+        except RuntimeError:
+            admin.drop(fresh)
+            raise
+    except RuntimeError as e:
+        _admin_failed("Refresh failed, the database was left as it was", e)
+    if replace:
+        # Swap đã xong: session cũ bị kill có thể chưa thoát hẳn -> drop có retry, lỗi chỉ cảnh báo
+        try:
+            admin.drop(old, force=True)
+        except RuntimeError as e:
+            print(f"  [SNAPSHOT] Warning: could not drop the previous database {old} ({' '.join(str(e).split())}); "
+                  f"it is dropped by the next refresh.")
+    METRICS.note(snapshot=name, downtime_s=round(downtime, 3))
+    print(
+        f"  [SNAPSHOT] {db_name} refreshed in {time.time() - start:.1f}s "
+        f"(copy {cloned - start:.1f}s, swap {downtime:.1f}s)."
+    )
+
+def snapshot_drop(config, filename, target='local'):
+    admin = DatabaseAdmin(config, target)
+    name = snapshot_db_name(filename)
+    try:
+        if not any(snap['name'] == name for snap in _snapshots(admin)):
+            print(f"Error: No snapshot of {filename} on {target}.")
+            sys.exit(1)
+        admin.drop(name, template=True)
+    except RuntimeError as e:
+        _admin_failed("Drop failed", e)
+    print(f"  [SNAPSHOT] Dropped {name} ({filename}).")
+
+def snapshot_list(config, target='local'):
+    try:
+        snaps = sorted(_snapshots(DatabaseAdmin(config, target)), key=lambda s: s['created'] or '', reverse=True)
+    except RuntimeError as e:
+        _admin_failed("Cannot list snapshots", e)
+    print(f"--- [SNAPSHOT] {len(snaps)} snapshot(s) on {target} ---")
+    for snap in snaps:
+        print(f"  {snap['created'] or '?':<19}  {snap['file']:<50} {_format_size(snap['size']):>10}  {snap['name']}")
+    return snaps
+
+def _latest_snapshot_file(config, target):
+    """Backup of the newest snapshot on ``target``, or None."""
+    try:
+        snaps = _snapshots(DatabaseAdmin(config, target))
+    except RuntimeError as e:
+        _admin_failed("Cannot list snapshots", e)
+    snaps.sort(key=lambda s: s['created'] or '', reverse=True)
+    return snaps[0]['file'] if snaps else None
+
+# --- Shadow restore: nạp vào DB phụ trong khi DB chính vẫn phục vụ, rồi đổi tên ---
+SHADOW_SUFFIX = '__shadow'
+PREVIOUS_SUFFIX = '__previous'
+USER_TABLES_SQL = "SELECT count(*) FROM pg_tables WHERE schemaname NOT IN ('pg_catalog', 'information_schema')"
+
+def _shadow_names(db_name):
+    """``(shadow, previous)`` database names next to ``db_name``."""
+    return f"{db_name[:50]}{SHADOW_SUFFIX}", f"{db_name[:50]}{PREVIOUS_SUFFIX}"
+
+def _shadow_sanity_check(admin, shadow, db_name, checks):
+    """Problems found in the freshly loaded ``shadow`` database (empty = OK).
+
+    It must contain tables, and every query of ``shadow.checks`` must return
+    true there. Fewer tables than the live database is only reported.
+    """
+    problems = []
+    tables = int(admin.sql(USER_TABLES_SQL, db=shadow).strip() or 0)
+    live_tables = int(admin.sql(USER_TABLES_SQL, db=db_name).strip() or 0) if admin.exists(db_name) else None
+    print(f"  [SHADOW] {tables} table(s) loaded" + (f", the live database has {live_tables}" if live_tables is not None else ""))
+    if not tables:
+        problems.append("no table was restored")
+    elif live_tables and tables < live_tables:
+        print(f"  [SHADOW] Warning: {live_tables - tables} table(s) fewer than the live database.")
+    for check in checks:
+        try:
+            result = admin.sql(check, db=shadow).strip()
+        except RuntimeError as e:
+            problems.append(f"{check}: {' '.join(str(e).split())}")
+            continue
+        if result.splitlines()[:1] != ['t']:
+            problems.append(f"{check} returned {result or 'nothing'}")
+    return problems
+
+@METRICS.timed('restore_shadow')
+def restore_shadow(config, target, filename, jobs=None, fast=False):
+    """Restore ``filename`` into ``<db>__shadow`` while ``<db>`` keeps serving.
+
+    After the load and the sanity check the shadow is swapped in by renaming
+    (see ``DatabaseAdmin.swap``), so the database is only unavailable for
+    the swap. The replaced database is kept as ``<db>__previous`` for
+    ``--rollback`` unless ``shadow.keep_previous`` is false.
+    """
+    admin = DatabaseAdmin(config, target)
+    db_name = admin.conf['db_name']
+    settings = admin.conf.get('shadow') or {}
+    shadow, previous = _shadow_names(db_name)
+    print(f"--- [SHADOW] Loading {filename} into {shadow} on {target}; {db_name} stays online ---")
+    try:
+        admin.drop(shadow)
+        admin.create(shadow)
+    except RuntimeError as e:
+        _admin_failed("Shadow restore failed", e)
+
+    start = time.time()
+    try:
+        admin.restore(filename, shadow, jobs=jobs, fast=fast)
+    except BaseException:
+        print(f"  [SHADOW] Restore failed, dropping {shadow}. {db_name} was not touched.")
+        try:
+            admin.drop(shadow)
+        except RuntimeError as e:
+            print(f"  [SHADOW] Warning: cannot drop {shadow}: {e}")
+        raise
+    loaded = time.time() - start
+
+    try:
+        problems = _shadow_sanity_check(admin, shadow, db_name, settings.get('checks') or [])
+        if problems:
+            print("Shadow restore aborted, the sanity check failed:")
+            for problem in problems:
+                print(f"  - {problem}")
+            admin.drop(shadow)
+            print(f"  {shadow} dropped, {db_name} was not touched.")
+            sys.exit(1)
+        admin.drop(previous)
+        replace = admin.exists(db_name)
+        downtime = admin.swap(shadow, db_name, previous if replace else None)
+        keep_previous = replace and settings.get('keep_previous', True)
+        if replace and not keep_previous:
+            admin.drop(previous)
+    except RuntimeError as e:
+        _admin_failed(f"Shadow restore failed, {db_name} was left as it was", e)
+
+    METRICS.note(downtime_s=round(downtime, 3))
+    print(f"  [SHADOW] {db_name} swapped in {downtime:.1f}s after a {loaded:.1f}s load in the background.")
+    if keep_previous:
+        print(f"  [SHADOW] The replaced database is kept as {previous}; undo with --rollback.")
+
+@METRICS.timed('restore_rollback')
+def restore_rollback(config, target):
+    """Swap ``<db>__previous`` back in; the replaced database becomes ``<db>__previous``."""
+    admin = DatabaseAdmin(config, target)
+    db_name = admin.conf['db_name']
+    _, previous = _shadow_names(db_name)
+    swapped = f"{db_name[:50]}__rollback"
+    print(f"--- [SHADOW] Rolling {db_name} on {target} back to {previous} ---")
+    try:
+        if not admin.exists(previous):
+            print(f"Error: There is no {previous} to roll back to.")
+            sys.exit(1)
+        admin.drop(swapped)
+        downtime = admin.swap(previous, db_name, swapped)
+        # Đổi tên bản vừa thay ra thành __previous: chạy --rollback lần nữa là quay lại
+        admin.sql(f"ALTER DATABASE {_quote_ident(swapped)} RENAME TO {_quote_ident(previous)}")
+    except RuntimeError as e:
+        _admin_failed("Rollback failed", e)
+    METRICS.note(downtime_s=round(downtime, 3))
+    print(f"  [SHADOW] Rolled back in {downtime:.1f}s; the replaced database is now {previous}.")
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+# --clean của --stream chỉ chạy khi Production đã gửi chừng này byte nén (hoặc dump xong thành công):
+# pg_dump lỗi ngay từ đầu (sai mật khẩu, sai container) chỉ để lại vài byte header của gzip/zstd
+STREAM_CLEAN_AFTER = 64 * 1024
+
+def _drain_stderr(channel, buf):
+    """Read whatever is pending on a channel's stderr so it never blocks the remote side."""
+    while channel.recv_stderr_ready():
+        buf.append(channel.recv_stderr(STREAM_CHUNK_SIZE))
+
+@METRICS.timed('stream_prod_to_staging')
+def stream_prod_to_staging(config, filename, clean=False, tee=False, subset=None):
+    """Pipe ``pg_dump`` on Production straight into ``psql`` on Staging.
+
+    No intermediate file is written on either server: the compressed dump is
+    read from the Production SSH channel and written to the Staging SSH
+    channel chunk by chunk, so dumping, transferring and restoring overlap.
+    With ``tee`` the same bytes are also saved to ``local.backup_dir``.
+
+    ``clean`` resets Staging only once the dump is really flowing (or has
+    finished successfully), so a dump failing at once leaves it untouched.
+    """
+    print(f"--- [STREAM] Production -> Staging (File: {filename}) ---")
+    prod_conf = config['production']
+    staging_conf = config['staging']
+    local_conf = config['local']
+
+    prod_conn = get_connection(prod_conf)
+    staging_conn = get_connection(staging_conf)
+
+    comp = _compression_settings(prod_conf)
+    subset = _subset_enabled(prod_conf, subset)
+    script_path = f"/tmp/{filename}.subset.sql"
+    if subset:
+        source = _prepare_subset(prod_conn, prod_conf, script_path)
+    else:
+        source = f"{_dump_tool_prefix(prod_conf)}pg_dump {_db_host_arg(prod_conf)}-U {prod_conf['db_user']} {prod_conf['db_name']}"
+    dump_cmd = _niced(prod_conf, _remote_pipeline(f"{source} | {_compressor_command(comp)}"))
+    restore_cmd = _remote_pipeline(
+        f"{_decompressor_command(comp['codec'])} | "
+        f"{_db_prefix(staging_conf, interactive=True)}psql {_db_host_arg(staging_conf)}-U {staging_conf['db_user']} -d {staging_conf['db_name']}"
+    )
+
+    tee_path = None
+    tee_file = None
+    tee_digest = hashlib.sha256()
+    src = dst = None
+    src_err, dst_err = [], []
+    transferred = 0
+    failed = None
+    start = time.time()
+    limiter, controller = _start_throttle(prod_conn, prod_conf, lambda: transferred / max(time.time() - start, 1e-6))
+    try:
+        # Mở channel "thô" trên transport để đọc/ghi từng chunk thay vì conn.run()
+        src = _transport(prod_conn).open_session()
+        src.exec_command(dump_cmd)
+        # Giữ phần đầu của dump cho đến khi chắc pg_dump chạy được, rồi mới đụng vào Staging
+        head = []
+        head_size = 0
+        while head_size < STREAM_CLEAN_AFTER:
+            data = src.recv(STREAM_CHUNK_SIZE)
+            if not data:
+                break
+            head.append(data)
+            head_size += len(data)
+            _drain_stderr(src, src_err)
+        if head_size < STREAM_CLEAN_AFTER:
+            src_status = src.recv_exit_status()
+            if src_status != 0:
+                raise IOError(f"pg_dump on production exited with code {src_status}; staging was not touched")
+
+        if clean:
+            _clean_remote_db(staging_conn, staging_conf)
+
+        if tee:
+            if not os.path.exists(local_conf['backup_dir']):
+                os.makedirs(local_conf['backup_dir'])
+            tee_path = os.path.join(local_conf['backup_dir'], filename)
+            tee_file = open(tee_path, 'wb')
+
+        dst = _transport(staging_conn).open_session()
+        dst.exec_command(restore_cmd)
+
+        print("Streaming dump into staging psql...")
+        last_report = start
+        while True:
+            data = head.pop(0) if head else src.recv(STREAM_CHUNK_SIZE)
+            if not data:
+                break
+            if dst.exit_status_ready():
+                failed = "staging restore exited before the dump finished"
+                break
+            if limiter is not None:
+                limiter.acquire(len(data))
+            dst.sendall(data)
+            if tee_file:
+                tee_file.write(data)
+                tee_digest.update(data)
+            transferred += len(data)
+
+            _drain_stderr(src, src_err)
+            _drain_stderr(dst, dst_err)
+            now = time.time()
+            if now - last_report >= 1:
+                sys.stdout.write(f"\rStreamed: {_format_size(transferred)} ({_format_rate(transferred, now - start)})")
+                sys.stdout.flush()
+                last_report = now
+
+        if failed is None:
+            dst.shutdown_write()  # EOF cho decompressor | psql
+            src_status = src.recv_exit_status()
+            if src_status != 0:
+                failed = f"pg_dump on production exited with code {src_status}"
+        if failed is None:
+            dst_status = dst.recv_exit_status()
+            if dst_status != 0:
+                failed = f"restore on staging exited with code {dst_status}"
+    except Exception as e:
+        failed = str(e)
+    finally:
+        for channel, buf in ((src, src_err), (dst, dst_err)):
+            if channel is not None:
+                _drain_stderr(channel, buf)
+                channel.close()
+        if tee_file:
+            tee_file.close()
+        if subset:
+            prod_conn.run(f"rm -f {script_path}", hide=True, warn=True)
+        release_connection(prod_conn)
+        release_connection(staging_conn)
+
+    elapsed = time.time() - start
+    _finish_throttle(limiter, controller, transferred, elapsed)
+    METRICS.note(bytes_in=transferred, bytes_out=transferred, codec=comp['codec'])
+    print(f"\rStreamed: {_format_size(transferred)} ({comp['codec']}) in {elapsed:.1f}s ({_format_rate(transferred, elapsed)})")
+    if failed:
+        print(f"Stream failed: {failed}")
+        for label, buf in (("production", src_err), ("staging", dst_err)):
+            err = b"".join(buf).decode(errors='replace').strip()
+            if err:
+                print(f"  [{label} stderr] {err}")
+        if tee_path and os.path.exists(tee_path):
+            # Bản tee không đầy đủ thì xóa đi, tránh bị nhầm là backup hợp lệ
+            os.remove(tee_path)
+        sys.exit(1)
+
+    print("Stream restore successful.")
+    if tee_path:
+        _write_local_checksum(tee_path, tee_digest.hexdigest())
+        print(f"Local copy saved to {tee_path}")
+        _catalog_add(
+            config, filename, 'local', tee_path, os.path.getsize(tee_path), source='production',
+            db_name=prod_conf['db_name'], format='plain', codec=comp['codec'], checksum=tee_digest.hexdigest(),
+        )
+
+
+# --- Backup vật lý: pg_basebackup -Ft qua SSH -> data directory local ----------
+CLUSTER_SIZE_SQL = "SELECT sum(pg_database_size(datname)) FROM pg_database"
+# pg_basebackup -D - chỉ ghi được 1 tar: cluster có tablespace riêng thì không dùng được
+EXTRA_TABLESPACES_SQL = "SELECT spcname FROM pg_tablespace WHERE spcname NOT IN ('pg_default', 'pg_global') ORDER BY 1"
+PHYSICAL_DEFAULTS = {'checkpoint': 'fast', 'max_rate': None}
+
+def _physical_filename(config):
+    """``<prefix>_physical_<timestamp>.base.tar<codec suffix>`` for a new physical backup.
+
+    Its own prefix keeps "latest backup" lookups of the logical dumps apart.
+    """
+    prefix = base_prefix(config['local'].get('backup_filename', 'backup.sql.gz'))
+    codec = _compression_settings(config['production'])['codec']
+    return get_timestamped_filename(f"{prefix}_physical{PHYSICAL_SUFFIX}") + COMPRESSION_CODECS[codec]['suffix']
+
+def _basebackup_command(prod_conf):
+    """``pg_basebackup`` writing one tar (data + the WAL needed to start it) to stdout, compressed."""
+    phys = dict(PHYSICAL_DEFAULTS)
+    phys.update(prod_conf.get('physical') or {})
+    # Có thể dùng user riêng có quyền REPLICATION
+    conf = dict(prod_conf, db_password=phys.get('db_password', prod_conf.get('db_password')))
+    user = phys.get('db_user') or prod_conf['db_user']
+    max_rate = f" -r {phys['max_rate']}" if phys.get('max_rate') else ""
+    # -D - chỉ cho -X fetch: WAL được lấy vào tar sau khi copy xong data
+    return _niced(prod_conf, _remote_pipeline(
+        f"{_dump_tool_prefix(conf)}pg_basebackup {_db_host_arg(conf)}-U {user} -D - -Ft -X fetch "
+        f"-c {phys['checkpoint']}{max_rate} -l backuptool | {_compressor_command(_compression_settings(prod_conf))}"
+    ))
+
+@METRICS.timed('backup_physical')
+def backup_physical(config, filename):
+    """Stream ``pg_basebackup`` from Production straight into ``local.backup_dir``.
+
+    Nothing is written on Production: the compressed tar is read from the SSH
+    channel, hashed and written to ``<file>.part``, renamed when complete.
+    """
+    print(f"--- [PHYSICAL] Streaming pg_basebackup from Production (File: {filename}) ---")
+    prod_conf = config['production']
+    local_conf = config['local']
+    conn = get_connection(prod_conf)
+    comp = _compression_settings(prod_conf)
+    os.makedirs(local_conf['backup_dir'], exist_ok=True)
+    local_path = os.path.join(local_conf['backup_dir'], filename)
+    part_path = local_path + '.part'
+
+    try:
+        need, cluster_size = _estimate_dump_size(config, conn, prod_conf, filename, 'physical', CLUSTER_SIZE_SQL)
+    except UnexpectedExit as e:
+        print(f"Error: Cannot read the cluster size on Production: {e.result.stderr.strip()}")
+        sys.exit(1)
+    try:
+        tablespaces = _psql_query(conn, prod_conf, EXTRA_TABLESPACES_SQL)
+    except UnexpectedExit as e:
+        print(f"Error: Cannot list the tablespaces on Production: {e.result.stderr.strip()}")
+        sys.exit(1)
+    if tablespaces:
+        print(f"Error: Production has tablespaces outside the data directory ({', '.join(tablespaces)}). "
+              f"pg_basebackup can stream only a single tar to stdout; back them up with pg_basebackup -Ft -D <dir> on the server instead.")
+        sys.exit(1)
+    _ensure_space(config, 'local', need)
+    print(f"  [PHYSICAL] Cluster size {_format_size(cluster_size)}, {comp['codec']} on Production")
+
+    digest = hashlib.sha256()
+    errors = []
+    transferred = 0
+    failed = None
+    channel = None
+    start = time.time()
+    limiter, controller = _start_throttle(conn, prod_conf, lambda: transferred / max(time.time() - start, 1e-6))
+    try:
+        channel = _transport(conn).open_session()
+        channel.exec_command(_basebackup_command(prod_conf))
+        last_report = start
+        with open(part_path, 'wb') as f_out:
+            while True:
+                data = channel.recv(STREAM_CHUNK_SIZE)
+                if not data:
+                    break
+                if limiter is not None:
+                    limiter.acquire(len(data))
+                f_out.write(data)
+                digest.update(data)
+                transferred += len(data)
+                _drain_stderr(channel, errors)
+                now = time.time()
+                if now - last_report >= 1:
+                    sys.stdout.write(f"\rStreamed: {_format_size(transferred)} ({_format_rate(transferred, now - start)})")
+                    sys.stdout.flush()
+                    last_report = now
+        status = channel.recv_exit_status()
+        if status != 0:
+            failed = f"pg_basebackup on production exited with code {status}"
+    except (OSError, paramiko.SSHException) as e:
+        failed = str(e)
+    finally:
+        if channel is not None:
+            _drain_stderr(channel, errors)
+            channel.close()
+        release_connection(conn)
+
+    elapsed = time.time() - start
+    _finish_throttle(limiter, controller, transferred, elapsed)
+    METRICS.note(bytes_in=cluster_size, bytes_out=transferred, codec=comp['codec'], format='physical')
+    if failed:
+        print(f"\nPhysical backup failed: {failed}")
+        err = b"".join(errors).decode(errors='replace').strip()
+        if err:
+            print(f"  [production stderr] {err}")
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        sys.exit(1)
+
+    os.replace(part_path, local_path)
+    _write_local_checksum(local_path, digest.hexdigest())
+    print(
+        f"\rStreamed: {_format_size(transferred)} in {elapsed:.1f}s "
+        f"({_format_rate(transferred, elapsed)} over SSH, {_format_rate(cluster_size, elapsed)} of cluster data)"
+    )
+    print(f"Physical backup saved to {local_path}")
+    _catalog_add(
+        config, filename, 'local', local_path, transferred, source='production', db_name=prod_conf['db_name'],
+        format='physical', codec=comp['codec'], db_size=cluster_size, checksum=digest.hexdigest(),
+    )
+
+class _CountingReader(io.RawIOBase):
+    """Read-only stream counting the bytes read through it."""
+
+    def __init__(self, source):
+        self.source = source
+        self.count = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.source.read(len(buffer))
+        buffer[:len(data)] = data
+        self.count += len(data)
+        return len(data)
+
+def _local_pg_version(bin_dir=None):
+    """Major version of the local ``pg_ctl`` (``'16'``), or None when it is not installed."""
+    pg_ctl = os.path.join(bin_dir, 'pg_ctl') if bin_dir else 'pg_ctl'
+    try:
+        result = subprocess.run([pg_ctl, '--version'], capture_output=True, text=True)
+    except OSError:
+        return None
+    match = re.search(r'(\d+)(?:\.\d+)?', result.stdout)
+    return match.group(1) if match else None
+
+@METRICS.timed('restore_physical')
+def restore_physical(config, filename, clean=False, start=False):
+    """Unpack a physical backup into ``local.physical.data_dir``; optionally start it.
+
+    The tar carries the WAL needed for consistency, so the server recovers on
+    first start without any archive. The local PostgreSQL must have the same
+    major version as Production.
+    """
+    print(f"--- [PHYSICAL] Restoring physical backup into a local data directory (File: {filename}) ---")
+    local_conf = config['local']
+    phys = local_conf.get('physical') or {}
+    data_dir = phys.get('data_dir')
+    if not data_dir:
+        print("Error: local.physical.data_dir is not configured.")
+        sys.exit(1)
+    backup_path = os.path.join(local_conf['backup_dir'], filename)
+    if not os.path.exists(backup_path):
+        print(f"Error: Backup file not found at {backup_path}")
+        sys.exit(1)
+
+    expected = _read_local_checksum(backup_path)
+    if expected and _sha256_file(backup_path) != expected:
+        print("Restore aborted: the backup is corrupted (checksum mismatch), the data directory was not touched.")
+        sys.exit(1)
+
+    if os.path.isdir(data_dir) and os.listdir(data_dir):
+        if os.path.exists(os.path.join(data_dir, 'postmaster.pid')):
+            print(f"Error: A server seems to be running on {data_dir} (postmaster.pid). Stop it first.")
+            sys.exit(1)
+        if not clean:
+            print(f"Error: {data_dir} is not empty. Use --clean to replace it.")
+            sys.exit(1)
+        print(f"  [CLEAN] Removing the old data directory {data_dir}")
+        shutil.rmtree(data_dir)
+    os.makedirs(data_dir, exist_ok=True)
+    # PostgreSQL từ chối data directory có quyền rộng hơn 0700/0750
+    os.chmod(data_dir, 0o700)
+
+    with open(backup_path, 'rb') as f_head:
+        codec = _codec_from_magic(f_head.read(4))
+    packed = os.path.getsize(backup_path)
+    began = time.time()
+    try:
+        with _open_decompressed(backup_path, codec) as source:
+            counter = _CountingReader(source)
+            reader = io.BufferedReader(counter, STREAM_CHUNK_SIZE)
+            with tarfile.open(fileobj=reader, mode='r|') as tar:
+                _extract_tar(tar, data_dir)
+            # Đọc nốt phần đệm sau cuối tar để CLI giải nén chạy hết và exit code được kiểm tra
+            while reader.read(STREAM_CHUNK_SIZE):
+                pass
+    except (OSError, EOFError, tarfile.TarError) as e:
+        # Data directory giải nén dở không khởi động được -> xóa đi
+        shutil.rmtree(data_dir, ignore_errors=True)
+        print(f"Restore failed: {e}; the incomplete data directory {data_dir} was removed.")
+        sys.exit(1)
+    elapsed = time.time() - began
+    METRICS.note(bytes_in=packed, bytes_out=counter.count, codec=codec, format='physical')
+    print(
+        f"  [PHYSICAL] {_format_size(counter.count)} unpacked in {elapsed:.1f}s "
+        f"({_format_rate(packed, elapsed)} compressed, {_format_rate(counter.count, elapsed)} data)"
+    )
+
+    with open(os.path.join(data_dir, 'PG_VERSION')) as f:
+        version = f.read().strip()
+    local_version = _local_pg_version(phys.get('bin_dir'))
+    if local_version and local_version != version:
+        print(f"  [PHYSICAL] Warning: the backup is PostgreSQL {version}, local pg_ctl is {local_version}. "
+              f"Use a logical dump (restore_local) across major versions.")
+    port = phys.get('port', local_conf.get('port'))
+    if port:
+        # Ghi đè port của Production trong postgresql.auto.conf (dòng sau thắng)
+        with open(os.path.join(data_dir, 'postgresql.auto.conf'), 'a') as f:
+            f.write(f"\n# backuptool restore_physical\nport = {int(port)}\n")
+    print(f"Restore successful: PostgreSQL {version} data directory at {data_dir}")
+
+    if start or phys.get('start'):
+        pg_ctl = os.path.join(phys['bin_dir'], 'pg_ctl') if phys.get('bin_dir') else 'pg_ctl'
+        log_path = os.path.join(data_dir, 'startup.log')
+        result = subprocess.run([pg_ctl, '-D', data_dir, '-l', log_path, '-w', 'start'])
+        if result.returncode != 0:
+            print(f"Error: pg_ctl start failed (exit code {result.returncode}), see {log_path}")
+            sys.exit(1)
+        print(f"  [PHYSICAL] Server started on port {port or 'from the backup'} (log: {log_path})")
+    else:
+        print(f"  Start it with: pg_ctl -D {data_dir} -l {os.path.join(data_dir, 'startup.log')} start")
+
+def _psql_query(conn, conf, sql, snapshot=None):
+    """Run a query on the remote database and return the output rows (``psql -At``).
+
+    With ``snapshot`` (an id from ``pg_export_snapshot``) the query sees that snapshot.
+    """
+    commands = [sql]
+    if snapshot:
+        commands = [
+            "BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY",
+            f"SET TRANSACTION SNAPSHOT {_sql_literal(snapshot)}",
+            sql,
+            "COMMIT",
+        ]
+    cmd = (
+        f"{_db_prefix(conf)}psql {_db_host_arg(conf)}-U {conf['db_user']} -d {conf['db_name']} "
+        f"-X -q -v ON_ERROR_STOP=1 -At " + " ".join(f"-c {shlex.quote(c)}" for c in commands)
+    )
+    result = conn.run(cmd, hide=True)
+    return [line for line in result.stdout.splitlines() if line.strip()]
+
+# Mỗi bảng: số tuple insert/update/delete tích lũy + relfilenode (đổi khi TRUNCATE/
+# VACUUM FULL/CLUSTER) + kích thước -> "chữ ký" thay đổi của bảng
+TABLE_SIGNATURE_SQL = (
+    "SELECT quote_ident(s.schemaname) || '.' || quote_ident(s.relname) || chr(9) || "
+    "s.n_tup_ins || ':' || s.n_tup_upd || ':' || s.n_tup_del || ':' || c.relfilenode || ':' || "
+    "pg_relation_size(c.oid) || chr(9) || pg_total_relation_size(c.oid) || chr(9) || "
+    "s.schemaname || chr(9) || s.relname "
+    "FROM pg_stat_user_tables s JOIN pg_class c ON c.oid = s.relid ORDER BY 1"
+)
+# Tách output của script dữ liệu thành 1 file nén cho mỗi bảng: mỗi bảng kết thúc bằng
+# dòng "\." (không thể là dữ liệu vì COPY text luôn escape dấu "\")
+INCREMENTAL_SPLIT_AWK = (
+    'BEGIN { n = 0; out = cmd " > " dir "/data_" n } '
+    '{ print | out } '
+    '$0 == "\\\\." { if (close(out)) exit 1; n++; out = cmd " > " dir "/data_" n }'
+)
+SEQUENCE_SETVAL_SQL = (
+    "SELECT format('SELECT pg_catalog.setval(%L, %s, %s);', "
+    "quote_ident(schemaname) || '.' || quote_ident(sequencename), "
+    "coalesce(last_value, start_value), (last_value IS NOT NULL)::text) FROM pg_sequences"
+)
+
+SNAPSHOT_EXPORT_TIMEOUT = 60
+SNAPSHOT_NOTICE_RE = re.compile(r'snapshot ([0-9A-F]+(?:-[0-9A-F]+)+)')
+
+class _ExportedSnapshot:
+    """Open transaction on the server whose snapshot other sessions import.
+
+    A psql session on its own exec channel runs ``pg_export_snapshot()`` and
+    stays idle in its REPEATABLE READ transaction until ``close``; ``pg_dump
+    --snapshot`` and ``SET TRANSACTION SNAPSHOT`` then all see the same data.
+    ``id`` stays None when the server (or a pooler in front of it) refuses.
+    """
+
+    def __init__(self, conn, conf):
+        self.id = None
+        self.error = ''
+        psql = (
+            f"{_db_prefix(conf, interactive=True)}psql {_db_host_arg(conf)}-U {conf['db_user']} "
+            f"-d {conf['db_name']} -X -q -At -v ON_ERROR_STOP=1"
+        )
+        self.channel = _transport(conn).open_session()
+        self.channel.settimeout(SNAPSHOT_EXPORT_TIMEOUT)
+        # stdout của psql qua pipe bị buffer tới khi thoát -> id đi ra stderr bằng NOTICE (không buffer)
+        messages = b''
+        try:
+            self.channel.exec_command(psql)
+            self.channel.sendall(
+                b"SET client_min_messages = notice;\n"
+                b"BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY;\n"
+                b"DO $$ BEGIN RAISE NOTICE 'snapshot %', pg_export_snapshot(); END $$;\n"
+            )
+            while not SNAPSHOT_NOTICE_RE.search(messages.decode(errors='replace')):
+                data = self.channel.recv_stderr(4096)
+                if not data:
+                    break
+                messages += data
+        except (OSError, paramiko.SSHException) as e:
+            self.error = str(e) or type(e).__name__
+        match = SNAPSHOT_NOTICE_RE.search(messages.decode(errors='replace'))
+        if match:
+            self.id = match.group(1)
+        elif not self.error:
+            self.error = ' '.join(messages.decode(errors='replace').split()) or 'no snapshot id'
+
+    def close(self):
+        try:
+            if self.id:
+                self.channel.sendall(b"COMMIT;\n")
+            self.channel.shutdown_write()
+        except (OSError, paramiko.SSHException):
+            pass
+        self.channel.close()
+
+def _table_signatures(conn, conf, snapshot=None):
+    """``({table: {'sig', 'size'}}, {table: (schema, relname)})`` from ``TABLE_SIGNATURE_SQL``."""
+    current = {}
+    names = {}
+    for row in _psql_query(conn, conf, TABLE_SIGNATURE_SQL, snapshot):
+        table, signature, size, schema, relname = row.split('\t')
+        current[table] = {'sig': signature, 'size': int(size)}
+        names[table] = (schema, relname)
+    return current, names
+
+def _incremental_dir(config, conf):
+    return os.path.join(config['local']['backup_dir'], 'incremental', conf['db_name'])
+
+def _segment_name(table, stamp, suffix):
+    """File name of a table's data segment, safe on every filesystem.
+
+    ``quote_ident`` names may hold quotes and other characters Windows does
+    not allow; they are replaced and a short hash keeps names unique. The
+    real table name stays in the state file.
+    """
+    safe = re.sub(r'[^A-Za-z0-9_.-]', '_', table)
+    return f"{safe}-{hashlib.sha1(table.encode()).hexdigest()[:8]}.{stamp}{suffix}"
+
+def _incremental_data_script(tables, names, snapshot=None):
+    """psql script printing the data of ``tables`` from one snapshot.
+
+    All tables are read in one REPEATABLE READ transaction (importing
+    ``snapshot`` when given), so rows of related tables match and the
+    foreign keys of post-data restore cleanly. Each table is a
+    pg_dump-style ``COPY ... FROM stdin`` block.
+    """
+    lines = [
+        "SET client_min_messages = warning;",
+        "BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY;",
+    ]
+    if snapshot:
+        lines.append(f"SET TRANSACTION SNAPSHOT {_sql_literal(snapshot)};")
+    for table in tables:
+        schema, relname = names[table]
+        lines.append("\\echo " + _psql_literal(f"-- Data for Name: {relname}; Type: TABLE DATA; Schema: {schema}; Owner: -"))
+        lines.append("\\echo " + _psql_literal(f"COPY {table} FROM stdin;"))
+        lines.append(f"COPY {table} TO STDOUT;")
+        lines.append("\\echo " + _psql_literal("\\."))
+    lines.append("COMMIT;")
+    return "\n".join(lines) + "\n"
+
+def _load_incremental_state(state_path):
+    if not os.path.exists(state_path):
+        return {'tables': {}}
+    with open(state_path, 'r') as f:
+        return json.load(f)
+
+@METRICS.timed('backup_incremental')
+def backup_incremental(config, filename):
+    """Table-level incremental backup of Production into ``local.backup_dir``.
+
+    Change counters of every table (``pg_stat_user_tables`` + ``pg_class``) are
+    compared with the previous run; only tables whose counters moved are
+    dumped on the server. Their compressed data segments are downloaded and
+    kept under ``<backup_dir>/incremental/<db>/``. Unchanged tables reuse the
+    previous segment. The schema (pre/post-data) and sequence values are
+    dumped every time, then everything is concatenated into ``filename`` -
+    a regular restorable dump for ``restore_local`` / ``upload`` + ``restore``.
+
+    Schema and data come from one exported snapshot. Counters are read
+    before and after it is taken; a table whose counters moved in between is
+    dumped too, because its saved segment may miss rows the snapshot has.
+    Without an exported snapshot every table is dumped.
+    """
+    print(f"--- [INCREMENTAL] Backing up Production Database (File: {filename}) ---")
+    prod_conf = config['production']
+    comp = _compression_settings(prod_conf)
+    codec = comp['codec']
+    work_local = _incremental_dir(config, prod_conf)
+    segments_dir = os.path.join(work_local, 'segments')
+    state_path = os.path.join(work_local, 'state.json')
+    os.makedirs(segments_dir, exist_ok=True)
+    state = _load_incremental_state(state_path)
+    if state.get('codec', codec) != codec:
+        # Các segment phải cùng codec thì mới nối lại thành 1 file được
+        print(f"  [INFO] Compression changed ({state.get('codec')} -> {codec}), taking a full dump.")
+        state = {'tables': {}}
+
+    conn = get_connection(prod_conf)
+    start = time.time()
+    snapshot = None
+    try:
+        # Counter không theo MVCC: đọc TRƯỚC và SAU khi export snapshot, bảng nào
+        # nhảy counter ở giữa thì segment cũ có thể thiếu dữ liệu của snapshot -> dump lại
+        before, _ = _table_signatures(conn, prod_conf)
+        snapshot = _ExportedSnapshot(conn, prod_conf)
+        if snapshot.id:
+            current, names = _table_signatures(conn, prod_conf, snapshot.id)
+        else:
+            print(f"  [INFO] Cannot export a snapshot ({snapshot.error}), dumping every table.")
+            current, names = _table_signatures(conn, prod_conf)
+            state['tables'] = {}
+
+        changed = []
+        for table, info in current.items():
+            previous = state['tables'].get(table)
+            if (previous is None or previous['sig'] != info['sig']
+                    or before.get(table, {}).get('sig') != info['sig']
+                    or not os.path.exists(os.path.join(segments_dir, previous['segment']))):
+                changed.append(table)
+        reused = len(current) - len(changed)
+        changed_size = sum(current[t]['size'] for t in changed)
+        total_size = sum(info['size'] for info in current.values())
+        print(
+            f"  {len(changed)} of {len(current)} tables changed "
+            f"({_format_size(changed_size)} of {_format_size(total_size)} on disk), reusing {reused} segments"
+        )
+
+        # Dump trên server: schema + dữ liệu các bảng thay đổi + giá trị sequence,
+        # mỗi phần 1 file nén riêng, đóng gói tar để tải về 1 lần
+        stamp = _strip_dump_suffix(filename)
+        remote_dir = f"/tmp/{stamp}.incr"
+        remote_tar = f"/tmp/{stamp}.incr.tar"
+        remote_script = f"/tmp/{stamp}.incr.sql"
+        compressor = _compressor_command(comp)
+        pg_dump = f"{_dump_tool_prefix(prod_conf)}pg_dump {_db_host_arg(prod_conf)}-U {prod_conf['db_user']}"
+        if snapshot.id:
+            pg_dump += f" --snapshot={snapshot.id}"
+        psql = f"{_db_prefix(prod_conf)}psql {_db_host_arg(prod_conf)}-U {prod_conf['db_user']} -d {prod_conf['db_name']}"
+        steps = [
+            f"rm -rf {remote_dir} && mkdir -p {remote_dir}",
+            f"{pg_dump} --section=pre-data {prod_conf['db_name']} | {compressor} > {remote_dir}/pre",
+            f"{pg_dump} --section=post-data {prod_conf['db_name']} | {compressor} > {remote_dir}/post",
+            f"{psql} -At -c {shlex.quote(SEQUENCE_SETVAL_SQL)} | {compressor} > {remote_dir}/sequences",
+        ]
+        if changed:
+            # Mọi bảng thay đổi đọc trong CÙNG 1 snapshot (1 phiên psql), awk tách ra từng segment
+            with conn.sftp().open(remote_script, 'w') as f:
+                f.write(_incremental_data_script(changed, names, snapshot.id))
+            data_psql = (
+                f"{_db_prefix(prod_conf, interactive=True)}psql {_db_host_arg(prod_conf)}-U {prod_conf['db_user']} "
+                f"-d {prod_conf['db_name']} -X -q -At -v ON_ERROR_STOP=1"
+            )
+            steps.append(
+                f"{data_psql} < {remote_script} | awk -v dir={remote_dir} -v cmd={shlex.quote(compressor)} "
+                f"{shlex.quote(INCREMENTAL_SPLIT_AWK)}"
             )
+        steps.append(f"tar -C {remote_dir} -cf {remote_tar} .")
+        remote_cmd = _niced(prod_conf, _remote_pipeline(
+            " && ".join(steps) + f"; rc=$?; rm -rf {remote_dir} {remote_script}; exit $rc"
+        ))
+        conn.run(remote_cmd, hide='stdout')
+        snapshot.close()
+        snapshot = None
+        dump_elapsed = time.time() - start
+
+        local_tar = os.path.join(work_local, f"{stamp}.incr.tar")
+        transfer_file(conn, prod_conf, 'get', remote_tar, local_tar)
+        conn.run(f"rm -f {remote_tar}", hide=True, warn=True)
+    except UnexpectedExit as e:
+        print(f"Incremental backup failed: {e}")
+        sys.exit(1)
+    finally:
+        if snapshot is not None:
+            snapshot.close()
+        release_connection(conn)
+
+    # Giải nén các segment mới, thay thế segment cũ của bảng tương ứng
+    with tarfile.open(local_tar) as tar:
+        _extract_tar(tar, os.path.join(work_local, stamp))
+    new_dir = os.path.join(work_local, stamp)
+    for index, table in enumerate(changed):
+        segment = _segment_name(table, stamp, COMPRESSION_CODECS[codec]['suffix'])
+        os.replace(os.path.join(new_dir, f"data_{index}"), os.path.join(segments_dir, segment))
+        old = state['tables'].get(table)
+        if old and old['segment'] != segment and os.path.exists(os.path.join(segments_dir, old['segment'])):
+            os.remove(os.path.join(segments_dir, old['segment']))
+        # Chữ ký đọc TRƯỚC snapshot: counter đã nhảy sau đó thì lần sau bảng được dump lại
+        state['tables'][table] = {'sig': before.get(table, {}).get('sig'), 'segment': segment}
+    # Bảng đã bị drop trên prod thì bỏ segment
+    for table in list(state['tables']):
+        if table not in current:
+            old_segment = os.path.join(segments_dir, state['tables'].pop(table)['segment'])
+            if os.path.exists(old_segment):
+                os.remove(old_segment)
+
+    # Nối các phần nén lại (gzip/zstd/lz4 đều cho phép nối nhiều frame) thành 1 dump hoàn chỉnh
+    output_path = os.path.join(config['local']['backup_dir'], filename)
+    parts = [os.path.join(new_dir, 'pre')]
+    parts += [os.path.join(segments_dir, state['tables'][t]['segment']) for t in sorted(current)]
+    parts += [os.path.join(new_dir, 'sequences'), os.path.join(new_dir, 'post')]
+    with open(output_path + '.part', 'wb') as out:
+        for part in parts:
+            with open(part, 'rb') as f:
+                shutil.copyfileobj(f, out, TRANSFER_BLOCK_SIZE)
+    os.replace(output_path + '.part', output_path)
+    _catalog_add(config, filename, 'local', output_path, os.path.getsize(output_path), source='production', db_name=prod_conf['db_name'], format='plain', codec=codec)
+    shutil.rmtree(new_dir, ignore_errors=True)
+    os.remove(local_tar)
+
+    state['codec'] = codec
+    state['last_backup'] = filename
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(state_path + '.tmp', state_path)
+
+    elapsed = time.time() - start
+    METRICS.note(bytes_out=os.path.getsize(output_path), tables_dumped=len(changed), tables_reused=len(current) - len(changed))
+    print(
+        f"Incremental backup assembled: {output_path} ({_format_size(os.path.getsize(output_path))}), "
+        f"server dump {dump_elapsed:.1f}s, total {elapsed:.1f}s"
+    )
+
+
+# --- Subset dump: chỉ lấy một phần dữ liệu Production cho staging / máy dev ---
+SUBSET_TABLES_SQL = (
+    "SELECT quote_ident(n.nspname) || '.' || quote_ident(c.relname) || chr(9) || n.nspname || chr(9) || c.relname "
+    "FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+    "WHERE c.relkind = 'r' AND n.nspname NOT IN ('pg_catalog', 'information_schema') "
+    "AND n.nspname NOT LIKE 'pg_toast%' AND n.nspname NOT LIKE 'pg_temp%' ORDER BY 1"
+)
+# Mỗi khóa ngoại: bảng con, bảng cha, cột bảng con, cột bảng cha (đúng thứ tự trong khóa)
+SUBSET_FOREIGN_KEYS_SQL = (
+    "SELECT quote_ident(cn.nspname) || '.' || quote_ident(c.relname) || chr(9) || "
+    "quote_ident(pn.nspname) || '.' || quote_ident(p.relname) || chr(9) || "
+    "(SELECT string_agg(quote_ident(a.attname), ',' ORDER BY k.i) FROM unnest(con.conkey) WITH ORDINALITY k(n, i) "
+    "JOIN pg_attribute a ON a.attrelid = con.conrelid AND a.attnum = k.n) || chr(9) || "
+    "(SELECT string_agg(quote_ident(a.attname), ',' ORDER BY k.i) FROM unnest(con.confkey) WITH ORDINALITY k(n, i) "
+    "JOIN pg_attribute a ON a.attrelid = con.confrelid AND a.attnum = k.n) "
+    "FROM pg_constraint con "
+    "JOIN pg_class c ON c.oid = con.conrelid JOIN pg_namespace cn ON cn.oid = c.relnamespace "
+    "JOIN pg_class p ON p.oid = con.confrelid JOIN pg_namespace pn ON pn.oid = p.relnamespace "
+    "WHERE con.contype = 'f' ORDER BY 1"
+)
+
+def _subset_enabled(conf, flag=None):
+    """``--subset`` / ``--no-subset`` win over ``subset.enabled`` in the config."""
+    if flag is not None:
+        return flag
+    return bool((conf.get('subset') or {}).get('enabled'))
+
+def _qualify(pattern):
+    return pattern if '.' in pattern else f"public.{pattern}"
+
+def _subset_settings(conf):
+    subset = conf.get('subset') or {}
+    return {
+        'include': [_qualify(p) for p in subset.get('include') or ['*.*']],
+        'exclude': [_qualify(p) for p in subset.get('exclude') or []],
+        'schema_only': [_qualify(p) for p in subset.get('schema_only') or []],
+        'tables': {_qualify(p): rule or {} for p, rule in (subset.get('tables') or {}).items()},
+        'default_limit': subset.get('default_limit'),
+        'follow_foreign_keys': subset.get('follow_foreign_keys', True),
+    }
+
+def _matches(name, patterns):
+    return any(fnmatch.fnmatchcase(name, p) for p in patterns)
+
+def _subset_select(table, rule):
+    """``SELECT`` choosing the rows of ``table`` for a subset rule (where / limit / sample_percent / order_by)."""
+    sql = f"SELECT * FROM {table}"
+    if rule.get('sample_percent') is not None:
+        sql += f" TABLESAMPLE BERNOULLI ({float(rule['sample_percent'])})"
+    if rule.get('where'):
+        sql += f" WHERE {rule['where']}"
+    if rule.get('order_by'):
+        sql += f" ORDER BY {rule['order_by']}"
+    if rule.get('limit') is not None:
+        sql += f" LIMIT {int(rule['limit'])}"
+    return sql
+
+def _subset_plan(settings, tables, foreign_keys):
+    """Decide what every table contributes to the subset dump.
+
+    ``tables`` is ``[(quoted_name, schema, table)]``, ``foreign_keys`` is
+    ``[(child, parent, child_cols, parent_cols)]``.  Returns ``(plan,
+    excluded, closure)``: ``plan`` maps each kept table to ``'full'``,
+    ``'none'`` (schema only) or the ``SELECT`` of its rows, ``closure`` lists
+    the foreign keys whose parent rows must be completed from the child.
+    """
+    plan = {}
+    excluded = []
+    used_rules = set()
+    for quoted, schema, table in tables:
+        name = f"{schema}.{table}"
+        if not _matches(name, settings['include']) or _matches(name, settings['exclude']):
+            excluded.append(quoted)
+            continue
+        if _matches(name, settings['schema_only']):
+            plan[quoted] = 'none'
+            continue
+        rule = next((p for p in settings['tables'] if fnmatch.fnmatchcase(name, p)), None)
+        if rule is not None:
+            used_rules.add(rule)
+            plan[quoted] = _subset_select(quoted, settings['tables'][rule])
+        elif settings['default_limit'] is not None:
+            plan[quoted] = _subset_select(quoted, {'limit': settings['default_limit']})
         else:
-            # Fallback: DROP OWNED BY chỉ xóa objects owned bởi db_user
-            reset_schema_cmd = (
-                f"{prefix}psql -v ON_ERROR_STOP=1 {_db_host_arg(staging_conf)}-U {staging_conf['db_user']} -d {staging_conf['db_name']} "
-                f"-c \"DROP OWNED BY current_user CASCADE; "
-                f"DROP SCHEMA IF EXISTS public CASCADE; CREATE SCHEMA public; "
-                f"GRANT ALL ON SCHEMA public TO {staging_conf['db_user']}; "
-                f"GRANT ALL ON SCHEMA public TO public;\""
-            )
+            plan[quoted] = 'full'
+    for rule in settings['tables']:
+        if rule not in used_rules:
+            print(f"  [SUBSET] Warning: rule '{rule}' matches no table.")
 
-        try:
-            conn.run(kill_cmd, hide=True, warn=True) # warn=True because it might fail if we kill ourself or no perms, but worth trying
-            conn.run(reset_schema_cmd)
-            print("  [CLEAN] Schema reset successful.")
-        except Exception as e:
-            print(f"  [CLEAN] Warning: Failed to reset schema: {e}")
-            print("  Continuing with restore (might fail if conflicts exist)...")
+    closure = []
+    if not settings['follow_foreign_keys']:
+        return plan, excluded, closure
+    # Lặp đến khi ổn định: bảng schema-only bị bảng con tham chiếu sẽ thành bảng
+    # "rỗng + các dòng được tham chiếu", rồi đến lượt nó kéo theo bảng cha của nó
+    changed = True
+    while changed:
+        changed = False
+        for child, parent, child_cols, parent_cols in foreign_keys:
+            if plan.get(child, 'none') == 'none' or parent not in plan or plan[parent] == 'full':
+                continue
+            if plan[parent] == 'none':
+                plan[parent] = f"SELECT * FROM {parent} WHERE false"
+                changed = True
+    for child, parent, child_cols, parent_cols in foreign_keys:
+        if child in plan and plan[child] != 'none' and parent in excluded:
+            print(f"  [SUBSET] Warning: {child} references excluded table {parent}; its foreign key will fail to restore.")
+        if plan.get(child, 'none') != 'none' and plan.get(parent, 'full') not in ('full', 'none'):
+            closure.append((child, parent, child_cols.split(','), parent_cols.split(',')))
+    return plan, excluded, closure
 
-    restore_cmd = (
-        f"gunzip -c {remote_path} | "
-        f"{_db_prefix(staging_conf, interactive=True)}psql {_db_host_arg(staging_conf)}-U {staging_conf['db_user']} -d {staging_conf['db_name']}"
-    )
-    
-    print(f"Executing restore on staging... (This might take a while)")
-    try:
-        conn.run(restore_cmd)
-        print("Restore successful.")
-    except UnexpectedExit as e:
-        print(f"Restore failed: {e}")
-        sys.exit(1)
-    finally:
-        conn.close()
+def _psql_literal(text):
+    """Quote ``text`` as a single-quoted argument of a psql meta-command (``\\echo``)."""
+    return "'" + text.replace('\\', '\\\\').replace("'", "''") + "'"
 
-def restore_local(config, filename, clean=False):
-    print(f"--- [RESTORE LOCAL] Restoring to Local Database (File: {filename}) ---")
-    local_conf = config['local']
-    
-    backup_path = os.path.join(local_conf['backup_dir'], filename)
-    if not os.path.exists(backup_path):
-        print(f"Error: Backup file not found at {backup_path}")
-        sys.exit(1)
+def _subset_script(plan, closure, names):
+    """psql script printing the data section of the subset dump.
 
-    # Prepare environment for psql
-    env = os.environ.copy()
-    if 'db_password' in local_conf and local_conf['db_password']:
-        env['PGPASSWORD'] = local_conf['db_password']
-    
-    # Base connection args
-    auth_args = [
-        '-U', local_conf['db_user'],
-        '-h', local_conf['host'],
-        '-p', str(local_conf.get('port', 5432)),
-        '-d', local_conf['db_name']
+    Everything runs in one REPEATABLE READ transaction (one snapshot): the
+    chosen rows are copied into temp tables, parents referenced by kept rows
+    are added until no foreign key points outside the subset, then each table
+    is written as ``COPY ... FROM stdin`` blocks like pg_dump's own output.
+    """
+    temp = {}
+    lines = [
+        "SET client_min_messages = warning;",
+        "BEGIN ISOLATION LEVEL REPEATABLE READ;",
     ]
+    for table, select in plan.items():
+        if select not in ('full', 'none'):
+            temp[table] = f"_subset_{len(temp) + 1}"
+            lines.append(f"CREATE TEMP TABLE {temp[table]} AS {select};")
 
-    # Clean DB if requested
-    if clean:
-        print("  [CLEAN] Dropping & Recreating 'public' schema locally...")
-        try:
-            # 1. Terminate connections
-            kill_sql = f"SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = '{local_conf['db_name']}' AND pid <> pg_backend_pid();"
-            subprocess.run(['psql'] + auth_args + ['-c', kill_sql], env=env, check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            
-            # 2. Dùng superuser nếu có để DROP SCHEMA hoàn toàn (bypass ownership restrictions)
-            #    Nếu không có superuser, fallback về DROP OWNED BY current_user
-            su_user = local_conf.get('db_superuser')
-            if su_user:
-                su_pass = local_conf.get('db_superuser_password', '')
-                su_env = os.environ.copy()
-                if su_pass:
-                    su_env['PGPASSWORD'] = su_pass
-                su_auth = ['-U', su_user, '-h', local_conf['host'], '-p', str(local_conf.get('port', 5432)), '-d', local_conf['db_name']]
-                reset_sql = (
-                    f"DROP SCHEMA public CASCADE; CREATE SCHEMA public; "
-                    f"GRANT ALL ON SCHEMA public TO {local_conf['db_user']}; "
-                    f"GRANT ALL ON SCHEMA public TO public;"
-                )
-                # ON_ERROR_STOP=1: psql exit non-zero khi SQL error → CalledProcessError được raise
-                subprocess.run(['psql', '-v', 'ON_ERROR_STOP=1'] + su_auth + ['-c', reset_sql], env=su_env, check=True)
-            else:
-                # Fallback: DROP OWNED BY chỉ xóa objects owned bởi db_user
-                reset_sql = (
-                    f"DROP OWNED BY current_user CASCADE; "
-                    f"DROP SCHEMA IF EXISTS public CASCADE; CREATE SCHEMA public; "
-                    f"GRANT ALL ON SCHEMA public TO {local_conf['db_user']}; "
-                    f"GRANT ALL ON SCHEMA public TO public;"
-                )
-                subprocess.run(['psql', '-v', 'ON_ERROR_STOP=1'] + auth_args + ['-c', reset_sql], env=env, check=True)
-            print("  [CLEAN] Schema reset successful.")
-        except subprocess.CalledProcessError as e:
-            print(f"  [CLEAN] Warning: Failed to reset schema: {e}")
-            print("  Continuing with restore...")
+    def completion(child, parent, child_cols, parent_cols):
+        source = temp.get(child, child)
+        child_key = ', '.join(f"c.{col}" for col in child_cols)
+        parent_key = ', '.join(f"p.{col}" for col in parent_cols)
+        kept_key = ', '.join(f"s.{col}" for col in parent_cols)
+        return (
+            f"INSERT INTO {temp[parent]} SELECT p.* FROM {parent} p "
+            f"WHERE EXISTS (SELECT 1 FROM {source} c WHERE ({child_key}) = ({parent_key})) "
+            f"AND NOT EXISTS (SELECT 1 FROM {temp[parent]} s WHERE ({kept_key}) = ({parent_key}));"
+        )
 
-    print(f"Restoring {backup_path} to local db {local_conf['db_name']}...")
-    
-    try:
-        # Use gzip module to decompress stream to psql stdin
-        with gzip.open(backup_path, 'rb') as f_in:
-            with subprocess.Popen(['psql'] + auth_args, stdin=subprocess.PIPE, env=env) as p:
-                shutil.copyfileobj(f_in, p.stdin)
-                p.stdin.close() # Signal EOF
-                p.wait()
-                
-                if p.returncode == 0:
-                    print("Restore successful.")
-                else:
-                    print(f"Restore failed with exit code {p.returncode}")
-                    sys.exit(1)
+    # Bảng con lấy toàn bộ thì chỉ cần bổ sung bảng cha một lần; bảng con đã lọc
+    # thì lặp vì bảng con có thể vừa được bổ sung dòng ở vòng trước
+    lines += [completion(*fk) for fk in closure if fk[0] not in temp]
+    looped = [fk for fk in closure if fk[0] in temp]
+    if looped:
+        lines.append("DO $subset$\nDECLARE\n    added bigint;\n    total bigint;\nBEGIN\n    LOOP\n        total := 0;")
+        for fk in looped:
+            lines.append(f"        {completion(*fk)}")
+            lines.append("        GET DIAGNOSTICS added = ROW_COUNT;\n        total := total + added;")
+        lines.append("        EXIT WHEN total = 0;\n    END LOOP;\nEND\n$subset$;")
 
-    except Exception as e:
-        print(f"Restore failed: {e}")
-        sys.exit(1)
+    for table, select in plan.items():
+        if select == 'none':
+            continue
+        schema, relname = names[table]
+        lines.append("\\echo " + _psql_literal(f"-- Data for Name: {relname}; Type: TABLE DATA; Schema: {schema}; Owner: -"))
+        lines.append("\\echo " + _psql_literal(f"COPY {table} FROM stdin;"))
+        lines.append(f"COPY {temp.get(table, table)} TO STDOUT;")
+        lines.append("\\echo " + _psql_literal("\\."))
+    lines.append("\\echo " + _psql_literal("-- Name: sequences; Type: SEQUENCE SET; Schema: -; Owner: -"))
+    lines.append(SEQUENCE_SETVAL_SQL + ";")
+    lines.append("COMMIT;")
+    return "\n".join(lines) + "\n"
+
+def _prepare_subset(conn, conf, script_path):
+    """Plan the subset of ``conf``'s database and upload its psql script to ``script_path``.
+
+    Returns the shell command printing the subset as plain SQL: pg_dump's
+    pre-data, the chosen rows, then pg_dump's post-data (indexes and foreign
+    keys are created after the data, like a regular dump).
+    """
+    settings = _subset_settings(conf)
+    tables = [tuple(row.split('\t')) for row in _psql_query(conn, conf, SUBSET_TABLES_SQL)]
+    foreign_keys = [tuple(row.split('\t')) for row in _psql_query(conn, conf, SUBSET_FOREIGN_KEYS_SQL)]
+    plan, excluded, closure = _subset_plan(settings, tables, foreign_keys)
+    names = {quoted: (schema, table) for quoted, schema, table in tables}
 
+    modes = list(plan.values())
+    print(
+        f"  [SUBSET] {len(tables)} tables: {modes.count('full')} full, "
+        f"{len(modes) - modes.count('full') - modes.count('none')} filtered, {modes.count('none')} schema-only, "
+        f"{len(excluded)} excluded; {len(closure)} foreign key(s) followed"
+    )
+    with conn.sftp().open(script_path, 'w') as f:
+        f.write(_subset_script(plan, closure, names))
+
+    pg_dump = f"{_db_prefix(conf)}pg_dump {_db_host_arg(conf)}-U {conf['db_user']}"
+    psql = (
+        f"{_db_prefix(conf, interactive=True)}psql {_db_host_arg(conf)}-U {conf['db_user']} -d {conf['db_name']} "
+        f"-X -q -At -v ON_ERROR_STOP=1"
+    )
+    exclude = "".join(f" --exclude-table={shlex.quote(table)}" for table in excluded)
+    return (
+        f"{{ {pg_dump} --section=pre-data{exclude} {conf['db_name']} && {psql} < {script_path} && "
+        f"{pg_dump} --section=post-data{exclude} {conf['db_name']}; }}"
+    )
 
 
 def test_connections(config):
@@ -488,7 +3535,7 @@ def test_connections(config):
         prod_conn.run(db_check_cmd, hide=True)
         print(f"  [DB] OK! Database '{prod_conf['db_name']}' is accessible.")
         
-        prod_conn.close()
+        release_connection(prod_conn)
     except Exception as e:
         print(f"  [ERROR] Production Failed: {e}")
 
@@ -506,119 +3553,859 @@ def test_connections(config):
         staging_conn.run(db_check_cmd, hide=True)
         print(f"  [DB] OK! Database '{staging_conf['db_name']}' is accessible.")
         
-        staging_conn.close()
+        release_connection(staging_conn)
     except Exception as e:
         print(f"  [ERROR] Staging Failed: {e}")
 
-def find_latest_backup(backup_dir, base_filename):
-    """Finds the most recent backup file in the directory matching the base filename pattern."""
-    if not os.path.exists(backup_dir):
-        return None
-    
-    # Base pattern (e.g. backup_*.sql.gz)
-    # This is a bit naiive, assuming structure [base]_[timestamp].[ext]
-    # We'll just look for files that start with the base name (minus extension)
-    
-    if '.' in base_filename:
-        prefix = base_filename.split('.', 1)[0]
-        extension = base_filename.split('.', 1)[1]
-    else:
-        prefix = base_filename
-        extension = ""
-        
-    candidates = []
-    for f in os.listdir(backup_dir):
-        if f.startswith(prefix) and (extension in f if extension else True):
-            candidates.append(f)
-            
-    if not candidates:
-        return None
-        
-    # Sort by name (timestamp is increasing, so last is newest) or actual mtime
-    candidates.sort(reverse=True)
-    return candidates[0]
+def _is_backup_name(name):
+    return name.endswith(tuple(DUMP_SUFFIXES.values()) + PLAIN_SUFFIXES + PHYSICAL_SUFFIXES)
 
-def find_latest_remote_backup(config, base_filename):
-    """Finds the most recent backup file on the REMOTE Production server."""
-    prod_conf = config['production']
-    conn = get_connection(prod_conf)
-    
-    # Base pattern logic
-    if '.' in base_filename:
-        prefix = base_filename.split('.', 1)[0]
-    else:
-        prefix = base_filename
-        
-    # List files in /tmp/ matching pattern
-    # We use a simple command to list and sort by time
-    cmd = f"ls -t /tmp/ | grep '{prefix}' | head -n 1"
-    
-    try:
-        result = conn.run(cmd, hide=True)
-        filename = result.stdout.strip()
-        if filename:
+def _register_local_backups(config, catalog):
+    """Sync the catalog with ``backup_dir``, the archive dir and the dedup store (one listing each).
+
+    Returns ``(added, removed)`` copy counts.
+    """
+    store = _get_store(config)
+    stored = set(store.names()) if store else set()
+    known_store = set(catalog.names('store'))
+    added = removed = 0
+    directories = [('local', config['local']['backup_dir'])]
+    if _archive_dir(config):
+        directories.append(('archive', _archive_dir(config)))
+    for location, directory in directories:
+        names = set(os.listdir(directory)) if os.path.exists(directory) else set()
+        known = set(catalog.names(location))
+        for name in sorted(names):
+            if _is_backup_name(name) and name not in known:
+                path = os.path.join(directory, name)
+                catalog.add_copy(name, location, path, os.path.getsize(path), checksum=_read_local_checksum(path))
+                added += 1
+        for name in known:
+            if not os.path.exists(catalog.copies(name)[location]['path']):
+                catalog.remove_copy(name, location)
+                removed += 1
+    for name in sorted(stored - known_store):
+        catalog.add_copy(name, 'store', store.path, raw_size=store.manifest(name)['raw_size'])
+        added += 1
+    for name in known_store - stored:
+        catalog.remove_copy(name, 'store')
+        removed += 1
+    return added, removed
+
+def _register_remote_backups(catalog, conn, location, dirs, prefixes):
+    """Sync the catalog's ``location`` copies with a single SFTP listing of each dir.
+
+    Only files whose prefix is exactly one of ``prefixes`` are considered, so
+    unrelated files in ``/tmp`` are never picked up. Returns ``(added, removed)``.
+    """
+    sftp = conn.sftp()
+    seen = set()
+    added = removed = 0
+    for directory in dirs:
+        try:
+            entries = sftp.listdir_attr(directory)
+        except IOError:
+            continue
+        for entry in entries:
+            if _is_backup_name(entry.filename) and split_filename(entry.filename)[0] in prefixes:
+                if location not in catalog.copies(entry.filename):
+                    added += 1
+                catalog.add_copy(entry.filename, location, posixpath.join(directory, entry.filename), entry.st_size)
+                seen.add(entry.filename)
+    for name in catalog.names(location):
+        path = catalog.copies(name)[location]['path']
+        if name not in seen and split_filename(name)[0] in prefixes and posixpath.dirname(path) in dirs:
+            catalog.remove_copy(name, location)
+            removed += 1
+    return added, removed
+
+def _remote_backup_dirs(config, location):
+    if location == 'production':
+        return ['/tmp']
+    return sorted({'/tmp', config['staging'].get('remote_dir') or STAGING_REMOTE_DIR_DEFAULT})
+
+def find_latest_backup(config, base_filename):
+    """Finds the most recent local backup (backup_dir or dedup store) matching the base filename.
+
+    This is a catalog lookup; entries whose file has gone are dropped on the
+    way. When the catalog has nothing for this prefix yet (first run, files
+    copied in by hand) ``backup_dir`` and the store are scanned once.
+    """
+    prefix = base_prefix(base_filename)
+    catalog = _get_catalog(config)
+    store = _get_store(config)
+    for scanned in (False, True):
+        if scanned:
+            _register_local_backups(config, catalog)
+        while True:
+            filename = catalog.latest(prefix, ('local', 'store'))
+            if filename is None:
+                break
+            copies = catalog.copies(filename)
+            if 'local' in copies and not os.path.exists(copies['local']['path']):
+                catalog.remove_copy(filename, 'local')
+                continue
+            if 'store' in copies and (store is None or not store.has(filename)):
+                catalog.remove_copy(filename, 'store')
+                continue
             return filename
+    return None
+
+def _find_latest_remote(config, location, prefix):
+    """Latest backup with a copy on ``location`` (production/staging), verified with one stat."""
+    conn = get_connection(config[location])
+    catalog = _get_catalog(config)
+    try:
+        sftp = conn.sftp()
+        for scanned in (False, True):
+            if scanned:
+                _register_remote_backups(catalog, conn, location, _remote_backup_dirs(config, location), {prefix})
+            while True:
+                filename = catalog.latest(prefix, (location,))
+                if filename is None:
+                    break
+                try:
+                    sftp.stat(catalog.copies(filename)[location]['path'])
+                    return filename
+                except IOError:
+                    catalog.remove_copy(filename, location)
         return None
-    except Exception:
+    except (IOError, sqlite3.Error) as e:
+        print(f"  [CATALOG] Lookup failed: {e}")
         return None
     finally:
-        conn.close()
+        release_connection(conn)
+
+def find_latest_remote_backup(config, base_filename):
+    """Finds the most recent backup file on the REMOTE Production server."""
+    return _find_latest_remote(config, 'production', base_prefix(base_filename))
 
 def find_latest_remote_staging_backup(config, base_filename):
     """Finds the most recent backup file on the REMOTE Staging server."""
-    staging_conf = config['staging']
-    conn = get_connection(staging_conf)
-    
-    # Base pattern logic
     # Staging files are prefixed with 'staging_' in logic: filename = f"staging_{filename}"
-    
-    if '.' in base_filename:
-        prefix = base_filename.split('.', 1)[0]
+    return _find_latest_remote(config, 'staging', f"staging_{base_prefix(base_filename)}")
+
+def catalog_list(config, location=None):
+    """Print the catalog, newest first."""
+    catalog = _get_catalog(config)
+    rows = catalog.find(locations=[location] if location else None)
+    print(f"--- [CATALOG] {catalog.path}: {len(rows)} backup(s) ---")
+    for row in rows:
+        copies = catalog.copies(row['filename'])
+        if not copies:
+            continue
+        size = _format_size(row['size']) if row['size'] else '?'
+        print(
+            f"  {row['created']}  {row['filename']:<50} {row['source'] or '?':<10} "
+            f"{size:>10} {row['codec'] or row['format'] or '':<6} {', '.join(sorted(copies))}"
+        )
+
+def catalog_sync(config):
+    """Reconcile the catalog with backup_dir, the store and both servers (one listing each)."""
+    catalog = _get_catalog(config)
+    base = base_prefix(config['local'].get('backup_filename', 'backup.sql.gz'))
+    added, removed = _register_local_backups(config, catalog)
+    print(f"  [CATALOG] local: {added} added, {removed} removed")
+    for location in ('production', 'staging'):
+        prefixes = set(catalog.prefixes(location)) | {base, f"staging_{base}"}
+        conn = get_connection(config[location])
+        try:
+            added, removed = _register_remote_backups(catalog, conn, location, _remote_backup_dirs(config, location), prefixes)
+            print(f"  [CATALOG] {location}: {added} added, {removed} removed")
+        finally:
+            release_connection(conn)
+
+def catalog_prune(config, keep, location='local'):
+    """Delete all but the newest ``keep`` backups per prefix at ``location``."""
+    catalog = _get_catalog(config)
+    doomed = []
+    for prefix in catalog.prefixes(location):
+        doomed += catalog.find(prefix, [location], offset=keep)
+    if not doomed:
+        print(f"  [PRUNE] Nothing to prune at {location} (keep {keep}).")
+        return
+    paths = [(row['filename'], catalog.copies(row['filename'])[location]['path']) for row in doomed]
+    print(f"  [PRUNE] Removing {len(paths)} backup(s) from {location}:")
+    for filename, path in paths:
+        print(f"    - {path}")
+    _remove_backups(config, location, paths)
+
+def _remove_backups(config, location, paths):
+    """Delete ``[(filename, path)]`` at ``location`` with their sidecars and catalog copies.
+
+    Remote files go in a single ``rm`` per host, store backups through one gc.
+    """
+    if not paths:
+        return
+    catalog = _get_catalog(config)
+    if location in ('local', 'archive'):
+        for _, path in paths:
+            for victim in (path, _checksum_path(path)):
+                if os.path.exists(victim):
+                    os.remove(victim)
+    elif location == 'store':
+        store = _get_store(config)
+        for filename, _ in paths:
+            store.remove(filename)
+        freed, freed_bytes = store.gc()
+        print(f"  [PRUNE] Store gc: {freed} chunk(s), {_format_size(freed_bytes)} freed")
     else:
-        prefix = base_filename
-        
-    search_prefix = f"staging_{prefix}"
-    
-    # List files in /tmp/ matching pattern
-    cmd = f"ls -t /tmp/ | grep '{search_prefix}' | head -n 1"
-    
+        conn = get_connection(config[location])
+        try:
+            # Một lệnh rm cho tất cả file thay vì mỗi file một round-trip
+            conn.run("rm -f " + " ".join(
+                f"{shlex.quote(path)} {shlex.quote(_checksum_path(path))}" for _, path in paths
+            ), hide=True)
+        finally:
+            release_connection(conn)
+
+    for filename, _ in paths:
+        catalog.remove_copy(filename, location)
+        if not catalog.copies(filename):
+            catalog.forget(filename)
+
+# --- Retention: GFS + ngân sách dung lượng cho từng nơi lưu backup ---
+RETENTION_LOCATIONS = ('local', 'archive', 'production', 'staging')
+# Ước lượng dump khi chưa có lịch sử: dump nén thường nhỏ hơn nhiều so với DB (không có index)
+DUMP_SIZE_FACTOR = 0.5
+DB_SIZE_SQL = "SELECT pg_database_size(current_database())"
+SIZE_ESTIMATE_MARGIN = 1.2
+
+def _retention_conf(config, location):
+    return (config.get('retention') or {}).get(location) or {}
+
+def _archive_dir(config):
+    """Secondary local directory old local backups are moved to (``retention.local.archive_dir``)."""
+    return _retention_conf(config, 'local').get('archive_dir')
+
+def _location_dir(config, location):
+    if location == 'local':
+        return config['local']['backup_dir']
+    if location == 'archive':
+        return _archive_dir(config)
+    if location == 'staging':
+        return config['staging'].get('remote_dir') or STAGING_REMOTE_DIR_DEFAULT
+    return '/tmp'
+
+def _known_prefixes(config, catalog, location):
+    base = base_prefix(config['local'].get('backup_filename', 'backup.sql.gz'))
+    return set(catalog.prefixes(location)) | {base, f"staging_{base}"}
+
+def _location_backups(config, catalog, location, conn=None):
+    """Backups with a copy at ``location`` as retention dicts, after one listing of the location."""
+    if location in ('local', 'archive'):
+        _register_local_backups(config, catalog)
+    else:
+        _register_remote_backups(catalog, conn, location, _remote_backup_dirs(config, location),
+                                 _known_prefixes(config, catalog, location))
+    backups = []
+    for row in catalog.find(locations=[location]):
+        copies = catalog.copies(row['filename'])
+        copy = copies[location]
+        backups.append({
+            'filename': row['filename'],
+            'prefix': row['prefix'],
+            'created': retention.to_datetime(row['created']),
+            'size': copy['size'] or row['size'] or 0,
+            'path': copy['path'],
+            'copies': set(copies),
+        })
+    return backups
+
+def _free_bytes(config, location, conn=None):
+    directory = _location_dir(config, location)
+    if location in ('local', 'archive'):
+        os.makedirs(directory, exist_ok=True)
+        return shutil.disk_usage(directory).free
+    result = conn.run(f"df -PB1 {shlex.quote(directory)} | tail -n 1", hide=True)
+    return int(result.stdout.split()[3])
+
+def _migrate_backups(config, backups):
+    """Move local backups (and their checksum sidecars) into the archive directory."""
+    catalog = _get_catalog(config)
+    archive = _archive_dir(config)
+    os.makedirs(archive, exist_ok=True)
+    for backup in backups:
+        target = os.path.join(archive, backup['filename'])
+        shutil.move(backup['path'], target)
+        if os.path.exists(_checksum_path(backup['path'])):
+            shutil.move(_checksum_path(backup['path']), _checksum_path(target))
+        catalog.add_copy(backup['filename'], 'archive', target, backup['size'])
+        catalog.remove_copy(backup['filename'], 'local')
+
+def _drop_backups(config, location, backups, reason):
+    """Migrate (local with an archive dir) or delete ``backups``, printing what happens."""
+    if not backups:
+        return
+    migrate = location == 'local' and _archive_dir(config)
+    verb = f"Moving to {_archive_dir(config)}" if migrate else "Removing"
+    print(f"  [RETENTION] {verb} {len(backups)} backup(s) from {location} ({reason}):")
+    for backup in backups:
+        print(f"    - {backup['filename']} ({_format_size(backup['size'])}, {backup['created']:%Y-%m-%d %H:%M})")
+    if migrate:
+        _migrate_backups(config, backups)
+    else:
+        _remove_backups(config, location, [(b['filename'], b['path']) for b in backups])
+
+def apply_retention(config, location=None, dry_run=False):
+    """``retention`` action: apply the GFS policy and size budget of each configured location.
+
+    Local backups leaving the policy are moved to ``archive_dir`` when one is
+    configured (then the archive's own policy applies), otherwise deleted.
+    """
+    locations = [location] if location else [loc for loc in RETENTION_LOCATIONS if _retention_conf(config, loc)]
+    if not locations:
+        print("Nothing to do: no 'retention' block in the config.")
+        return
+    catalog = _get_catalog(config)
+    for loc in locations:
+        rconf = _retention_conf(config, loc)
+        policy = retention.policy_from_config(rconf)
+        budget = retention.budget_bytes(rconf)
+        if loc == 'archive' and not _archive_dir(config):
+            print("  [RETENTION] archive: retention.local.archive_dir is not set, skipping.")
+            continue
+        conn = get_connection(config[loc]) if loc in ('production', 'staging') else None
+        try:
+            backups = _location_backups(config, catalog, loc, conn)
+            total = sum(b['size'] for b in backups)
+            print(
+                f"--- [RETENTION] {loc}: {len(backups)} backup(s), {_format_size(total)}"
+                f"{f' of {_format_size(budget)} budget' if budget else ''} ({retention.format_policy(policy)}) ---"
+            )
+            doomed, over = retention.plan_retention(backups, policy, budget)
+            if over:
+                print(f"  [RETENTION] Warning: still {_format_size(over)} over budget (newest backups are always kept).")
+            if not doomed:
+                print("  [RETENTION] Nothing to remove.")
+            elif dry_run:
+                for backup in doomed:
+                    print(f"    would drop {backup['filename']} ({_format_size(backup['size'])})")
+            else:
+                _drop_backups(config, loc, doomed, 'policy/budget')
+        finally:
+            if conn is not None:
+                release_connection(conn)
+
+def _ensure_space(config, location, need, conn=None):
+    """Make sure ``need`` more bytes fit at ``location`` before writing them.
+
+    Checks free disk space (keeping ``min_free_gb`` spare) and the location's
+    ``max_size_gb`` budget. If either is short, backups the retention policy
+    drops anyway go first, then the oldest ones that have a copy elsewhere
+    (local: any, when they can be moved to the archive). Exits when the
+    space cannot be found, before anything is written.
+    """
+    rconf = _retention_conf(config, location)
+    reserve = int(float(rconf.get('min_free_gb') or 0) * retention.GB)
+    free = _free_bytes(config, location, conn)
+    budget = retention.budget_bytes(rconf)
+    deficit = need + reserve - free
+    print(
+        f"  [SPACE] {location} {_location_dir(config, location)}: {_format_size(free)} free, "
+        f"~{_format_size(need)} needed{f' + {_format_size(reserve)} reserve' if reserve else ''}"
+    )
+    if deficit <= 0 and budget is None:
+        return
+    catalog = _get_catalog(config)
+    backups = _location_backups(config, catalog, location, conn)
+    if budget is not None:
+        deficit = max(deficit, sum(b['size'] for b in backups) + need - budget)
+    if deficit <= 0:
+        return
+
+    policy = retention.policy_from_config(rconf)
+    archive = location == 'local' and _archive_dir(config)
+    if archive:
+        # Lần đầu archive_dir có thể chưa có; đằng nào cũng tạo khi chuyển file sang
+        os.makedirs(archive, exist_ok=True)
+    if archive and os.stat(archive).st_dev == os.stat(_location_dir(config, location)).st_dev:
+        print("  [SPACE] Warning: archive_dir is on the same disk as backup_dir; moving there frees no disk space.")
+
+    def can_drop(backup):
+        return bool(archive) or len(backup['copies']) > 1
+
+    chosen, freed = retention.make_room(backups, deficit, policy, can_drop)
+    if freed < deficit:
+        print(
+            f"Error: not enough space at {location}: {_format_size(deficit)} short and only "
+            f"{_format_size(freed)} can be freed by retention. Free some space or adjust 'retention.{location}'."
+        )
+        sys.exit(1)
+    _drop_backups(config, location, chosen, f"making room for {_format_size(need)}")
+
+def _transfer_need(conn, direction, remote_path, local_path, store=None):
+    """Bytes a download / upload will add at its destination (0 if the same-size file is there)."""
+    sftp = conn.sftp()
+    if direction == 'get':
+        size = sftp.stat(remote_path).st_size
+        existing = os.path.getsize(local_path) if os.path.exists(local_path) else None
+    else:
+        if store is not None:
+            name = os.path.basename(local_path)
+            size = sum(os.path.getsize(store.chunk_path(d)) for d in store.chunk_digests(name))
+        else:
+            size = os.path.getsize(local_path)
+        try:
+            existing = sftp.stat(remote_path).st_size
+        except IOError:
+            existing = None
+    return 0 if existing == size else size
+
+def _estimate_dump_size(config, conn, conf, filename, fmt, size_sql=DB_SIZE_SQL):
+    """Expected size of a new dump of ``conf``'s database, and ``pg_database_size``.
+
+    Scales the previous dump of the same name/format by the database growth
+    since then; without history a fixed fraction (``size_factor``) of the
+    database size is assumed. ``size_sql`` measures something else than the
+    database (the whole cluster for physical backups).
+    """
+    db_size = int(_psql_query(conn, conf, size_sql)[0])
+    previous = next(
+        (row for row in _get_catalog(config).find(split_filename(filename)[0], limit=20)
+         if row['size'] and row['db_size'] and row['format'] == fmt),
+        None,
+    )
+    if previous:
+        estimate = previous['size'] * db_size / previous['db_size'] * SIZE_ESTIMATE_MARGIN
+    else:
+        factor = float(_retention_conf(config, 'production').get('size_factor') or DUMP_SIZE_FACTOR)
+        estimate = db_size * factor
+    if fmt == 'directory':
+        # Thư mục pg_dump -Fd và file tar cùng nằm trên đĩa cho đến khi đóng gói xong
+        estimate *= 2
+    return int(estimate), db_size
+
+# --- Plan: ước lượng thời gian / dung lượng của 'full' trước khi chạy ---
+# Mỗi bảng: tổng (kèm index + toast), dữ liệu (heap + toast), index, số dòng ước lượng
+TABLE_SIZES_SQL = (
+    "SELECT quote_ident(n.nspname) || '.' || quote_ident(c.relname) || chr(9) || "
+    "pg_total_relation_size(c.oid) || chr(9) || pg_table_size(c.oid) || chr(9) || "
+    "pg_indexes_size(c.oid) || chr(9) || greatest(c.reltuples, 0)::bigint "
+    "FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+    "WHERE c.relkind IN ('r', 'm') AND n.nspname NOT IN ('pg_catalog', 'information_schema') "
+    "AND n.nspname NOT LIKE 'pg_toast%' ORDER BY pg_total_relation_size(c.oid) DESC"
+)
+PLAN_TOP_TABLES = 10
+
+def _table_sizes(conn, conf):
+    tables = []
+    for line in _psql_query(conn, conf, TABLE_SIZES_SQL):
+        name, total, data, indexes, rows = line.split('\t')
+        tables.append({'table': name, 'total': int(total), 'data': int(data), 'indexes': int(indexes), 'rows': int(rows)})
+    return tables
+
+def _plan_disk(config, location, need):
+    """Free space vs ``need`` at ``location`` (``free`` is None when it cannot be read)."""
+    reserve = int(float(_retention_conf(config, location).get('min_free_gb') or 0) * retention.GB)
+    entry = {'location': location, 'path': _location_dir(config, location), 'need': int(need), 'reserve': reserve, 'free': None, 'ok': None}
     try:
-        result = conn.run(cmd, hide=True)
-        filename = result.stdout.strip()
-        if filename:
-            return filename
-        return None
-    except Exception:
-        return None
-    finally:
-        conn.close()
+        conn = None if location == 'local' else get_connection(config[location])
+        entry['free'] = _free_bytes(config, location, conn)
+    except (ConnectionError, UnexpectedExit, OSError, IndexError, ValueError) as e:
+        print(f"  [PLAN] Warning: free space at {location} unknown: {e}")
+        return entry
+    entry['ok'] = entry['free'] >= need + reserve
+    return entry
+
+def plan_pipeline(config, fmt=None, subset=None, json_out=None):
+    """Estimate the disk space and duration of each stage of ``full`` without running it.
+
+    Sizes come from production (database and per-table sizes) and the
+    catalog; rates from earlier runs in the metrics JSON lines (config
+    ``plan.history``, default the metrics file), else ``plan.rates_mb_s``.
+    With ``json_out`` the estimate is also written there as JSON.
+    """
+    prod_conf = config['production']
+    plan_conf = config.get('plan') or {}
+    subset = _subset_enabled(prod_conf, subset)
+    fmt, _ = _dump_settings(prod_conf, 'plain' if subset else fmt)
+    filename = _new_backup_filename(config, 'backup', fmt)
+    project = METRICS.labels.get('project')
+    print(f"--- [PLAN] {project or 'full'}: {prod_conf['db_name']} on {prod_conf['host']} ({fmt}) ---")
+
+    conn = get_connection(prod_conf)
+    dump_bytes, db_size = _estimate_dump_size(config, conn, prod_conf, filename, fmt)
+    tables = _table_sizes(conn, prod_conf)
+    # Dung lượng đĩa của pg_dump -Fd gấp đôi file cuối (thư mục + tar), file truyền đi thì không
+    file_bytes = dump_bytes // 2 if fmt == 'directory' else dump_bytes
+
+    backups = _get_catalog(config).find(split_filename(filename)[0])
+    raw_ratio, _, samples = planner.size_ratios(backups, fmt)
+    if fmt == 'plain' and raw_ratio:
+        raw_bytes, raw_basis = db_size * raw_ratio, f"catalog ({samples} backup(s))"
+    else:
+        # SQL thô ~ dữ liệu của các bảng (không có index)
+        raw_bytes, raw_basis = sum(t['data'] for t in tables), 'table sizes'
+
+    history_path = plan_conf.get('history') or METRICS.jsonl_path
+    records = planner.load_history(history_path) if history_path else []
+    stages = planner.estimate_stages(raw_bytes, file_bytes, fmt, records, project, plan_conf.get('rates_mb_s'))
+    disks = [
+        _plan_disk(config, 'production', dump_bytes),
+        _plan_disk(config, 'local', file_bytes),
+        _plan_disk(config, 'staging', dump_bytes),
+    ]
+    plan = {
+        'project': project,
+        'database': prod_conf['db_name'],
+        'format': fmt,
+        'codec': _compression_settings(prod_conf)['codec'] if fmt == 'plain' else None,
+        'subset': subset,
+        'generated': datetime.datetime.now().isoformat(timespec='seconds'),
+        'db_size': db_size,
+        'raw_bytes': int(raw_bytes),
+        'raw_basis': raw_basis,
+        'dump_bytes': file_bytes,
+        'stages': stages,
+        'total_seconds': round(sum(s['seconds'] for s in stages), 1),
+        'disk': disks,
+        'fits': all(d['ok'] is not False for d in disks),
+        'tables': tables[:PLAN_TOP_TABLES],
+        'table_count': len(tables),
+    }
+
+    print(f"  Database: {_format_size(db_size)}, {len(tables)} table(s); SQL ~{_format_size(raw_bytes)} ({raw_basis}); dump ~{_format_size(file_bytes)}")
+    for table in plan['tables']:
+        print(
+            f"    {table['table']:<40} {_format_size(table['total']):>10} "
+            f"(data {_format_size(table['data'])}, indexes {_format_size(table['indexes'])}, ~{table['rows']} rows)"
+        )
+    print("  Stages:")
+    for stage in stages:
+        basis = f"history, {stage['runs']} run(s)" if stage['basis'] == 'history' else 'default rate'
+        print(
+            f"    {stage['stage']:<9} {_format_size(stage['bytes']):>10} at {_format_rate(stage['rate'], 1)} "
+            f"-> {planner.format_duration(stage['seconds']):>8}  ({basis})"
+        )
+    print(f"  Total: ~{planner.format_duration(plan['total_seconds'])}")
+    print("  Disk:")
+    for disk in disks:
+        free = _format_size(disk['free']) if disk['free'] is not None else '?'
+        status = {True: 'OK', False: 'SHORT', None: '?'}[disk['ok']]
+        reserve = f" + {_format_size(disk['reserve'])} reserve" if disk['reserve'] else ''
+        print(f"    {disk['location']:<10} {disk['path']:<30} need ~{_format_size(disk['need'])}{reserve}, {free} free  [{status}]")
+    if subset:
+        print("  Note: subset dumps only part of the rows; sizes and durations are upper bounds.")
+    if not plan['fits']:
+        print("  Warning: not enough free space somewhere; 'full' would clean up with retention or stop (see 'retention').")
+    if json_out is not None:
+        json.dump(plan, json_out, indent=2)
+        json_out.write('\n')
+    return plan
+
+# --- Batch: chạy pipeline của nhiều project (nhiều file config) song song ---
+BATCH_STEPS = ('backup', 'download', 'upload', 'relay', 'restore', 'backup_staging', 'download_staging', 'restore_local', 'store', 'retention')
+# Bước nặng trên DB server -> giới hạn theo host (không chạy 2 pg_dump cùng lúc trên 1 máy)
+BATCH_HOST_STEPS = {'backup': 'production', 'backup_staging': 'staging', 'restore': 'staging'}
+BATCH_DEFAULT_STEPS = ('backup', 'download')
+
+def _batch_config_paths(args):
+    """Config files named by ``--configs`` and/or found in ``--config-dir``."""
+    paths = list(args.configs or [])
+    if args.config_dir:
+        for name in sorted(os.listdir(args.config_dir)):
+            if name.endswith(('.yaml', '.yml')):
+                paths.append(os.path.join(args.config_dir, name))
+    seen = set()
+    unique = []
+    for path in paths:
+        key = os.path.abspath(path)
+        if key not in seen:
+            seen.add(key)
+            unique.append(path)
+    return unique
+
+class BatchScheduler:
+    """Run each project's steps as child processes with global and per-host limits.
+
+    At most ``max_parallel`` projects run at a time; a step listed in
+    ``BATCH_HOST_STEPS`` also takes one of ``per_host`` slots of the server
+    it loads. A failing step stops only its own project.
+    """
+
+    def __init__(self, max_parallel, per_host, log_dir, extra_args):
+        self.global_slots = threading.Semaphore(max(max_parallel, 1))
+        self.per_host = max(per_host, 1)
+        self.log_dir = log_dir
+        self.extra_args = extra_args
+        self._host_slots = {}
+        self._lock = threading.Lock()
+
+    def _host_slot(self, conf):
+        key = (conf['host'], conf.get('port', 22))
+        with self._lock:
+            if key not in self._host_slots:
+                self._host_slots[key] = threading.Semaphore(self.per_host)
+            return self._host_slots[key]
+
+    def run_project(self, project):
+        with self.global_slots:
+            project['start'] = time.time()
+            project['status'] = 'running'
+            for step in project['steps']:
+                host_slot = None
+                if step in BATCH_HOST_STEPS:
+                    host_slot = self._host_slot(project['config'][BATCH_HOST_STEPS[step]])
+                    if not host_slot.acquire(blocking=False):
+                        print(f"  [BATCH] {project['name']}: waiting for a free slot on {project['config'][BATCH_HOST_STEPS[step]]['host']}...")
+                        host_slot.acquire()
+                try:
+                    code = self._run_step(project, step)
+                finally:
+                    if host_slot:
+                        host_slot.release()
+                if code != 0:
+                    project['status'] = 'failed'
+                    project['failed_step'] = step
+                    print(f"  [BATCH] {project['name']}: {step} FAILED (exit {code}), see {project['log']}")
+                    break
+            else:
+                project['status'] = 'ok'
+            project['elapsed'] = time.time() - project['start']
+
+    def _run_step(self, project, step):
+        cmd = [sys.executable, os.path.abspath(__file__), step, '--config', project['path']]
+        if project['filename']:
+            cmd += ['--file', project['filename']]
+        cmd += self.extra_args
+        print(f"  [BATCH] {project['name']}: {step} started")
+        start = time.time()
+        with open(project['log'], 'a') as log:
+            log.write(f"===== {step}: {' '.join(cmd)}\n")
+            log.flush()
+            result = subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT)
+        project['steps_done'].append((step, result.returncode, time.time() - start))
+        if result.returncode == 0:
+            print(f"  [BATCH] {project['name']}: {step} ok ({time.time() - start:.1f}s)")
+        return result.returncode
+
+def run_batch(args):
+    """``batch`` action: run the same steps for several projects concurrently."""
+    paths = _batch_config_paths(args)
+    if not paths:
+        print("Error: batch needs --configs and/or --config-dir.")
+        sys.exit(1)
+    steps = args.steps or list(BATCH_DEFAULT_STEPS)
+    log_dir = args.log_dir or os.path.join(os.getcwd(), 'batch_logs')
+    os.makedirs(log_dir, exist_ok=True)
+    stamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+
+    projects = []
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        project = {
+            'name': name, 'path': path, 'steps': steps, 'steps_done': [],
+            'status': 'pending', 'log': os.path.join(log_dir, f"{name}_{stamp}.log"),
+        }
+        try:
+            with open(path, 'r') as f:
+                project['config'] = yaml.safe_load(f)
+            # Có bước backup -> đặt tên file mới dùng chung cho các bước sau,
+            # nếu không thì mỗi bước tự tìm file mới nhất như khi chạy tay
+            backup_step = next((s for s in steps if s in ('backup', 'backup_staging')), None)
+            # dump_format / codec sai -> _dump_settings in lỗi rồi sys.exit: chỉ project này fail, không dừng cả batch
+            messages = io.StringIO()
+            with contextlib.redirect_stdout(messages):
+                project['filename'] = _new_backup_filename(project['config'], backup_step, args.format) if backup_step else None
+        except (OSError, yaml.YAMLError, KeyError, TypeError, SystemExit) as e:
+            project['status'] = 'failed'
+            project['failed_step'] = 'config'
+            detail = messages.getvalue() if isinstance(e, SystemExit) else str(e)
+            project['error'] = ' '.join(detail.replace('Error: ', '', 1).split())
+            project['elapsed'] = 0
+        projects.append(project)
+
+    extra_args = []
+    if args.format:
+        extra_args += ['--format', args.format]
+    if args.jobs:
+        extra_args += ['--jobs', str(args.jobs)]
+    # None = theo config từng project; chỉ chuyển tiếp khi gõ --subset / --no-subset
+    if args.subset is not None:
+        extra_args.append('--subset' if args.subset else '--no-subset')
+    if args.clean:
+        extra_args.append('--clean')
+    if args.fast:
+        extra_args.append('--fast')
+    if args.pipe:
+        extra_args += ['--pipe', args.pipe]
+    if args.shadow:
+        extra_args.append('--shadow')
+    if args.relay_mode:
+        extra_args += ['--relay-mode', args.relay_mode]
+
+    runnable = [p for p in projects if p['status'] == 'pending']
+    print(f"--- [BATCH] {len(runnable)} project(s), steps: {' -> '.join(steps)}, "
+          f"max {args.max_parallel} parallel, {args.per_host} per host. Logs: {log_dir} ---")
+    scheduler = BatchScheduler(args.max_parallel, args.per_host, log_dir, extra_args)
+    start = time.time()
+    threads = [threading.Thread(target=scheduler.run_project, args=(p,), daemon=True) for p in runnable]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    print(f"\n--- [BATCH] Summary ({time.time() - start:.1f}s total) ---")
+    for p in projects:
+        if p['status'] == 'ok':
+            size = ''
+            if p['filename']:
+                local_path = os.path.join(p['config']['local']['backup_dir'], p['filename'])
+                if os.path.exists(local_path):
+                    size = f", {_format_size(os.path.getsize(local_path))}"
+            print(f"  [OK]     {p['name']}: {p['filename'] or 'latest backup'} ({p['elapsed']:.1f}s{size})")
+        else:
+            detail = p.get('error') or f"see {p['log']}"
+            print(f"  [FAILED] {p['name']}: step '{p.get('failed_step')}' after {p.get('elapsed', 0):.1f}s ({detail})")
+    failed = [p for p in projects if p['status'] != 'ok']
+    print(f"{len(projects) - len(failed)} succeeded, {len(failed)} failed.")
+    if failed:
+        sys.exit(1)
 
 def main():
     parser = argparse.ArgumentParser(description="Database Backup & Restore Tool")
-    parser.add_argument('action', choices=['backup', 'download', 'upload', 'restore', 'full', 'test', 'backup_staging', 'download_staging', 'restore_local', 'upload_prod', 'restore_prod'], 
+    parser.add_argument('action', choices=['backup', 'download', 'upload', 'restore', 'full', 'test', 'backup_staging', 'download_staging', 'restore_local', 'upload_prod', 'restore_prod', 'store', 'store_list', 'backup_incremental', 'batch', 'catalog_list', 'catalog_sync', 'catalog_prune', 'retention', 'snapshot_list', 'snapshot_create', 'snapshot_refresh', 'snapshot_drop', 'backup_physical', 'restore_physical', 'plan', 'relay'], 
                         help="Action to perform")
     parser.add_argument('--config', default='config.yaml', help="Path to config file")
     parser.add_argument('--file', help="Specific filename to use. Optional.")
-    parser.add_argument('--clean', action='store_true', help="[Restore/Full] Drop and recreate 'public' schema before restoring. WARNING: Destructive!")
+    parser.add_argument('--clean', action='store_true', help="[Restore/Full] Drop and recreate 'public' schema before restoring ([Restore physical] replace a non-empty data directory). WARNING: Destructive!")
+    parser.add_argument('--stream', action='store_true', help="[Full] Pipe pg_dump on Production straight into psql on Staging, no intermediate files.")
+    parser.add_argument('--tee', action='store_true', help="[Full --stream] Also keep a local copy of the streamed dump in local.backup_dir.")
+    parser.add_argument('--format', choices=DUMP_FORMATS, help="[Backup/Full] Dump format: plain (SQL + gzip), custom (pg_dump -Fc) or directory (pg_dump -Fd, packed as .dir.tar). Default: config 'dump_format' or plain.")
+    parser.add_argument('--fast', action='store_true', help="[Restore] Fast-restore profile: relaxed session settings (config 'fast_restore') and separate pre-data / data / post-data phases with timing.")
+    parser.add_argument('--pipe', choices=RESTORE_PIPE_MODES, help="[Restore local] How the dump reaches psql: native (decompressor piped straight into psql), python (in-process, big reusable buffer) or auto. Default: config 'local.restore_pipe.mode' or auto.")
+    parser.add_argument('--jobs', type=int, help="Parallel jobs for pg_dump -j (directory format) and pg_restore -j. Default: config 'jobs' or 1.")
+    parser.add_argument('--subset', action='store_true', default=None, help="[Backup/Full] Dump only the rows chosen by production 'subset' in the config (plain SQL).")
+    parser.add_argument('--no-subset', dest='subset', action='store_false', help="[Backup/Full] Full dump even if production 'subset.enabled' is set.")
+    
+    parser.add_argument('--keep', type=int, help="[Catalog prune] Backups to keep per name prefix.")
+    parser.add_argument('--location', choices=LOCATIONS, help="[Catalog list/prune, retention] Where the copies live (prune default: local, retention default: every configured location).")
+    parser.add_argument('--shadow', action='store_true', help="[Restore/Full] Load into <db>__shadow while the database keeps serving, sanity-check it, then swap it in by renaming. The old database is kept as <db>__previous.")
+    parser.add_argument('--rollback', action='store_true', help="[Restore] Swap <db>__previous (kept by --shadow) back in.")
+    parser.add_argument('--start', action='store_true', help="[Restore physical] Start the restored data directory with pg_ctl.")
+    parser.add_argument('--target', choices=SNAPSHOT_TARGETS, default='local', help="[Snapshot] Server holding the snapshots: local (the 'local' database) or staging. Default: local.")
+    parser.add_argument('--relay', action='store_true', help="[Full] Move the backup from Production to Staging directly between the servers instead of download + upload.")
+    parser.add_argument('--relay-mode', choices=RELAY_MODES, help="[Relay] pull: the destination fetches from the source over SSH; push: the source sends to the destination. Default: config 'relay.mode' or pull.")
+    parser.add_argument('--from', dest='relay_from', choices=RELAY_ENVS, default='production', help="[Relay] Server the backup is on (default production).")
+    parser.add_argument('--to', dest='relay_to', choices=RELAY_ENVS, default='staging', help="[Relay] Server the backup goes to (default staging).")
+    parser.add_argument('--json', action='store_true', help="[Plan] Also print the estimate as JSON on stdout; everything else goes to stderr.")
+    parser.add_argument('--dry-run', action='store_true', help="[Retention] Only print what would be moved or removed.")
+    parser.add_argument('--configs', nargs='+', help="[Batch] Config files to run.")
+    parser.add_argument('--config-dir', help="[Batch] Run every *.yaml config in this directory.")
+    parser.add_argument('--steps', nargs='+', choices=BATCH_STEPS, help=f"[Batch] Steps per project, in order. Default: {' '.join(BATCH_DEFAULT_STEPS)}.")
+    parser.add_argument('--max-parallel', type=int, default=4, help="[Batch] Projects running at the same time (default 4).")
+    parser.add_argument('--per-host', type=int, default=1, help="[Batch] Dumps/restores running at the same time on one server (default 1).")
+    parser.add_argument('--log-dir', help="[Batch] Directory for per-project logs (default ./batch_logs).")
     
     args = parser.parse_args()
+    if args.action == 'batch':
+        run_batch(args)
+        return
     config = load_config(args.config)
-    
+    _configure_metrics(config, args)
+    if args.json:
+        # stdout chỉ chứa JSON (cho scheduler), log thường ra stderr
+        sys.stdout = sys.stderr
+
+    try:
+        with METRICS.stage(f"run_{args.action}"):
+            run_action(args, config)
+    except ConnectionError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    finally:
+        SESSIONS.close_all()
+        METRICS.write_textfile()
+
+def _configure_metrics(config, args):
+    """Point METRICS at the files from the optional top-level ``metrics`` block.
+
+    JSON lines go to ``<backup_dir>/metrics.jsonl`` unless configured
+    otherwise; the Prometheus textfile is only written when set.
+    """
+    metrics_conf = config.get('metrics') or {}
+    if not metrics_conf.get('enabled', True):
+        return
+    labels = {'project': os.path.splitext(os.path.basename(args.config))[0]}
+    labels.update(metrics_conf.get('labels') or {})
+    jsonl_path = metrics_conf.get('jsonl', os.path.join(config['local']['backup_dir'], 'metrics.jsonl'))
+    fields = {
+        'action': args.action,
+        'run_id': datetime.datetime.now().strftime('%Y%m%d_%H%M%S'),
+    }
+    METRICS.configure(jsonl_path, metrics_conf.get('prometheus_textfile'), labels, fields)
+
+def _backup_format_and_codec(config, action, fmt=None):
+    source = 'staging' if action == 'backup_staging' else 'production'
+    fmt, _ = _dump_settings(config[source], 'plain' if action == 'backup_incremental' else fmt)
+    return fmt, _compression_settings(config[source])['codec']
+
+def _check_backup_filename(config, action, filename, fmt=None):
+    """Exit when a ``--file`` given for a new backup does not end like its format/codec.
+
+    Restores pick the format and the decompressor from the extension, so a
+    ``custom`` archive saved as ``.sql.gz`` could not be restored.
+    """
+    fmt, codec = _backup_format_and_codec(config, action, fmt)
+    expected = _filename_for_format(filename, fmt, codec)
+    if expected != filename:
+        print(f"Error: --file {filename} does not match the {fmt} format ({codec if fmt == 'plain' else 'archive'}); use --file {expected}")
+        sys.exit(1)
+
+def _new_backup_filename(config, action, fmt=None):
+    """Timestamped filename for a new backup, with the extension of its format/codec."""
+    base_name = config['local'].get('backup_filename', 'backup.sql.gz')
+    filename = get_timestamped_filename(base_name)
+    fmt, codec = _backup_format_and_codec(config, action, fmt)
+    filename = _filename_for_format(filename, fmt, codec)
+    # If backing up staging, maybe prefix differently to differentiate?
+    if action == 'backup_staging':
+        filename = f"staging_{filename}"
+    return filename
+
+def _run_restore(args, config, target, filename):
+    """Restore step of ``restore`` / ``restore_prod`` / ``restore_local`` / ``full`` (--shadow aware)."""
+    if args.shadow:
+        if args.clean:
+            print("  [SHADOW] --clean is not needed: the shadow database starts empty.")
+        restore_shadow(config, target, filename, jobs=args.jobs, fast=args.fast)
+    elif target == 'staging':
+        restore_staging(config, filename, clean=args.clean, jobs=args.jobs, fast=args.fast)
+    elif target == 'production':
+        restore_prod(config, filename, clean=args.clean, jobs=args.jobs, fast=args.fast)
+    else:
+        restore_local(config, filename, clean=args.clean, jobs=args.jobs, fast=args.fast, pipe=args.pipe)
+
+RESTORE_TARGETS = {'restore': 'staging', 'restore_prod': 'production', 'restore_local': 'local'}
+
+def run_action(args, config):
+    if args.rollback:
+        if args.action not in RESTORE_TARGETS:
+            print("Error: --rollback only applies to restore, restore_prod and restore_local.")
+            sys.exit(1)
+        restore_rollback(config, RESTORE_TARGETS[args.action])
+        return
+
     # Determine Filename
     filename = None
     
+    new_backup = args.action in ['backup', 'full', 'backup_staging', 'backup_incremental']
+    if new_backup:
+        fmt = args.format
+        if args.action in ('backup', 'full') and _subset_enabled(config['production'], args.subset):
+            fmt = 'plain'
     if args.file:
         filename = args.file
+        if new_backup:
+            _check_backup_filename(config, args.action, filename, fmt)
     else:
         # Default behavior depends on action
         base_name = config['local'].get('backup_filename', 'backup.sql.gz')
         
-        if args.action in ['backup', 'full', 'backup_staging']:
+        if new_backup:
             # ALWAYS New file for backup creation
-            filename = get_timestamped_filename(base_name)
-            # If backing up staging, maybe prefix differently to differentiate?
-            if args.action == 'backup_staging':
-                filename = f"staging_{filename}"
+            filename = _new_backup_filename(config, args.action, fmt)
         
         elif args.action == 'download':
             # For download, we look at REMOTE PROD
@@ -642,10 +4429,10 @@ def main():
                  print(f"Error: Could not find any backup files matching 'staging_{base_name}' on Remote Staging /tmp/")
                  sys.exit(1)
              
-        elif args.action in ['upload', 'restore', 'upload_prod', 'restore_prod']:
+        elif args.action in ['upload', 'restore', 'upload_prod', 'restore_prod', 'store']:
             # Seek the LATEST file for operations on existing data (LOCALLY)
             print(f"No --file specified. Looking for latest backup in {config['local']['backup_dir']}...")
-            latest = find_latest_backup(config['local']['backup_dir'], base_name)
+            latest = find_latest_backup(config, base_name)
             if latest:
                 filename = latest
                 print(f"Found latest local backup: {filename}")
@@ -653,10 +4440,13 @@ def main():
                 print(f"Error: Could not find any existing backup files matching '{base_name}' in {config['local']['backup_dir']}")
                 print("Please run 'backup' first or specify a file with --file")
                 sys.exit(1)
-        elif args.action == 'restore_local':
+        elif args.action == 'snapshot_refresh' and _latest_snapshot_file(config, args.target):
+            filename = _latest_snapshot_file(config, args.target)
+            print(f"No --file specified. Using the newest snapshot on {args.target}: {filename}")
+        elif args.action in ['restore_local', 'snapshot_create', 'snapshot_refresh']:
              # Restore local also looks for latest local backup
              print(f"No --file specified. Looking for latest backup in {config['local']['backup_dir']}...")
-             latest = find_latest_backup(config['local']['backup_dir'], base_name)
+             latest = find_latest_backup(config, base_name)
              if latest:
                 filename = latest
                 print(f"Found latest local backup: {filename}")
@@ -664,35 +4454,107 @@ def main():
                 print(f"Error: Could not find any existing backup files matching '{base_name}' in {config['local']['backup_dir']}")
                 sys.exit(1)
 
-        elif args.action == 'test':
+        elif args.action == 'relay':
+            prefix = base_prefix(base_name)
+            if args.relay_from == 'staging':
+                prefix = f"staging_{prefix}"
+            print(f"No --file specified. Looking for latest backup on REMOTE {args.relay_from.capitalize()}...")
+            filename = _find_latest_remote(config, args.relay_from, prefix)
+            if filename:
+                print(f"Found latest remote backup: {filename}")
+            else:
+                print(f"Error: Could not find any backup files matching '{prefix}' on {args.relay_from}.")
+                sys.exit(1)
+        elif args.action == 'backup_physical':
+            filename = _physical_filename(config)
+        elif args.action == 'restore_physical':
+            print(f"No --file specified. Looking for latest physical backup in {config['local']['backup_dir']}...")
+            filename = find_latest_backup(config, f"{base_prefix(base_name)}_physical{PHYSICAL_SUFFIX}")
+            if filename:
+                print(f"Found latest physical backup: {filename}")
+            else:
+                print("Error: Could not find any physical backup. Run 'backup_physical' first or specify --file.")
+                sys.exit(1)
+        elif args.action == 'snapshot_drop':
+            print("Error: snapshot_drop needs --file (see snapshot_list).")
+            sys.exit(1)
+        elif args.action in ['test', 'store_list', 'catalog_list', 'catalog_sync', 'catalog_prune', 'retention', 'snapshot_list', 'plan']:
              pass
 
     if args.action == 'test':
         test_connections(config)
+    elif args.action == 'catalog_list':
+        catalog_list(config, args.location)
+    elif args.action == 'catalog_sync':
+        catalog_sync(config)
+    elif args.action == 'catalog_prune':
+        if args.keep is None or args.keep < 0:
+            print("Error: catalog_prune needs --keep N with N >= 0.")
+            sys.exit(1)
+        catalog_prune(config, args.keep, args.location or 'local')
+    elif args.action == 'retention':
+        if args.location == 'store':
+            print("Error: the store is pruned with catalog_prune --location store.")
+            sys.exit(1)
+        apply_retention(config, args.location, dry_run=args.dry_run)
+    elif args.action == 'relay':
+        relay_backup(config, filename, args.relay_from, args.relay_to, mode=args.relay_mode)
+    elif args.action == 'plan':
+        plan_pipeline(config, fmt=args.format, subset=args.subset, json_out=sys.__stdout__ if args.json else None)
+    elif args.action == 'backup_physical':
+        backup_physical(config, filename)
+    elif args.action == 'restore_physical':
+        restore_physical(config, filename, clean=args.clean, start=args.start)
+    elif args.action == 'snapshot_list':
+        snapshot_list(config, args.target)
+    elif args.action == 'snapshot_create':
+        snapshot_create(config, filename, args.target, jobs=args.jobs, fast=args.fast)
+    elif args.action == 'snapshot_refresh':
+        snapshot_refresh(config, filename, args.target, jobs=args.jobs, fast=args.fast)
+    elif args.action == 'snapshot_drop':
+        snapshot_drop(config, filename, args.target)
+    elif args.action == 'store':
+        store_backup(config, filename)
+    elif args.action == 'backup_incremental':
+        backup_incremental(config, filename)
+    elif args.action == 'store_list':
+        store_list(config)
     elif args.action == 'backup':
-        backup_prod(config, filename)
+        backup_prod(config, filename, fmt=args.format, jobs=args.jobs, subset=args.subset)
     elif args.action == 'download':
         download_backup(config, filename)
     elif args.action == 'upload':
         upload_backup(config, filename)
     elif args.action == 'restore':
-        restore_staging(config, filename, clean=args.clean)
+        _run_restore(args, config, 'staging', filename)
     elif args.action == 'backup_staging':
-        backup_staging(config, filename)
+        backup_staging(config, filename, fmt=args.format, jobs=args.jobs)
     elif args.action == 'download_staging':
         download_staging(config, filename)
     elif args.action == 'restore_local':
-        restore_local(config, filename, clean=args.clean)
+        _run_restore(args, config, 'local', filename)
     elif args.action == 'upload_prod':
         upload_prod(config, filename)
     elif args.action == 'restore_prod':
-        restore_prod(config, filename, clean=args.clean)
+        _run_restore(args, config, 'production', filename)
+    elif args.action == 'full' and args.stream:
+        if args.shadow:
+            print("Error: --shadow needs a backup file to load; it cannot be combined with --stream.")
+            sys.exit(1)
+        if _dump_format_of(filename) != 'plain':
+            print("Error: --stream only supports the plain dump format (pg_restore -j needs a seekable archive).")
+            sys.exit(1)
+        print(f"Starting STREAMING FULL pipeline with filename: {filename}")
+        stream_prod_to_staging(config, filename, clean=args.clean, tee=args.tee, subset=args.subset)
     elif args.action == 'full':
         print(f"Starting FULL pipeline with filename: {filename}")
-        backup_prod(config, filename)
-        download_backup(config, filename)
-        upload_backup(config, filename)
-        restore_staging(config, filename, clean=args.clean)
+        backup_prod(config, filename, fmt=args.format, jobs=args.jobs, subset=args.subset)
+        if args.relay:
+            relay_backup(config, filename, mode=args.relay_mode)
+        else:
+            download_backup(config, filename)
+            upload_backup(config, filename)
+        _run_restore(args, config, 'staging', filename)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,191 @@
+"""SQLite catalog of backups and of the places their copies live.
+
+One row per backup (by filename) with its source environment, database,
+timestamp, size, codec and checksum, plus one row per copy::
+
+    backups(filename, prefix, source, db_name, created, format, codec, size, raw_size, db_size, checksum)
+    copies(backup_id, location, path, size, recorded)   location: local / archive / production / staging / store
+
+``prefix`` is the filename without its ``_YYYYMMDD_HHMMSS`` timestamp and
+extensions, so "latest backup of prod_chatbot_backup on staging" is one
+indexed query instead of a directory listing.
+"""
+import datetime
+import os
+import re
+import sqlite3
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    id INTEGER PRIMARY KEY,
+    filename TEXT NOT NULL UNIQUE,
+    prefix TEXT NOT NULL,
+    source TEXT,
+    db_name TEXT,
+    created TEXT NOT NULL,
+    format TEXT,
+    codec TEXT,
+    size INTEGER,
+    raw_size INTEGER,
+    db_size INTEGER,
+    checksum TEXT
+);
+CREATE INDEX IF NOT EXISTS backups_prefix_created ON backups (prefix, created);
+CREATE TABLE IF NOT EXISTS copies (
+    backup_id INTEGER NOT NULL REFERENCES backups (id) ON DELETE CASCADE,
+    location TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER,
+    recorded TEXT NOT NULL,
+    PRIMARY KEY (backup_id, location)
+);
+CREATE INDEX IF NOT EXISTS copies_location ON copies (location, backup_id);
+"""
+LOCATIONS = ('local', 'archive', 'production', 'staging', 'store')
+BACKUP_FIELDS = ('source', 'db_name', 'format', 'codec', 'size', 'raw_size', 'db_size', 'checksum')
+# Cột thêm sau phiên bản đầu: (tên, kiểu) -> ALTER TABLE cho catalog cũ
+ADDED_COLUMNS = (('db_size', 'INTEGER'),)
+_TIMESTAMP_RE = re.compile(r'^(.+?)_(\d{8}_\d{6})(?:\.|$)')
+
+
+def split_filename(filename):
+    """``prod_backup_20260101_120000.sql.gz`` -> ``('prod_backup', datetime)``.
+
+    Names without a timestamp keep their stem as prefix and get ``None``.
+    """
+    match = _TIMESTAMP_RE.match(filename)
+    if not match:
+        return filename.split('.', 1)[0], None
+    return match.group(1), datetime.datetime.strptime(match.group(2), '%Y%m%d_%H%M%S')
+
+
+def base_prefix(base_filename):
+    """Prefix of the configured ``backup_filename`` (``prod_backup.sql.gz`` -> ``prod_backup``)."""
+    return base_filename.split('.', 1)[0]
+
+
+class Catalog:
+    """Backup catalog stored in the SQLite file ``path``."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+            columns = {row['name'] for row in db.execute('PRAGMA table_info(backups)')}
+            for name, kind in ADDED_COLUMNS:
+                if name not in columns:
+                    db.execute(f'ALTER TABLE backups ADD COLUMN {name} {kind}')
+
+    @contextmanager
+    def _connect(self):
+        # Kết nối ngắn hạn cho mỗi thao tác -> an toàn khi nhiều thread/process (batch) cùng ghi
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            db.execute('PRAGMA foreign_keys = ON')
+            db.execute('PRAGMA journal_mode = WAL')
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def record(self, filename, **fields):
+        """Insert or update backup ``filename``; ``None`` fields keep their stored value."""
+        fields = {k: v for k, v in fields.items() if k in BACKUP_FIELDS and v is not None}
+        prefix, created = split_filename(filename)
+        created = (created or datetime.datetime.now()).isoformat(timespec='seconds')
+        with self._connect() as db:
+            db.execute(
+                'INSERT INTO backups (filename, prefix, created) VALUES (?, ?, ?) '
+                'ON CONFLICT (filename) DO NOTHING',
+                (filename, prefix, created),
+            )
+            if fields:
+                assignments = ', '.join(f'{k} = ?' for k in fields)
+                db.execute(f'UPDATE backups SET {assignments} WHERE filename = ?', list(fields.values()) + [filename])
+
+    def add_copy(self, filename, location, path, size=None, **fields):
+        """Record that ``filename`` exists at ``location`` (``path`` there).
+
+        ``size`` is also taken as the backup's size unless ``fields`` set one.
+        """
+        fields.setdefault('size', size)
+        self.record(filename, **fields)
+        with self._connect() as db:
+            db.execute(
+                'INSERT INTO copies (backup_id, location, path, size, recorded) '
+                'SELECT id, ?, ?, ?, ? FROM backups WHERE filename = ? '
+                'ON CONFLICT (backup_id, location) DO UPDATE SET path = excluded.path, '
+                'size = excluded.size, recorded = excluded.recorded',
+                (location, path, size, datetime.datetime.now().isoformat(timespec='seconds'), filename),
+            )
+
+    def remove_copy(self, filename, location):
+        with self._connect() as db:
+            db.execute(
+                'DELETE FROM copies WHERE location = ? AND backup_id = (SELECT id FROM backups WHERE filename = ?)',
+                (location, filename),
+            )
+
+    def forget(self, filename):
+        """Drop a backup and all its copies from the catalog (files are not touched)."""
+        with self._connect() as db:
+            db.execute('DELETE FROM backups WHERE filename = ?', (filename,))
+
+    def get(self, filename):
+        with self._connect() as db:
+            row = db.execute('SELECT * FROM backups WHERE filename = ?', (filename,)).fetchone()
+        return dict(row) if row else None
+
+    def copies(self, filename):
+        """``{location: {'path':..., 'size':..., 'recorded':...}}`` for a backup."""
+        with self._connect() as db:
+            rows = db.execute(
+                'SELECT c.location, c.path, c.size, c.recorded FROM copies c '
+                'JOIN backups b ON b.id = c.backup_id WHERE b.filename = ?',
+                (filename,),
+            ).fetchall()
+        return {row['location']: {'path': row['path'], 'size': row['size'], 'recorded': row['recorded']} for row in rows}
+
+    def find(self, prefix=None, locations=None, limit=None, offset=0):
+        """Backups newest first, optionally filtered by prefix and copy location."""
+        sql = 'SELECT DISTINCT b.* FROM backups b'
+        params = []
+        where = []
+        if locations:
+            sql += ' JOIN copies c ON c.backup_id = b.id'
+            where.append(f"c.location IN ({', '.join('?' * len(locations))})")
+            params += list(locations)
+        if prefix is not None:
+            where.append('b.prefix = ?')
+            params.append(prefix)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY b.created DESC, b.filename DESC'
+        if limit is not None or offset:
+            sql += ' LIMIT ? OFFSET ?'
+            params += [-1 if limit is None else limit, offset]
+        with self._connect() as db:
+            return [dict(row) for row in db.execute(sql, params).fetchall()]
+
+    def latest(self, prefix, locations):
+        rows = self.find(prefix, locations, limit=1)
+        return rows[0]['filename'] if rows else None
+
+    def names(self, location):
+        with self._connect() as db:
+            rows = db.execute(
+                'SELECT b.filename FROM backups b JOIN copies c ON c.backup_id = b.id WHERE c.location = ?',
+                (location,),
+            ).fetchall()
+        return [row['filename'] for row in rows]
+
+    def prefixes(self, location):
+        with self._connect() as db:
+            rows = db.execute(
+                'SELECT DISTINCT b.prefix FROM backups b JOIN copies c ON c.backup_id = b.id WHERE c.location = ?',
+                (location,),
+            ).fetchall()
+        return [row['prefix'] for row in rows]
@@ -0,0 +1,222 @@
+"""Content-addressed, deduplicating store for plain SQL backups.
+
+A backup is split into content-defined chunks, every chunk is saved once under
+its SHA-256 and a small JSON manifest lists the chunks of each backup::
+
+    <store>/chunks/ab/ab12...ef      one gzip member per chunk
+    <store>/manifests/<backup>.json  ordered chunk list + sizes
+
+Chunk boundaries are chosen on SQL line boundaries by hashing each line, so
+inserting or updating rows only changes the chunks around the change - the
+rest of the dump maps to chunks that already exist.  Because every chunk is
+an independent gzip member, concatenating the chunks of a manifest gives a
+valid ``.sql.gz`` file; the remote side can rebuild a backup with plain
+``cat`` and restore it with the usual ``gunzip | psql``.
+"""
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import os
+import zlib
+
+DEFAULT_AVG_CHUNK_KB = 1024
+# Độ dài trung bình ước lượng của 1 dòng SQL (dùng để tính mask cắt chunk)
+_ASSUMED_LINE_BYTES = 128
+
+
+class ChunkStore:
+    """Local chunk store rooted at ``path``."""
+
+    def __init__(self, path, avg_chunk_kb=DEFAULT_AVG_CHUNK_KB, level=6):
+        self.path = path
+        self.chunks_dir = os.path.join(path, 'chunks')
+        self.manifests_dir = os.path.join(path, 'manifests')
+        self.level = level
+        avg = max(int(avg_chunk_kb), 16) * 1024
+        self.min_size = avg // 4
+        self.max_size = avg * 4
+        # Cắt chunk khi crc32(line) & mask == 0 -> trung bình mỗi (mask+1) dòng một lần
+        lines_per_chunk = max(avg // _ASSUMED_LINE_BYTES, 1)
+        self.mask = (1 << max(lines_per_chunk.bit_length() - 1, 0)) - 1
+        os.makedirs(self.chunks_dir, exist_ok=True)
+        os.makedirs(self.manifests_dir, exist_ok=True)
+
+    def chunk_path(self, digest):
+        return os.path.join(self.chunks_dir, digest[:2], digest)
+
+    def manifest_path(self, name):
+        return os.path.join(self.manifests_dir, f"{name}.json")
+
+    def has(self, name):
+        return os.path.exists(self.manifest_path(name))
+
+    def manifest(self, name):
+        with open(self.manifest_path(name), 'r') as f:
+            return json.load(f)
+
+    def names(self):
+        """Backup names in the store, oldest first by name (timestamps sort)."""
+        return sorted(f[:-len('.json')] for f in os.listdir(self.manifests_dir) if f.endswith('.json'))
+
+    def _split(self, stream):
+        """Yield content-defined chunks of a binary stream, cut on line boundaries."""
+        buf = []
+        size = 0
+        for line in stream:
+            # Dòng quá dài (dữ liệu nhị phân / bytea lớn) -> cắt cứng theo max_size
+            while len(line) > self.max_size - size:
+                take = self.max_size - size
+                buf.append(line[:take])
+                line = line[take:]
+                yield b''.join(buf)
+                buf, size = [], 0
+            buf.append(line)
+            size += len(line)
+            if size >= self.min_size and (zlib.crc32(line) & self.mask) == 0:
+                yield b''.join(buf)
+                buf, size = [], 0
+        if buf:
+            yield b''.join(buf)
+
+    def add(self, name, stream):
+        """Store the decompressed SQL ``stream`` as backup ``name``.
+
+        Returns a dict with the raw size and SHA-256 of the stream, the chunk
+        count and how many chunks / stored bytes were actually new.
+        """
+        entries = []
+        raw_size = new_chunks = new_bytes = 0
+        whole = hashlib.sha256()
+        for data in self._split(stream):
+            whole.update(data)
+            digest = hashlib.sha256(data).hexdigest()
+            entries.append([digest, len(data)])
+            raw_size += len(data)
+            path = self.chunk_path(digest)
+            if os.path.exists(path):
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            packed = gzip.compress(data, compresslevel=self.level, mtime=0)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(packed)
+            os.replace(tmp_path, path)
+            new_chunks += 1
+            new_bytes += len(packed)
+
+        manifest = {
+            'name': name,
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'raw_size': raw_size,
+            'sha256': whole.hexdigest(),
+            'chunks': entries,
+        }
+        tmp_path = self.manifest_path(name) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_path(name))
+        return {
+            'raw_size': raw_size,
+            'sha256': manifest['sha256'],
+            'chunks': len(entries),
+            'new_chunks': new_chunks,
+            'new_bytes': new_bytes,
+        }
+
+    def chunk_digests(self, name):
+        """Ordered chunk digests of a backup (may repeat)."""
+        return [digest for digest, _ in self.manifest(name)['chunks']]
+
+    def iter_packed(self, name):
+        """Yield the gzip members of a backup in order (a valid .sql.gz stream)."""
+        for digest in self.chunk_digests(name):
+            with open(self.chunk_path(digest), 'rb') as f:
+                yield f.read()
+
+    def iter_raw(self, name):
+        """Yield the decompressed SQL of a backup chunk by chunk."""
+        for packed in self.iter_packed(name):
+            yield gzip.decompress(packed)
+
+    def open_raw(self, name):
+        """File-like object reading the decompressed SQL of a backup."""
+        return io.BufferedReader(_IterReader(self.iter_raw(name)), buffer_size=1024 * 1024)
+
+    def read_back(self, name):
+        """``(raw_size, sha256)`` of a backup rebuilt from its stored chunks.
+
+        Raises IOError when a chunk is missing or does not match its digest.
+        """
+        whole = hashlib.sha256()
+        raw_size = 0
+        for digest, data in zip(self.chunk_digests(name), self.iter_raw(name)):
+            if hashlib.sha256(data).hexdigest() != digest:
+                raise IOError(f"chunk {digest[:12]}... of {name} is corrupt")
+            whole.update(data)
+            raw_size += len(data)
+        return raw_size, whole.hexdigest()
+
+    def export(self, name, fileobj):
+        """Write the backup as a .sql.gz stream into ``fileobj``; returns bytes written."""
+        written = 0
+        for packed in self.iter_packed(name):
+            fileobj.write(packed)
+            written += len(packed)
+        return written
+
+    def stats(self):
+        """Logical (sum of backups) vs physical (unique chunks) size of the store."""
+        logical = 0
+        for name in self.names():
+            logical += self.manifest(name)['raw_size']
+        physical = 0
+        count = 0
+        for root, _, files in os.walk(self.chunks_dir):
+            for f in files:
+                physical += os.path.getsize(os.path.join(root, f))
+                count += 1
+        return {'backups': len(self.names()), 'logical': logical, 'physical': physical, 'chunks': count}
+
+    def remove(self, name):
+        """Drop a backup manifest. Chunks are reclaimed by ``gc``."""
+        if self.has(name):
+            os.remove(self.manifest_path(name))
+
+    def gc(self):
+        """Delete chunks no manifest references; returns (files, bytes) freed."""
+        live = set()
+        for name in self.names():
+            live.update(self.chunk_digests(name))
+        freed = freed_bytes = 0
+        for root, _, files in os.walk(self.chunks_dir):
+            for f in files:
+                if f not in live:
+                    path = os.path.join(root, f)
+                    freed_bytes += os.path.getsize(path)
+                    os.remove(path)
+                    freed += 1
+        return freed, freed_bytes
+
+
+class _IterReader(io.RawIOBase):
+    """Adapt an iterator of ``bytes`` to a readable raw stream."""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            try:
+                self._pending = next(self._chunks)
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
@@ -0,0 +1,177 @@
+"""Per-stage metrics for the backup pipeline.
+
+Every step (``backup_prod``, ``download_backup``, ``restore_staging``...) is
+recorded as one JSON line::
+
+    {"stage": "backup_prod", "start": "...", "end": "...", "duration_s": 12.3,
+     "status": "ok", "exit_code": 0, "bytes_in": 1048576000, "bytes_out": 201326592,
+     "throughput_bytes_per_s": 85248000.0, "compression_ratio": 5.2, ...}
+
+and, when ``prometheus_textfile`` is configured, as gauges in a file for the
+node_exporter textfile collector.  The textfile keeps the last value of every
+stage, including stages that did not run this time.
+"""
+import datetime
+import functools
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+PROM_PREFIX = 'backuptool_stage'
+# (tên metric, field trong record, mô tả)
+PROM_GAUGES = (
+    ('duration_seconds', 'duration_s', 'Duration of the last run of the stage.'),
+    ('success', 'success', '1 if the last run of the stage succeeded, 0 otherwise.'),
+    ('last_run_timestamp_seconds', 'end_ts', 'Unix time the last run of the stage finished.'),
+    ('bytes_in', 'bytes_in', 'Bytes read by the stage.'),
+    ('bytes_out', 'bytes_out', 'Bytes written by the stage.'),
+    ('throughput_bytes_per_second', 'throughput_bytes_per_s', 'Bytes in per second.'),
+    ('compression_ratio', 'compression_ratio', 'Raw / compressed size of the dump.'),
+)
+_SAMPLE_RE = re.compile(r'^(\w+)(\{.*\}) ')
+
+
+class MetricsRecorder:
+    """Records stages into a JSON lines file and an optional Prometheus textfile.
+
+    Nothing is written until ``configure`` gives at least one destination.
+    """
+
+    def __init__(self):
+        self.jsonl_path = None
+        self.textfile_path = None
+        self.labels = {}
+        self.fields = {}
+        self.records = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def configure(self, jsonl_path=None, textfile_path=None, labels=None, fields=None):
+        """``labels`` go into every record and Prometheus sample, ``fields`` only into the JSON lines."""
+        self.jsonl_path = jsonl_path
+        self.textfile_path = textfile_path
+        self.labels = dict(labels or {})
+        self.fields = dict(fields or {})
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def stage(self, name, **fields):
+        """Time the enclosed block as stage ``name``.
+
+        ``sys.exit`` inside the block is recorded as a failure with its exit
+        code and re-raised unchanged.
+        """
+        record = {'stage': name}
+        record.update(self.labels)
+        record.update(self.fields)
+        record.update(fields)
+        start = time.time()
+        record['start'] = _isoformat(start)
+        stack = self._stack()
+        stack.append(record)
+        status, exit_code = 'ok', 0
+        try:
+            yield record
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+            if code:
+                status, exit_code = 'failed', code
+            raise
+        except BaseException:
+            status, exit_code = 'failed', 1
+            raise
+        finally:
+            stack.pop()
+            end = time.time()
+            record['end'] = _isoformat(end)
+            record['end_ts'] = round(end, 3)
+            record['duration_s'] = round(end - start, 3)
+            record['status'] = status
+            record['exit_code'] = exit_code
+            record['success'] = 1 if status == 'ok' else 0
+            if record.get('bytes_in') and record['duration_s'] > 0:
+                record['throughput_bytes_per_s'] = round(record['bytes_in'] / record['duration_s'], 1)
+            self._emit(record)
+
+    def timed(self, name):
+        """Decorator form of ``stage``."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def note(self, **fields):
+        """Attach fields (bytes_in, bytes_out, compression_ratio...) to the current stage."""
+        stack = self._stack()
+        if stack:
+            stack[-1].update({k: v for k, v in fields.items() if v is not None})
+
+    def _emit(self, record):
+        with self._lock:
+            self.records.append(record)
+            if not self.jsonl_path:
+                return
+            try:
+                directory = os.path.dirname(os.path.abspath(self.jsonl_path))
+                os.makedirs(directory, exist_ok=True)
+                with open(self.jsonl_path, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+            except OSError as e:
+                print(f"  [METRICS] Warning: cannot write {self.jsonl_path}: {e}")
+
+    def write_textfile(self):
+        """Rewrite the Prometheus textfile with this run's stages (atomic replace)."""
+        if not self.textfile_path or not self.records:
+            return
+        latest = {}
+        for record in self.records:
+            labels = dict(self.labels, stage=record['stage'])
+            latest['{' + ','.join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items())) + '}'] = record
+
+        # Giữ lại sample của các stage (hoặc project khác) không chạy lần này
+        kept = {}
+        if os.path.exists(self.textfile_path):
+            with open(self.textfile_path, 'r') as f:
+                for line in f:
+                    match = _SAMPLE_RE.match(line)
+                    if match and match.group(2) not in latest:
+                        kept.setdefault(match.group(1), []).append(line.rstrip('\n'))
+
+        lines = []
+        for metric, field, help_text in PROM_GAUGES:
+            full_name = f"{PROM_PREFIX}_{metric}"
+            samples = list(kept.get(full_name, []))
+            for label_text, record in sorted(latest.items()):
+                if record.get(field) is not None:
+                    samples.append(f"{full_name}{label_text} {record[field]}")
+            if samples:
+                lines.append(f"# HELP {full_name} {help_text}")
+                lines.append(f"# TYPE {full_name} gauge")
+                lines.extend(samples)
+
+        tmp_path = self.textfile_path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.textfile_path)), exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(tmp_path, self.textfile_path)
+        except OSError as e:
+            print(f"  [METRICS] Warning: cannot write {self.textfile_path}: {e}")
+
+
+def _isoformat(ts):
+    return datetime.datetime.fromtimestamp(ts).isoformat(timespec='milliseconds')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
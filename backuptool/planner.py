@@ -0,0 +1,115 @@
+"""Time and disk estimates for a ``full`` run, before running it (``plan`` action).
+
+Sizes come from the database (``pg_database_size`` and per-table sizes) and
+from the catalog (how big earlier dumps were compared to their database);
+rates come from the metrics JSON lines of earlier runs.  Without history the
+``DEFAULT_RATES`` (or the config's ``plan.rates_mb_s``) are assumed, and the
+estimate says so::
+
+    {'stage': 'download', 'bytes': 1181116006, 'rate': 11534336.0,
+     'seconds': 102.4, 'basis': 'history', 'runs': 6}
+
+Everything here works on plain dicts and numbers; querying the servers is
+up to the caller.
+"""
+import json
+import statistics
+
+MB = 1024 * 1024
+# MB/s giả định khi chưa có lịch sử: backup tính theo SQL thô, các bước khác theo file nén
+DEFAULT_RATES = {'backup': 30, 'download': 10, 'upload': 10, 'restore': 8}
+# Bước của plan -> stage trong metrics
+HISTORY_STAGES = {
+    'backup': 'backup_prod',
+    'download': 'download_backup',
+    'upload': 'upload_backup',
+    'restore': 'restore_staging',
+}
+PLAN_STAGES = tuple(HISTORY_STAGES)
+HISTORY_RUNS = 10
+
+
+def load_history(path):
+    """Records of a metrics JSON lines file (missing file or bad lines are skipped)."""
+    records = []
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except OSError:
+        pass
+    return records
+
+
+def stage_rate(records, stage, fmt, project=None, limit=HISTORY_RUNS):
+    """Median bytes/s of the last ``limit`` successful runs of plan ``stage``.
+
+    Plain backups are measured in raw SQL bytes (``bytes_in``), archive
+    backups in written bytes; transfers and restores in file bytes.  Returns
+    ``(rate, runs)``, ``(None, 0)`` without usable history.
+    """
+    field = 'bytes_in' if stage != 'backup' or fmt == 'plain' else 'bytes_out'
+    samples = []
+    for record in reversed(records):
+        if record.get('stage') != HISTORY_STAGES[stage] or record.get('status') != 'ok' or record.get('skipped'):
+            continue
+        if project and record.get('project', project) != project:
+            continue
+        # backup_prod chỉ ghi 'format' cho dump không phải plain; transfer thì không phụ thuộc format
+        if record.get('format', 'plain' if stage == 'backup' else fmt) != fmt:
+            continue
+        amount, seconds = record.get(field), record.get('duration_s')
+        if amount and seconds:
+            samples.append(amount / seconds)
+            if len(samples) == limit:
+                break
+    return (statistics.median(samples), len(samples)) if samples else (None, 0)
+
+
+def size_ratios(backups, fmt):
+    """``(raw/db_size, size/db_size, count)`` of cataloged backups of ``fmt``, newest first.
+
+    ``raw`` is None when no backup of the format has a known raw size.
+    """
+    samples = [b for b in backups if b.get('format') == fmt and b.get('size') and b.get('db_size')][:HISTORY_RUNS]
+    if not samples:
+        return None, None, 0
+    packed = statistics.median(b['size'] / b['db_size'] for b in samples)
+    raws = [b['raw_size'] / b['db_size'] for b in samples if b.get('raw_size')]
+    return (statistics.median(raws) if raws else None), packed, len(samples)
+
+
+def estimate_stages(raw_bytes, dump_bytes, fmt, records, project=None, default_rates=None):
+    """Per-stage byte counts, rates and durations of backup -> download -> upload -> restore."""
+    defaults = dict(DEFAULT_RATES)
+    defaults.update(default_rates or {})
+    stages = []
+    for stage in PLAN_STAGES:
+        amount = raw_bytes if stage == 'backup' and fmt == 'plain' else dump_bytes
+        rate, runs = stage_rate(records, stage, fmt, project)
+        basis = 'history'
+        if rate is None:
+            rate, basis = float(defaults[stage]) * MB, 'default'
+        stages.append({
+            'stage': stage,
+            'bytes': int(amount),
+            'rate': round(rate, 1),
+            'seconds': round(amount / rate, 1),
+            'basis': basis,
+            'runs': runs,
+        })
+    return stages
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds}s"
+    minutes, seconds = divmod(seconds, 60)
+    if minutes < 60:
+        return f"{minutes}m {seconds:02d}s"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes:02d}m"
@@ -0,0 +1,141 @@
+"""Grandfather-father-son retention and disk budgets for backups.
+
+A policy keeps the newest ``keep_last`` backups plus the newest backup of
+each of the last ``daily`` days, ``weekly`` ISO weeks, ``monthly`` months
+and ``yearly`` years that have one::
+
+    {'keep_last': 3, 'daily': 7, 'weekly': 4, 'monthly': 6, 'yearly': 0}
+
+Periods without a backup do not count, so a policy never empties a location
+just because no backup ran for a while.  ``max_size_gb`` caps the total size
+of the backups at a location on top of that.
+
+Everything here works on plain dicts (``filename``, ``prefix``, ``created``
+datetime, ``size``) and only decides; removing or moving files is up to the
+caller.
+"""
+import datetime
+
+GFS_PERIODS = (
+    ('daily', lambda d: d.date()),
+    ('weekly', lambda d: tuple(d.isocalendar())[:2]),
+    ('monthly', lambda d: (d.year, d.month)),
+    ('yearly', lambda d: d.year),
+)
+POLICY_KEYS = ('keep_last',) + tuple(name for name, _ in GFS_PERIODS)
+GB = 1024 ** 3
+
+
+def policy_from_config(conf):
+    """Normalise a retention block; returns None when no rule is set."""
+    conf = conf or {}
+    policy = {key: int(conf.get(key) or 0) for key in POLICY_KEYS}
+    if not any(policy.values()):
+        return None
+    # Luôn giữ ít nhất bản mới nhất
+    policy['keep_last'] = max(policy['keep_last'], 1)
+    return policy
+
+
+def budget_bytes(conf):
+    """``max_size_gb`` of a retention block in bytes, or None."""
+    value = (conf or {}).get('max_size_gb')
+    return int(float(value) * GB) if value else None
+
+
+def gfs_keep(backups, policy):
+    """Filenames a GFS ``policy`` keeps among ``backups`` of ONE prefix."""
+    ordered = sorted(backups, key=lambda b: b['created'], reverse=True)
+    keep = {b['filename'] for b in ordered[:policy['keep_last']]}
+    for name, period_of in GFS_PERIODS:
+        count = policy.get(name, 0)
+        seen = []
+        for backup in ordered:
+            period = period_of(backup['created'])
+            if period in seen:
+                continue
+            if len(seen) == count:
+                break
+            seen.append(period)
+            keep.add(backup['filename'])
+    return keep
+
+
+def group_by_prefix(backups):
+    groups = {}
+    for backup in backups:
+        groups.setdefault(backup['prefix'], []).append(backup)
+    return groups
+
+
+def plan_retention(backups, policy=None, budget=None, need=0, can_drop=None):
+    """Decide which ``backups`` to remove, oldest first.
+
+    1. everything the GFS ``policy`` does not keep (per prefix);
+    2. while the location is over ``budget`` (bytes, counting ``need`` bytes
+       about to be added): the oldest kept backups, never the newest of a
+       prefix.
+
+    ``can_drop(backup)`` vetoes removals of step 2 (e.g. the only copy of a
+    backup).  Returns ``(doomed, over_budget)`` where ``over_budget`` is the
+    number of bytes still over the budget afterwards.
+    """
+    doomed = []
+    kept = []
+    for group in group_by_prefix(backups).values():
+        keep = gfs_keep(group, policy) if policy else {b['filename'] for b in group}
+        for backup in group:
+            (kept if backup['filename'] in keep else doomed).append(backup)
+    doomed.sort(key=lambda b: b['created'])
+
+    over_budget = 0
+    if budget is not None:
+        total = sum(b['size'] or 0 for b in kept) + need
+        newest = {p: max(g, key=lambda b: b['created'])['filename'] for p, g in group_by_prefix(kept).items()}
+        for backup in sorted(kept, key=lambda b: b['created']):
+            if total <= budget:
+                break
+            if backup['filename'] in newest.values() or (can_drop and not can_drop(backup)):
+                continue
+            doomed.append(backup)
+            total -= backup['size'] or 0
+        over_budget = max(total - budget, 0)
+    return doomed, over_budget
+
+
+def make_room(backups, deficit, policy=None, can_drop=None):
+    """Backups to remove (oldest first) to free ``deficit`` bytes.
+
+    Backups the ``policy`` would drop anyway go first, then the oldest ones
+    ``can_drop`` allows, never the newest of a prefix.  Returns ``(chosen,
+    freed)``; ``freed < deficit`` means the space cannot be found.
+    """
+    if deficit <= 0:
+        return [], 0
+    # Các bản policy không giữ thì xóa hết (đằng nào cũng bị xóa ở lần retention sau)
+    chosen, _ = plan_retention(backups, policy) if policy else ([], 0)
+    freed = sum(b['size'] or 0 for b in chosen)
+    names = {b['filename'] for b in chosen}
+    newest = {p: max(g, key=lambda b: b['created'])['filename'] for p, g in group_by_prefix(backups).items()}
+    for backup in sorted(backups, key=lambda b: b['created']):
+        if freed >= deficit:
+            break
+        if backup['filename'] in names or backup['filename'] in newest.values():
+            continue
+        if can_drop and not can_drop(backup):
+            continue
+        chosen.append(backup)
+        freed += backup['size'] or 0
+    return chosen, freed
+
+
+def format_policy(policy):
+    if not policy:
+        return 'keep all'
+    return ', '.join(f"{key}={policy[key]}" for key in POLICY_KEYS if policy.get(key))
+
+
+def to_datetime(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.fromisoformat(value)
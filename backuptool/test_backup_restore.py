@@ -0,0 +1,306 @@
+"""Tests for the pure helpers of backup_restore.py (chạy: python -m pytest backuptool)."""
+import gzip
+import hashlib
+import io
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+import backup_restore
+
+
+# --- Codec nén và tên file ---
+
+@pytest.mark.parametrize('codec, head', [
+    ('gzip', b'\x1f\x8b\x08\x00'),
+    ('zstd', b'\x28\xb5\x2f\xfd'),
+    ('lz4', b'\x04\x22\x4d\x18'),
+])
+def test_codec_from_magic(codec, head):
+    assert backup_restore._codec_from_magic(head) == codec
+
+
+def test_codec_from_magic_plain_sql():
+    assert backup_restore._codec_from_magic(b'--\n-') is None
+    assert backup_restore._codec_from_magic(b'') is None
+
+
+@pytest.mark.parametrize('filename, fmt, codec, expected', [
+    ('prod_20260101_000000.sql.gz', 'plain', 'gzip', 'prod_20260101_000000.sql.gz'),
+    ('prod_20260101_000000.sql.gz', 'plain', 'zstd', 'prod_20260101_000000.sql.zst'),
+    ('prod_20260101_000000.sql.gz', 'plain', 'pigz', 'prod_20260101_000000.sql.gz'),
+    ('prod_20260101_000000.sql.zst', 'plain', 'lz4', 'prod_20260101_000000.sql.lz4'),
+    ('prod_20260101_000000.sql.gz', 'custom', 'gzip', 'prod_20260101_000000.dump'),
+    ('prod_20260101_000000.dump', 'directory', 'gzip', 'prod_20260101_000000.dir.tar'),
+])
+def test_filename_for_format(filename, fmt, codec, expected):
+    assert backup_restore._filename_for_format(filename, fmt, codec) == expected
+
+
+def test_open_decompressed_gzip(tmp_path):
+    path = tmp_path / 'a.sql.gz'
+    path.write_bytes(gzip.compress(b'SELECT 1;\n'))
+    with backup_restore._open_decompressed(str(path), 'gzip') as f:
+        assert f.read() == b'SELECT 1;\n'
+
+
+@pytest.mark.skipif(shutil.which('zstd') is None, reason="zstd CLI not installed")
+def test_open_decompressed_cli_reports_truncated_input(tmp_path, monkeypatch):
+    # Ép dùng CLI dù có gói zstandard
+    monkeypatch.setitem(sys.modules, 'zstandard', None)
+    data = b'INSERT INTO t VALUES (1);\n' * 20000
+    packed = subprocess.run(['zstd', '-q', '-c'], input=data, stdout=subprocess.PIPE, check=True).stdout
+    good = tmp_path / 'good.sql.zst'
+    good.write_bytes(packed)
+    with backup_restore._open_decompressed(str(good), 'zstd') as f:
+        assert f.read() == data
+
+    bad = tmp_path / 'bad.sql.zst'
+    bad.write_bytes(packed[:len(packed) // 2])
+    with pytest.raises(IOError, match='incomplete'):
+        with backup_restore._open_decompressed(str(bad), 'zstd') as f:
+            f.read()
+
+
+# --- Transfer: hash theo thứ tự chunk, state resume ----------------------------
+
+def _chunks(data, size):
+    return [(i, offset, min(size, len(data) - offset)) for i, offset in enumerate(range(0, len(data), size))]
+
+
+def test_ordered_hasher_out_of_order_chunks():
+    data = bytes(range(256)) * 40
+    chunks = _chunks(data, 1000)
+    hasher = backup_restore.OrderedHasher(chunks, [], read_chunk=None, max_pending=len(chunks))
+    for index, offset, length in reversed(chunks):
+        hasher.add(index, data[offset:offset + length])
+    assert hasher.hexdigest() == hashlib.sha256(data).hexdigest()
+
+
+def test_ordered_hasher_reads_back_resumed_chunks():
+    data = bytes(range(256)) * 40
+    chunks = _chunks(data, 500)
+    done = [i for i, _, _ in chunks if i % 3 != 2]
+    reads = []
+
+    def read_chunk(offset, length):
+        reads.append(offset)
+        return data[offset:offset + length]
+
+    # max_pending nhỏ hơn số chunk đã xong: không được kẹt khi resume
+    hasher = backup_restore.OrderedHasher(chunks, done, read_chunk, max_pending=2)
+    for index, offset, length in chunks:
+        if index not in done:
+            hasher.add(index, data[offset:offset + length])
+    assert hasher.hexdigest() == hashlib.sha256(data).hexdigest()
+    assert sorted(reads) == sorted(chunks[i][1] for i in done)
+
+
+def test_ordered_hasher_incomplete():
+    chunks = _chunks(b'x' * 30, 10)
+    hasher = backup_restore.OrderedHasher(chunks, [], read_chunk=None)
+    hasher.add(0, b'x' * 10)
+    with pytest.raises(IOError, match='incomplete'):
+        hasher.hexdigest()
+
+
+def test_transfer_state_round_trip(tmp_path):
+    state_path = str(tmp_path / 'a.sql.gz.transfer.json')
+    expected = {'direction': 'put', 'remote_path': '/tmp/a.sql.gz', 'size': 100, 'mtime': 1, 'chunk_size': 10}
+    assert backup_restore._load_transfer_state(state_path, expected) == []
+    backup_restore._save_transfer_state(state_path, expected, {3, 1, 2})
+    assert backup_restore._load_transfer_state(state_path, expected) == [1, 2, 3]
+
+
+@pytest.mark.parametrize('key, value', [('mtime', 2), ('size', 101), ('chunk_size', 20), ('direction', 'get')])
+def test_transfer_state_ignored_when_source_changed(tmp_path, key, value):
+    state_path = str(tmp_path / 'a.sql.gz.transfer.json')
+    expected = {'direction': 'put', 'remote_path': '/tmp/a.sql.gz', 'size': 100, 'mtime': 1, 'chunk_size': 10}
+    backup_restore._save_transfer_state(state_path, expected, {1})
+    assert backup_restore._load_transfer_state(state_path, dict(expected, **{key: value})) == []
+
+
+def test_transfer_state_unreadable(tmp_path):
+    state_path = tmp_path / 'a.sql.gz.transfer.json'
+    state_path.write_text('{not json')
+    assert backup_restore._load_transfer_state(str(state_path), {'size': 1}) == []
+
+
+# --- Fast restore: tách plain dump theo pha ------------------------------------
+
+SAMPLE_DUMP = b"""--
+-- PostgreSQL database dump
+--
+
+SET statement_timeout = 0;
+SET client_encoding = 'UTF8';
+
+--
+-- Name: shop; Type: SCHEMA; Schema: -; Owner: postgres
+--
+
+CREATE SCHEMA shop;
+
+--
+-- Name: orders; Type: TABLE; Schema: shop; Owner: postgres
+--
+
+CREATE TABLE shop.orders (id integer NOT NULL, customer integer);
+
+--
+-- Name: orders_id_seq; Type: SEQUENCE; Schema: shop; Owner: postgres
+--
+
+CREATE SEQUENCE shop.orders_id_seq;
+
+--
+-- Data for Name: orders; Type: TABLE DATA; Schema: shop; Owner: postgres
+--
+
+COPY shop.orders (id, customer) FROM stdin;
+1\t10
+2\t20
+\\.
+
+--
+-- Name: orders_id_seq; Type: SEQUENCE SET; Schema: shop; Owner: postgres
+--
+
+SELECT pg_catalog.setval('shop.orders_id_seq', 2, true);
+
+--
+-- Name: orders orders_pkey; Type: CONSTRAINT; Schema: shop; Owner: postgres
+--
+
+ALTER TABLE ONLY shop.orders ADD CONSTRAINT orders_pkey PRIMARY KEY (id);
+
+--
+-- Name: orders_customer_idx; Type: INDEX; Schema: shop; Owner: postgres
+--
+
+CREATE INDEX orders_customer_idx ON shop.orders USING btree (customer);
+
+--
+-- Name: orders orders_customer_fkey; Type: FK CONSTRAINT; Schema: shop; Owner: postgres
+--
+
+ALTER TABLE ONLY shop.orders ADD CONSTRAINT orders_customer_fkey FOREIGN KEY (customer) REFERENCES shop.customers(id);
+"""
+
+
+def _phase_lines(phase):
+    return b''.join(backup_restore._sql_phase_filter(io.BytesIO(SAMPLE_DUMP), phase))
+
+
+def test_sql_phase_filter_splits_the_dump():
+    pre, data, post = (_phase_lines(phase) for phase in (1, 2, 3))
+    assert b'CREATE TABLE shop.orders' in pre and b'COPY' not in pre and b'CREATE INDEX' not in pre
+    assert b'COPY shop.orders' in data and b'setval' in data and b'CREATE TABLE' not in data
+    assert b'CREATE INDEX' in post and b'FOREIGN KEY' in post and b'PRIMARY KEY' in post and b'COPY' not in post
+    # Header (SET ...) đi cùng mọi pha
+    assert all(part.startswith(b'--\n-- PostgreSQL database dump') for part in (pre, data, post))
+
+
+@pytest.mark.skipif(shutil.which('awk') is None, reason="awk not installed")
+@pytest.mark.parametrize('phase', [1, 2, 3])
+def test_sql_phase_awk_matches_python_filter(phase):
+    result = subprocess.run(
+        ['awk', '-v', f'phase={phase}', backup_restore.SQL_PHASE_AWK],
+        input=SAMPLE_DUMP, stdout=subprocess.PIPE, check=True,
+    )
+    assert result.stdout == _phase_lines(phase)
+
+
+def test_fast_restore_settings_jobs_precedence():
+    conf = {'jobs': 2, 'fast_restore': {'jobs': 8, 'maintenance_work_mem': '2GB'}}
+    pgoptions, jobs = backup_restore._fast_restore_settings(conf, None)
+    assert jobs == 8
+    assert '-c maintenance_work_mem=2GB' in pgoptions and '-c synchronous_commit=off' in pgoptions
+    assert 'jobs' not in pgoptions
+    assert backup_restore._fast_restore_settings(conf, 3)[1] == 3
+    assert backup_restore._fast_restore_settings({'jobs': 2}, None)[1] == 2
+    assert backup_restore._fast_restore_settings({}, None)[1] == 1
+
+
+# --- Subset dump ---------------------------------------------------------------
+
+SUBSET_TABLES = [
+    ('public.customers', 'public', 'customers'),
+    ('public.orders', 'public', 'orders'),
+    ('public.order_items', 'public', 'order_items'),
+    ('public.countries', 'public', 'countries'),
+    ('public.audit_log', 'public', 'audit_log'),
+    ('public.events', 'public', 'events'),
+]
+SUBSET_FOREIGN_KEYS = [
+    ('public.order_items', 'public.orders', 'order_id', 'id'),
+    ('public.orders', 'public.customers', 'customer_id', 'id'),
+    ('public.customers', 'public.countries', 'country_code', 'code'),
+]
+
+
+def _subset(**subset):
+    settings = backup_restore._subset_settings({'subset': subset})
+    return backup_restore._subset_plan(settings, SUBSET_TABLES, SUBSET_FOREIGN_KEYS)
+
+
+def test_subset_plan_rules():
+    plan, excluded, closure = _subset(
+        exclude=['audit_log'],
+        schema_only=['events'],
+        tables={'orders': {'where': "created >= '2026-01-01'", 'order_by': 'id', 'limit': 500}},
+    )
+    assert excluded == ['public.audit_log']
+    assert plan['public.events'] == 'none'
+    assert plan['public.orders'] == "SELECT * FROM public.orders WHERE created >= '2026-01-01' ORDER BY id LIMIT 500"
+    assert plan['public.customers'] == 'full' and plan['public.order_items'] == 'full'
+    # Bảng cha lấy đủ thì không cần bổ sung dòng
+    assert closure == [('public.order_items', 'public.orders', ['order_id'], ['id'])]
+
+
+def test_subset_plan_follows_foreign_keys_into_schema_only_tables():
+    plan, _, closure = _subset(
+        schema_only=['countries'],
+        tables={'customers': {'limit': 10}, 'orders': {'sample_percent': 5}},
+    )
+    assert plan['public.countries'] == 'SELECT * FROM public.countries WHERE false'
+    assert plan['public.orders'] == 'SELECT * FROM public.orders TABLESAMPLE BERNOULLI (5.0)'
+    assert ('public.customers', 'public.countries', ['country_code'], ['code']) in closure
+    assert ('public.orders', 'public.customers', ['customer_id'], ['id']) in closure
+
+
+def test_subset_plan_without_foreign_keys_and_default_limit():
+    plan, _, closure = _subset(default_limit=100, follow_foreign_keys=False, schema_only=['countries'])
+    assert plan['public.countries'] == 'none'
+    assert plan['public.orders'] == 'SELECT * FROM public.orders LIMIT 100'
+    assert closure == []
+
+
+def test_subset_plan_warns_about_unused_rules(capsys):
+    _subset(tables={'nope': {'limit': 1}})
+    assert "rule 'public.nope' matches no table" in capsys.readouterr().out
+
+
+def test_subset_script():
+    plan, _, closure = _subset(schema_only=['events'], tables={'orders': {'limit': 5}, 'customers': {'limit': 10}})
+    names = {quoted: (schema, table) for quoted, schema, table in SUBSET_TABLES}
+    script = backup_restore._subset_script(plan, closure, names)
+    lines = script.splitlines()
+    assert lines[1] == 'BEGIN ISOLATION LEVEL REPEATABLE READ;' and lines[-1] == 'COMMIT;'
+    assert 'CREATE TEMP TABLE _subset_1 AS SELECT * FROM public.customers LIMIT 10;' in lines
+    assert 'CREATE TEMP TABLE _subset_2 AS SELECT * FROM public.orders LIMIT 5;' in lines
+    # order_items (đủ) bổ sung orders một lần; orders (đã lọc) kéo customers trong vòng lặp DO
+    assert any(line.startswith('INSERT INTO _subset_2 SELECT p.* FROM public.orders p') for line in lines)
+    loop = script[script.index('DO $subset$'):script.index('$subset$;')]
+    assert 'INSERT INTO _subset_1 SELECT p.* FROM public.customers p' in loop
+    assert "COPY _subset_2 TO STDOUT;" in lines and "COPY public.order_items TO STDOUT;" in lines
+    assert "COPY public.events TO STDOUT;" not in lines
+    assert "\\echo 'COPY public.orders FROM stdin;'" in lines
+    assert "\\echo '\\\\.'" in lines
+
+
+def test_psql_literal():
+    assert backup_restore._psql_literal("it's") == "'it''s'"
+    assert backup_restore._psql_literal('\\.') == "'\\\\.'"
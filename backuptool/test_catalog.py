@@ -0,0 +1,96 @@
+"""Tests for catalog.py (chạy: python -m pytest backuptool)."""
+import datetime
+import sqlite3
+
+import pytest
+
+import backup_restore
+from catalog import Catalog, base_prefix, split_filename
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    return Catalog(str(tmp_path / 'catalog.sqlite3'))
+
+
+def test_split_filename():
+    assert split_filename('prod_backup_20260101_120000.sql.gz') == (
+        'prod_backup', datetime.datetime(2026, 1, 1, 12, 0, 0))
+    assert split_filename('prod_backup.sql.gz') == ('prod_backup', None)
+    assert base_prefix('prod_backup.sql.gz') == 'prod_backup'
+
+
+def test_add_copy_and_lookup(catalog):
+    catalog.add_copy('prod_20260101_000000.sql.gz', 'local', '/b/prod_20260101_000000.sql.gz', 100,
+                     source='production', codec='gzip', checksum='ab' * 32)
+    catalog.add_copy('prod_20260101_000000.sql.gz', 'staging', '/tmp/prod_20260101_000000.sql.gz', 100)
+    row = catalog.get('prod_20260101_000000.sql.gz')
+    assert row['prefix'] == 'prod' and row['created'] == '2026-01-01T00:00:00'
+    assert row['codec'] == 'gzip' and row['size'] == 100 and row['checksum'] == 'ab' * 32
+    assert set(catalog.copies('prod_20260101_000000.sql.gz')) == {'local', 'staging'}
+
+    # None giữ nguyên giá trị đã lưu
+    catalog.record('prod_20260101_000000.sql.gz', codec=None, raw_size=500)
+    row = catalog.get('prod_20260101_000000.sql.gz')
+    assert row['codec'] == 'gzip' and row['raw_size'] == 500
+
+
+def test_find_latest_and_locations(catalog):
+    for day in (1, 2, 3):
+        catalog.add_copy(f'prod_2026010{day}_000000.sql.gz', 'local', f'/b/{day}', 1)
+    catalog.add_copy('erp_20260105_000000.sql.gz', 'staging', '/tmp/erp', 1)
+    assert [r['filename'] for r in catalog.find('prod')] == [
+        'prod_20260103_000000.sql.gz', 'prod_20260102_000000.sql.gz', 'prod_20260101_000000.sql.gz']
+    assert catalog.latest('prod', ['local']) == 'prod_20260103_000000.sql.gz'
+    assert catalog.latest('prod', ['staging']) is None
+    assert catalog.latest('erp', ['staging', 'local']) == 'erp_20260105_000000.sql.gz'
+    assert sorted(catalog.prefixes('local')) == ['prod']
+    assert sorted(catalog.names('staging')) == ['erp_20260105_000000.sql.gz']
+    # offset = số bản giữ lại khi prune
+    assert [r['filename'] for r in catalog.find('prod', ['local'], offset=2)] == ['prod_20260101_000000.sql.gz']
+
+
+def test_remove_copy_and_forget(catalog):
+    catalog.add_copy('prod_20260101_000000.sql.gz', 'local', '/b/a', 1)
+    catalog.add_copy('prod_20260101_000000.sql.gz', 'store', '/b/store', None)
+    catalog.remove_copy('prod_20260101_000000.sql.gz', 'local')
+    assert set(catalog.copies('prod_20260101_000000.sql.gz')) == {'store'}
+    catalog.forget('prod_20260101_000000.sql.gz')
+    assert catalog.get('prod_20260101_000000.sql.gz') is None
+    assert catalog.names('store') == []
+
+
+def test_old_catalog_gets_new_columns(tmp_path):
+    path = str(tmp_path / 'catalog.sqlite3')
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE backups (id INTEGER PRIMARY KEY, filename TEXT NOT NULL UNIQUE, prefix TEXT NOT NULL, '
+               'source TEXT, db_name TEXT, created TEXT NOT NULL, format TEXT, codec TEXT, size INTEGER, '
+               'raw_size INTEGER, checksum TEXT)')
+    db.commit()
+    db.close()
+    catalog = Catalog(path)
+    catalog.record('prod_20260101_000000.sql.gz', db_size=42)
+    assert catalog.get('prod_20260101_000000.sql.gz')['db_size'] == 42
+
+
+def test_get_catalog_is_cached_per_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(backup_restore, 'CATALOGS', {})
+    config = {'local': {'backup_dir': str(tmp_path)}}
+    assert backup_restore._get_catalog(config) is backup_restore._get_catalog(config)
+    other = {'local': {'backup_dir': str(tmp_path), 'catalog': str(tmp_path / 'other.sqlite3')}}
+    assert backup_restore._get_catalog(other) is not backup_restore._get_catalog(config)
+
+
+def test_catalog_prune_local(tmp_path, monkeypatch):
+    monkeypatch.setattr(backup_restore, 'CATALOGS', {})
+    config = {'local': {'backup_dir': str(tmp_path)}}
+    catalog = backup_restore._get_catalog(config)
+    paths = []
+    for day in (1, 2, 3):
+        path = tmp_path / f'prod_2026010{day}_000000.sql.gz'
+        path.write_bytes(b'x')
+        catalog.add_copy(path.name, 'local', str(path), 1)
+        paths.append(path)
+    backup_restore.catalog_prune(config, 1, 'local')
+    assert [p.exists() for p in paths] == [False, False, True]
+    assert catalog.names('local') == ['prod_20260103_000000.sql.gz']
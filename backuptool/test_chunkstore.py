@@ -0,0 +1,83 @@
+"""Tests for chunkstore.py (chạy: python -m pytest backuptool)."""
+import gzip
+import hashlib
+import io
+import os
+
+import pytest
+
+from chunkstore import ChunkStore
+
+
+def dump(rows, start=0):
+    lines = [b'-- PostgreSQL database dump\n', b'COPY public.t (id, name) FROM stdin;\n']
+    lines += [f"{i}\tname {i} {'x' * 60}\n".encode() for i in range(start, start + rows)]
+    lines.append(b'\\.\n')
+    return b''.join(lines)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ChunkStore(str(tmp_path / 'store'), avg_chunk_kb=16)
+
+
+def test_add_round_trip(store):
+    data = dump(5000)
+    result = store.add('a.sql.gz', io.BytesIO(data))
+    assert result['raw_size'] == len(data)
+    assert result['sha256'] == hashlib.sha256(data).hexdigest()
+    assert result['chunks'] > 1
+    assert store.open_raw('a.sql.gz').read() == data
+    # Các chunk nối lại là một file .sql.gz hợp lệ
+    packed = io.BytesIO()
+    store.export('a.sql.gz', packed)
+    assert gzip.decompress(packed.getvalue()) == data
+
+
+def test_add_deduplicates_unchanged_chunks(store):
+    first = store.add('a.sql.gz', io.BytesIO(dump(5000)))
+    again = store.add('b.sql.gz', io.BytesIO(dump(5000)))
+    assert again['new_chunks'] == 0 and again['new_bytes'] == 0
+    # Thêm dòng ở cuối chỉ đổi vài chunk cuối
+    grown = store.add('c.sql.gz', io.BytesIO(dump(5100)))
+    assert 0 < grown['new_chunks'] < first['chunks']
+    assert store.stats()['backups'] == 3
+
+
+def test_read_back_matches_add(store):
+    result = store.add('a.sql.gz', io.BytesIO(dump(2000)))
+    assert store.read_back('a.sql.gz') == (result['raw_size'], result['sha256'])
+
+
+def test_read_back_detects_a_corrupt_chunk(store):
+    store.add('a.sql.gz', io.BytesIO(dump(2000)))
+    digest = store.chunk_digests('a.sql.gz')[1]
+    with open(store.chunk_path(digest), 'wb') as f:
+        f.write(gzip.compress(b'not the original data\n'))
+    with pytest.raises(IOError, match='corrupt'):
+        store.read_back('a.sql.gz')
+
+
+def test_remove_and_gc_keep_shared_chunks(store):
+    store.add('a.sql.gz', io.BytesIO(dump(3000)))
+    store.add('b.sql.gz', io.BytesIO(dump(3000, start=100000)))
+    shared = store.add('c.sql.gz', io.BytesIO(dump(3000)))
+    assert shared['new_chunks'] == 0
+
+    store.remove('a.sql.gz')
+    assert store.gc() == (0, 0)
+    assert store.open_raw('c.sql.gz').read() == dump(3000)
+
+    b_chunks = set(store.chunk_digests('b.sql.gz'))
+    store.remove('b.sql.gz')
+    freed, freed_bytes = store.gc()
+    assert freed == len(b_chunks - set(store.chunk_digests('c.sql.gz'))) and freed_bytes > 0
+    assert not any(os.path.exists(store.chunk_path(d)) for d in b_chunks - set(store.chunk_digests('c.sql.gz')))
+    assert store.names() == ['c.sql.gz']
+
+
+def test_long_lines_are_cut(store):
+    data = b'x' * (store.max_size * 2 + 10) + b'\n'
+    result = store.add('a.sql.gz', io.BytesIO(data))
+    assert result['chunks'] == 3
+    assert store.open_raw('a.sql.gz').read() == data
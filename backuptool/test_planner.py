@@ -0,0 +1,71 @@
+"""Tests for planner.py (chạy: python -m pytest backuptool)."""
+import json
+
+import planner
+
+MB = planner.MB
+
+
+def run(stage, bytes_in, seconds, status='ok', **fields):
+    return dict(stage=stage, status=status, bytes_in=bytes_in, duration_s=seconds, **fields)
+
+
+def test_load_history_skips_bad_lines(tmp_path):
+    path = tmp_path / 'metrics.jsonl'
+    path.write_text(json.dumps(run('backup_prod', 1, 1)) + '\nnot json\n' + json.dumps(run('upload_backup', 2, 1)) + '\n')
+    assert [r['stage'] for r in planner.load_history(str(path))] == ['backup_prod', 'upload_backup']
+    assert planner.load_history(str(tmp_path / 'missing.jsonl')) == []
+
+
+def test_stage_rate_median_of_successful_runs():
+    records = [
+        run('download_backup', 10 * MB, 1),
+        run('download_backup', 30 * MB, 1),
+        run('download_backup', 20 * MB, 1),
+        run('download_backup', 90 * MB, 1, status='failed'),
+        run('download_backup', 90 * MB, 1, skipped=True),
+    ]
+    assert planner.stage_rate(records, 'download', 'plain') == (20 * MB, 3)
+    assert planner.stage_rate([], 'download', 'plain') == (None, 0)
+
+
+def test_stage_rate_only_the_last_runs():
+    records = [run('upload_backup', MB, 1)] * 5 + [run('upload_backup', 3 * MB, 1)] * 3
+    assert planner.stage_rate(records, 'upload', 'plain', limit=3) == (3 * MB, 3)
+
+
+def test_stage_rate_backup_by_format_and_project():
+    records = [
+        run('backup_prod', 100 * MB, 10, project='a'),
+        run('backup_prod', 40 * MB, 10, project='b'),
+        dict(run('backup_prod', 0, 10, format='directory'), bytes_out=50 * MB),
+    ]
+    # plain: SQL thô (bytes_in); archive: bytes_out
+    assert planner.stage_rate(records, 'backup', 'plain', project='a') == (10 * MB, 1)
+    assert planner.stage_rate(records, 'backup', 'directory') == (5 * MB, 1)
+
+
+def test_size_ratios():
+    backups = [
+        {'format': 'plain', 'size': 20, 'raw_size': 100, 'db_size': 200},
+        {'format': 'plain', 'size': 30, 'raw_size': None, 'db_size': 100},
+        {'format': 'custom', 'size': 50, 'db_size': 100},
+    ]
+    assert planner.size_ratios(backups, 'plain') == (0.5, 0.2, 2)
+    assert planner.size_ratios(backups, 'directory') == (None, None, 0)
+
+
+def test_estimate_stages_defaults_and_history():
+    records = [run('download_backup', 100 * MB, 10)]
+    stages = {s['stage']: s for s in planner.estimate_stages(300 * MB, 60 * MB, 'plain', records, default_rates={'upload': 20})}
+    assert stages['backup']['bytes'] == 300 * MB and stages['backup']['basis'] == 'default'
+    assert stages['backup']['seconds'] == 10.0
+    assert stages['download']['basis'] == 'history' and stages['download']['seconds'] == 6.0
+    assert stages['upload']['rate'] == 20 * MB and stages['upload']['seconds'] == 3.0
+    assert stages['restore']['bytes'] == 60 * MB
+
+
+def test_format_duration():
+    assert planner.format_duration(42.4) == '42s'
+    assert planner.format_duration(125) == '2m 05s'
+    assert planner.format_duration(3 * 3600 + 7 * 60) == '3h 07m'
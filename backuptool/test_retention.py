@@ -0,0 +1,110 @@
+"""Tests for retention.py (chạy: python -m pytest backuptool)."""
+import datetime
+
+import retention
+
+
+def backup(day, prefix='prod_pg', size=100, hour=0):
+    created = datetime.datetime(2026, 1, 1, hour) + datetime.timedelta(days=day)
+    return {
+        'filename': f"{prefix}_{created:%Y%m%d_%H%M%S}.sql.gz",
+        'prefix': prefix,
+        'created': created,
+        'size': size,
+    }
+
+
+def names(backups):
+    return {b['filename'] for b in backups}
+
+
+def policy(**rules):
+    return retention.policy_from_config(rules)
+
+
+def test_policy_from_config_keeps_the_newest_by_default():
+    assert retention.policy_from_config({}) is None
+    assert retention.policy_from_config({'daily': 7})['keep_last'] == 1
+
+
+def test_gfs_keep_keep_last_only():
+    backups = [backup(day) for day in range(10)]
+    assert retention.gfs_keep(backups, policy(keep_last=3)) == names(backups[-3:])
+
+
+def test_gfs_keep_newest_backup_of_each_day():
+    backups = [backup(day, hour=hour) for day in range(5) for hour in (1, 13)]
+    kept = retention.gfs_keep(backups, policy(daily=3))
+    # Bản mới nhất của 3 ngày gần nhất (keep_last=1 trùng với ngày cuối)
+    assert kept == names([backup(4, hour=13), backup(3, hour=13), backup(2, hour=13)])
+
+
+def test_gfs_keep_periods_without_backups_do_not_count():
+    backups = [backup(0), backup(1), backup(30)]
+    assert retention.gfs_keep(backups, policy(daily=3)) == names(backups)
+
+
+def test_gfs_keep_weekly_and_monthly():
+    backups = [backup(day) for day in range(0, 70)]
+    kept = retention.gfs_keep(backups, policy(weekly=2, monthly=3))
+    # 2026-03-11 là bản mới nhất; tuần trước kết thúc Chủ nhật 2026-03-08,
+    # tháng 2 và tháng 1 kết thúc ngày 28/02 và 31/01
+    assert kept == names([backup(69), backup(66), backup(58), backup(30)])
+
+
+def test_plan_retention_is_per_prefix():
+    prod = [backup(day) for day in range(4)]
+    erp = [backup(day, prefix='erp_pg') for day in range(2)]
+    doomed, over = retention.plan_retention(prod + erp, policy(keep_last=2))
+    assert [b['filename'] for b in doomed] == [b['filename'] for b in prod[:2]]
+    assert over == 0
+
+
+def test_plan_retention_without_policy_keeps_everything():
+    backups = [backup(day) for day in range(4)]
+    assert retention.plan_retention(backups) == ([], 0)
+
+
+def test_plan_retention_budget_drops_oldest_but_never_the_newest():
+    backups = [backup(day, size=100) for day in range(4)]
+    doomed, over = retention.plan_retention(backups, budget=150, need=100)
+    assert names(doomed) == names(backups[:3])
+    assert over == 50
+
+
+def test_plan_retention_budget_respects_can_drop():
+    backups = [backup(day, size=100) for day in range(4)]
+    only_copy = backups[0]['filename']
+    doomed, over = retention.plan_retention(
+        backups, budget=200, can_drop=lambda b: b['filename'] != only_copy,
+    )
+    assert names(doomed) == names(backups[1:3])
+    assert over == 0
+
+
+def test_make_room_nothing_needed():
+    assert retention.make_room([backup(0), backup(1)], 0) == ([], 0)
+
+
+def test_make_room_policy_drops_first():
+    backups = [backup(day, size=100) for day in range(5)]
+    chosen, freed = retention.make_room(backups, 50, policy(keep_last=2))
+    # Những bản policy không giữ đều bị xóa, dù đã đủ chỗ
+    assert names(chosen) == names(backups[:3])
+    assert freed == 300
+
+
+def test_make_room_oldest_first_and_keeps_the_newest():
+    backups = [backup(day, size=100) for day in range(3)]
+    chosen, freed = retention.make_room(backups, 150)
+    assert [b['filename'] for b in chosen] == [b['filename'] for b in backups[:2]]
+    assert freed == 200
+    chosen, freed = retention.make_room(backups, 1000)
+    assert freed == 200
+
+
+def test_make_room_respects_can_drop():
+    backups = [backup(day, size=100) for day in range(3)]
+    chosen, freed = retention.make_room(backups, 100, can_drop=lambda b: b is not backups[0])
+    assert chosen == [backups[1]]
+    assert freed == 100
@@ -0,0 +1,95 @@
+"""Tests for throttle.py (chạy: python -m pytest backuptool)."""
+import pytest
+
+import throttle
+
+MB = throttle.MB
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept += seconds
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(throttle.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(throttle.time, 'sleep', clock.sleep)
+    return clock
+
+
+def settings(**adaptive):
+    return throttle.throttle_settings({'throttle': {'max_mb_s': 8, 'adaptive': dict(enabled=True, **adaptive)}})
+
+
+def test_throttle_settings():
+    assert throttle.throttle_settings({}) is None
+    conf = throttle.throttle_settings({'throttle': {'max_mb_s': 2.5, 'nice': 10, 'ionice': 'best-effort:7'}})
+    assert conf['max_rate'] == 2.5 * MB and conf['adaptive'] is None
+    assert throttle.nice_command(conf) == 'nice -n 10 ionice -c 2 -n 7 '
+    assert throttle.nice_command(None) == ''
+    with pytest.raises(ValueError, match='ionice'):
+        throttle.throttle_settings({'throttle': {'ionice': 'sometimes'}})
+
+
+def test_rate_limiter_holds_the_rate(clock):
+    limiter = throttle.RateLimiter(rate=MB)
+    for _ in range(10):
+        limiter.acquire(MB // 2)
+    # 5 MB ở 1 MB/s, bucket khởi đầu rỗng: đúng 5 giây
+    assert clock.slept == pytest.approx(5.0)
+    assert limiter.waited == pytest.approx(5.0)
+
+
+def test_rate_limiter_burst_is_capped(clock):
+    limiter = throttle.RateLimiter(rate=MB, burst_seconds=0.25)
+    clock.now += 60
+    limiter.acquire(MB)
+    # Nghỉ 60 giây chỉ được tích tối đa 0.25 giây token
+    assert clock.slept == pytest.approx(0.75)
+
+
+def test_rate_limiter_unlimited(clock):
+    limiter = throttle.RateLimiter()
+    limiter.acquire(100 * MB)
+    assert clock.slept == 0
+
+
+def test_adaptive_controller_backs_off_and_recovers():
+    limiter = throttle.RateLimiter(rate=8 * MB)
+    controller = throttle.AdaptiveController(limiter, settings(max_rtt_ms=200, min_mb_s=1), probe=None, measured=lambda: 0)
+    controller.adjust(0.5, None)
+    assert limiter.rate == 4 * MB and controller.backoffs == 1 and controller.last_reason.startswith('RTT')
+    for _ in range(3):
+        controller.adjust(0.5, None)
+    assert limiter.rate == 1 * MB  # không xuống dưới min_mb_s
+    for _ in range(20):
+        controller.adjust(0.01, 0.1)
+    assert limiter.rate == 8 * MB  # tăng lại nhưng không vượt max_mb_s
+    assert controller.lowest == 1 * MB
+
+
+def test_adaptive_controller_load_and_baseline_rtt():
+    limiter = throttle.RateLimiter(rate=None)
+    conf = throttle.throttle_settings({'throttle': {'adaptive': {'enabled': True, 'max_load_per_cpu': 1.0}}})
+    controller = throttle.AdaptiveController(limiter, conf, probe=None, measured=lambda: 10 * MB)
+    controller.adjust(0.02, 0.5)
+    assert limiter.rate is None
+    # RTT gấp > rtt_factor lần mốc thấp nhất đã thấy
+    controller.adjust(0.1, 0.5)
+    assert limiter.rate == 5 * MB
+    controller.adjust(0.02, 2.5)
+    assert limiter.rate == 2.5 * MB and controller.last_reason == 'load 2.50/CPU'
+    # Không có trần: khi đã vượt xa tốc độ thực tế thì bỏ giới hạn
+    controller.measured = lambda: 1 * MB
+    controller.adjust(0.02, 0.1)
+    assert limiter.rate is None
@@ -0,0 +1,175 @@
+"""Bandwidth caps and adaptive rate control for transfers under production load.
+
+Each environment may carry a ``throttle`` block::
+
+    {'max_mb_s': 20, 'nice': 10, 'ionice': 'idle',
+     'adaptive': {'enabled': True, 'min_mb_s': 2, 'max_rtt_ms': 250,
+                  'rtt_factor': 3.0, 'max_load_per_cpu': 1.0, 'interval_s': 5}}
+
+``RateLimiter`` is a token bucket shared by all streams of one transfer.
+``AdaptiveController`` probes the server every ``interval_s`` (SSH round trip
+time and load average, through a callable supplied by the caller) and halves
+the rate while either is too high, then grows it again by a quarter per quiet
+probe, up to ``max_mb_s`` (multiplicative decrease, gentle increase).
+"""
+import threading
+import time
+
+MB = 1024 * 1024
+ADAPTIVE_DEFAULTS = {
+    'enabled': False,
+    'min_mb_s': 1,
+    'max_rtt_ms': None,
+    'rtt_factor': 3.0,
+    'max_load_per_cpu': 1.0,
+    'interval_s': 5,
+}
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+BACKOFF_FACTOR = 0.5
+RECOVERY_FACTOR = 1.25
+
+
+def throttle_settings(conf):
+    """Normalise the ``throttle`` block of an environment; None when nothing is set.
+
+    Raises ValueError for an unknown ``ionice`` class.
+    """
+    block = dict(conf.get('throttle') or {})
+    adaptive = dict(ADAPTIVE_DEFAULTS)
+    adaptive.update(block.get('adaptive') or {})
+    ionice = block.get('ionice')
+    if ionice and str(ionice).partition(':')[0] not in IONICE_CLASSES:
+        raise ValueError(f"unknown ionice class '{ionice}' (use {', '.join(IONICE_CLASSES)}, optionally ':<level>')")
+    settings = {
+        'max_rate': float(block['max_mb_s']) * MB if block.get('max_mb_s') else None,
+        'nice': block.get('nice'),
+        'ionice': ionice,
+        'adaptive': adaptive if adaptive['enabled'] else None,
+    }
+    if settings['max_rate'] is None and settings['adaptive'] is None and settings['nice'] is None and not settings['ionice']:
+        return None
+    return settings
+
+
+def nice_command(settings):
+    """``nice -n N ionice -c C [-n L] `` prefix for the remote dump pipeline ('' when not set)."""
+    if not settings:
+        return ''
+    parts = []
+    if settings['nice'] is not None:
+        parts.append(f"nice -n {int(settings['nice'])}")
+    if settings['ionice']:
+        # "idle" / "best-effort" / "best-effort:7"
+        name, _, level = str(settings['ionice']).partition(':')
+        parts.append(f"ionice -c {IONICE_CLASSES[name]}" + (f" -n {int(level)}" if level else ''))
+    return ''.join(part + ' ' for part in parts)
+
+
+class RateLimiter:
+    """Token bucket: ``acquire(n)`` blocks until ``n`` more bytes fit under ``rate`` bytes/s.
+
+    ``rate`` None means unlimited; it can be changed while transfers run.
+    """
+
+    def __init__(self, rate=None, burst_seconds=0.25):
+        self.rate = rate
+        self.burst_seconds = burst_seconds
+        self.waited = 0.0
+        self._allowance = 0.0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, num_bytes):
+        with self._lock:
+            now = time.monotonic()
+            rate = self.rate
+            if not rate:
+                self._last = now
+                return
+            # Tích lũy token theo thời gian, tối đa burst_seconds để không bùng nổ sau khi nghỉ
+            self._allowance = min(self._allowance + (now - self._last) * rate, rate * self.burst_seconds)
+            self._last = now
+            self._allowance -= num_bytes
+            delay = -self._allowance / rate if self._allowance < 0 else 0.0
+            self.waited += delay
+        if delay:
+            time.sleep(delay)
+
+
+class AdaptiveController:
+    """Background thread adjusting a ``RateLimiter`` from server probes.
+
+    ``probe()`` returns ``(rtt_seconds, load_per_cpu)`` (either may be None).
+    ``measured()`` returns the current throughput in bytes/s; it seeds the
+    rate at the first backoff when there is no ``max_rate``.
+    """
+
+    def __init__(self, limiter, settings, probe, measured):
+        self.limiter = limiter
+        self.max_rate = settings['max_rate']
+        self.conf = settings['adaptive']
+        self.min_rate = float(self.conf['min_mb_s']) * MB
+        self.probe = probe
+        self.measured = measured
+        self.baseline_rtt = None
+        self.backoffs = 0
+        self.lowest = limiter.rate
+        self.last_reason = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        # RTT lúc đường truyền còn rảnh làm mốc so sánh
+        try:
+            self.baseline_rtt = self.probe()[0]
+        except Exception:
+            pass
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        interval = float(self.conf['interval_s'])
+        while not self._stop.wait(interval):
+            try:
+                rtt, load = self.probe()
+            except Exception:
+                # Probe lỗi (kênh bận, server không có /proc) -> giữ nguyên tốc độ
+                continue
+            self.adjust(rtt, load)
+
+    def congested(self, rtt, load):
+        """Reason to back off for one probe result, or None."""
+        if rtt is not None:
+            if self.baseline_rtt is None or rtt < self.baseline_rtt:
+                self.baseline_rtt = rtt
+            if self.conf['max_rtt_ms'] and rtt * 1000 > float(self.conf['max_rtt_ms']):
+                return f"RTT {rtt * 1000:.0f} ms"
+            if self.conf['rtt_factor'] and rtt > self.baseline_rtt * float(self.conf['rtt_factor']) and rtt > 0.01:
+                return f"RTT {rtt * 1000:.0f} ms (baseline {self.baseline_rtt * 1000:.0f} ms)"
+        if load is not None and self.conf['max_load_per_cpu'] and load > float(self.conf['max_load_per_cpu']):
+            return f"load {load:.2f}/CPU"
+        return None
+
+    def adjust(self, rtt, load):
+        reason = self.congested(rtt, load)
+        rate = self.limiter.rate
+        if reason:
+            current = rate or self.measured() or self.max_rate
+            if not current:
+                return
+            rate = max(current * BACKOFF_FACTOR, self.min_rate)
+            self.backoffs += 1
+            self.last_reason = reason
+            self.lowest = rate if self.lowest is None else min(self.lowest, rate)
+        elif rate is not None:
+            rate *= RECOVERY_FACTOR
+            if self.max_rate is not None:
+                rate = min(rate, self.max_rate)
+            elif rate > (self.measured() or 0) * 2:
+                # Không có trần cấu hình và đã vượt xa tốc độ thực tế -> bỏ giới hạn
+                rate = None
+        self.limiter.rate = rate
@@ -0,0 +1,210 @@
+"""Loopback SSH + SFTP server standing in for Production / Staging in the benchmarks.
+
+Commands received over ``exec`` run through the local ``bash``; the SFTP
+subsystem serves the local filesystem. Any key / password is accepted, so
+never expose it beyond 127.0.0.1.
+"""
+import logging
+import os
+import socket
+import subprocess
+import threading
+
+import paramiko
+from paramiko import SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface, SFTP_OK
+
+# Client ngắt kết nối khi xong việc -> không in "Socket exception" ra stderr
+logging.getLogger('paramiko').addHandler(logging.NullHandler())
+
+
+class _Handle(SFTPHandle):
+    def chattr(self, attr):
+        try:
+            if attr.st_size is not None:
+                os.ftruncate(self.writefile.fileno(), attr.st_size)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+
+class _LocalSFTP(SFTPServerInterface):
+    def list_folder(self, path):
+        try:
+            out = []
+            for name in os.listdir(path):
+                attr = SFTPAttributes.from_stat(os.stat(os.path.join(path, name)))
+                attr.filename = name
+                out.append(attr)
+            return out
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags, 0o644)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        f = os.fdopen(fd, mode)
+        handle = _Handle(flags)
+        handle.filename = path
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(oldpath, newpath)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    posix_rename = rename
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(path)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            if attr.st_size is not None:
+                os.truncate(path, attr.st_size)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def canonicalize(self, path):
+        return os.path.normpath(os.path.join('/', path))
+
+
+class _Server(paramiko.ServerInterface):
+    def __init__(self):
+        self.exec_requests = []
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def get_allowed_auths(self, username):
+        return 'publickey,password'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=_run_exec, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_env_request(self, channel, name, value):
+        return True
+
+
+def _pump(src, write):
+    for block in iter(lambda: src.read1(65536), b''):
+        write(block)
+
+
+def _run_exec(channel, command):
+    proc = subprocess.Popen(['bash', '-c', command], stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    err = threading.Thread(target=_pump, args=(proc.stderr, channel.sendall_stderr), daemon=True)
+    err.start()
+
+    def feed():
+        try:
+            while True:
+                data = channel.recv(65536)
+                if not data:
+                    break
+                proc.stdin.write(data)
+        except (OSError, EOFError):
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+    threading.Thread(target=feed, daemon=True).start()
+    try:
+        _pump(proc.stdout, channel.sendall)
+    except OSError:
+        proc.kill()
+    proc.wait()
+    err.join()
+    channel.send_exit_status(proc.returncode)
+    channel.shutdown_write()
+    channel.close()
+
+
+class LoopbackSSHServer:
+    """Threaded SSH server on 127.0.0.1; use ``with`` or ``start()``/``stop()``."""
+
+    def __init__(self, host_key_path):
+        if not os.path.exists(host_key_path):
+            paramiko.RSAKey.generate(2048).write_private_key_file(host_key_path)
+        self.host_key = paramiko.RSAKey.from_private_key_file(host_key_path)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self._stop = False
+
+    def start(self):
+        self.sock.listen(16)
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        return self
+
+    def _accept_loop(self):
+        while not self._stop:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                break
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', SFTPServer, _LocalSFTP)
+            transport.start_server(server=_Server())
+
+    def stop(self):
+        self._stop = True
+        self.sock.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
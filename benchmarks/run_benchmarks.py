@@ -0,0 +1,309 @@
+"""Throughput benchmarks for backuptool and logtool using local stand-ins.
+
+The real command line tools run against a loopback SSH/SFTP server
+(``loopback_ssh.py``) with fake ``pg_dump`` / ``psql`` scripts on the PATH
+(``fake_bin/``), so no database or remote server is needed.  Every stage is
+run as its own process and measured with ``wait4``:
+
+    backup[<codec>]         pg_dump | compressor on "Production"
+    download                Production -> local backup_dir
+    upload                  local backup_dir -> "Staging"
+    restore                 decompressor | psql on "Staging"
+    restore_local[native]   local decompressor | psql over OS pipes
+    restore_local[python]   local in-process decompress -> psql
+    logs                    log_downloader.py over a synthetic log directory
+
+Results (wall time, MB/s, peak RSS, CPU) are written to a JSON file that
+``--compare`` can diff against a later run.  POSIX only (uses bash, ``dd``
+and the ``resource`` module).
+
+Usage:
+    python benchmarks/run_benchmarks.py --size-mb 64
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/<old>.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import paramiko
+import yaml
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'backuptool'))
+
+from backup_restore import COMPRESSION_CODECS, _filename_for_format  # noqa: E402
+from loopback_ssh import LoopbackSSHServer  # noqa: E402
+
+BACKUP_SCRIPT = os.path.join(REPO_DIR, 'backuptool', 'backup_restore.py')
+LOG_SCRIPT = os.path.join(REPO_DIR, 'logtool', 'log_downloader.py')
+FAKE_BIN = os.path.join(BENCH_DIR, 'fake_bin')
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+MB = 1024 * 1024
+
+
+def _maxrss_mb(ru_maxrss):
+    # Linux trả về KB, macOS trả về bytes
+    if sys.platform == 'darwin':
+        return ru_maxrss / MB
+    return ru_maxrss / 1024
+
+
+def run_stage(name, cmd, bytes_processed, log_path, extra=None):
+    """Run one stage as a child process and return its measurements.
+
+    ``cpu_client_s`` covers the tool process (and local children such as
+    ``psql``); ``cpu_server_s`` is what the loopback server spent running the
+    remote side of the stage (``pg_dump``, compressors, ``psql``...).
+    """
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    with open(log_path, 'ab') as log:
+        log.write(f"\n===== {name}: {' '.join(cmd)}\n".encode())
+        log.flush()
+        proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, cwd=REPO_DIR)
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.perf_counter() - start
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    cpu_client = usage.ru_utime + usage.ru_stime
+    cpu_children = (children_after.ru_utime + children_after.ru_stime) - (children_before.ru_utime + children_before.ru_stime)
+    result = {
+        'stage': name,
+        'ok': proc.returncode == 0,
+        'exit_code': proc.returncode,
+        'wall_s': round(wall, 3),
+        'bytes': bytes_processed,
+        'mb_per_s': round(bytes_processed / MB / wall, 2) if wall > 0 else 0,
+        'peak_rss_mb': round(_maxrss_mb(usage.ru_maxrss), 1),
+        'cpu_client_s': round(cpu_client, 3),
+        'cpu_server_s': round(max(cpu_children - cpu_client, 0), 3),
+    }
+    result.update(extra or {})
+    status_text = 'ok' if result['ok'] else f"FAILED ({proc.returncode}, see {log_path})"
+    print(
+        f"  {name:<21} {result['wall_s']:>8.2f}s {result['mb_per_s']:>9.1f} MB/s "
+        f"rss {result['peak_rss_mb']:>7.1f} MB  cpu {cpu_client:.2f}s + {result['cpu_server_s']:.2f}s  {status_text}"
+    )
+    return result
+
+
+def available_codecs():
+    """Codecs whose command line tool is installed (gzip always is)."""
+    return [codec for codec in COMPRESSION_CODECS if shutil.which(codec)]
+
+
+def make_logs(log_dir, files, size_mb):
+    """Create rotated logs ``app.log.1`` .. ``app.log.N`` plus an active ``app.log``."""
+    os.makedirs(log_dir, exist_ok=True)
+    line = b"2026-01-01 00:00:00,000 INFO [worker-1] request handled path=/api/v1/messages status=200 ms=12\n"
+    block = line * (MB // len(line))
+    total = 0
+    for index in range(files + 1):
+        name = 'app.log' if index == 0 else f'app.log.{index}'
+        with open(os.path.join(log_dir, name), 'wb') as f:
+            for _ in range(max(int(size_mb), 1)):
+                f.write(block)
+        if index:
+            total += os.path.getsize(os.path.join(log_dir, name))
+    return total
+
+
+def raw_dump_size(env):
+    """Byte count the fake pg_dump emits for the configured size."""
+    proc = subprocess.Popen([os.path.join(FAKE_BIN, 'pg_dump')], stdout=subprocess.PIPE, env=env)
+    size = 0
+    for block in iter(lambda: proc.stdout.read(MB), b''):
+        size += len(block)
+    proc.wait()
+    return size
+
+
+def write_config(path, port, client_key, work_dir, codec, streams, chunk_mb):
+    server = {
+        'host': '127.0.0.1',
+        'port': port,
+        'user': 'bench',
+        'ssh_key_path': client_key,
+        'docker_container': '',
+        'db_user': 'bench',
+        'db_name': 'bench',
+        'db_password': 'bench',
+        'compression': {'codec': codec},
+        'transfer': {'streams': streams, 'chunk_mb': chunk_mb},
+    }
+    staging = dict(server, remote_dir=os.path.join(work_dir, 'staging'))
+    config = {
+        'production': server,
+        'staging': staging,
+        'local': {
+            'backup_dir': os.path.join(work_dir, 'local'),
+            'backup_filename': 'bench_backup.sql.gz',
+            'host': 'localhost',
+            'port': 5432,
+            'db_user': 'bench',
+            'db_name': 'bench',
+            'db_password': 'bench',
+        },
+    }
+    with open(path, 'w') as f:
+        yaml.safe_dump(config, f)
+
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix='backuptool_bench_')
+    os.makedirs(os.path.join(work_dir, 'staging'))
+    log_path = os.path.join(work_dir, 'bench.log')
+    client_key = os.path.join(work_dir, 'client_key')
+    paramiko.RSAKey.generate(2048).write_private_key_file(client_key)
+
+    # Server loopback chạy lệnh bằng bash với PATH/ENV của process này
+    os.environ['PATH'] = FAKE_BIN + os.pathsep + os.environ['PATH']
+    os.environ['BENCH_DUMP_MB'] = str(args.size_mb)
+    server = LoopbackSSHServer(os.path.join(work_dir, 'host_key')).start()
+
+    codecs = args.codecs or available_codecs()
+    raw_size = raw_dump_size(os.environ)
+    print(f"Synthetic dump: {raw_size / MB:.1f} MB, codecs: {', '.join(codecs)}, work dir: {work_dir}")
+
+    results = []
+    prod_files = []
+    stamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    try:
+        for codec in codecs:
+            config_path = os.path.join(work_dir, f'config_{codec}.yaml')
+            write_config(config_path, server.port, client_key, work_dir, codec, args.streams, args.chunk_mb)
+            filename = _filename_for_format(f'bench_{os.getpid()}_{stamp}.sql.gz', 'plain', codec)
+            remote_path = f'/tmp/{filename}'
+            prod_files.append(remote_path)
+            cli = [sys.executable, BACKUP_SCRIPT, '--config', config_path, '--file', filename]
+
+            result = run_stage(f'backup[{codec}]', cli[:2] + ['backup'] + cli[2:], raw_size, log_path)
+            if not result['ok']:
+                results.append(result)
+                continue
+            packed = os.path.getsize(remote_path)
+            result['compressed_bytes'] = packed
+            result['ratio'] = round(raw_size / packed, 2) if packed else 0
+            results.append(result)
+
+            # Transfer / restore chỉ đo một lần với codec đầu tiên
+            if codec != codecs[0]:
+                continue
+            results.append(run_stage('download', cli[:2] + ['download'] + cli[2:], packed, log_path))
+            results.append(run_stage('upload', cli[:2] + ['upload'] + cli[2:], packed, log_path))
+            results.append(run_stage('restore', cli[:2] + ['restore'] + cli[2:], raw_size, log_path, {'codec': codec}))
+            for pipe in ('native', 'python'):
+                results.append(run_stage(f'restore_local[{pipe}]', cli[:2] + ['restore_local'] + cli[2:] + ['--pipe', pipe],
+                                         raw_size, log_path, {'codec': codec}))
+
+        if args.log_files:
+            remote_logs = os.path.join(work_dir, 'remote_logs')
+            total = make_logs(remote_logs, args.log_files, args.log_size_mb)
+            log_config = os.path.join(work_dir, 'logtool.yaml')
+            with open(log_config, 'w') as f:
+                yaml.safe_dump({
+                    'server': {'host': '127.0.0.1', 'port': server.port, 'user': 'bench', 'ssh_key_path': client_key},
+                    'logs': {
+                        'remote_path': remote_logs,
+                        'local_path': os.path.join(work_dir, 'logs'),
+                        'import_patterns': [f'*.log.{i}' for i in range(1, args.log_files + 1)],
+                    },
+                    'settings': {'after_download': 'keep'},
+                }, f)
+            results.append(run_stage('logs', [sys.executable, LOG_SCRIPT, '--config', log_config], total, log_path,
+                                     {'files': args.log_files}))
+    finally:
+        server.stop()
+        for path in prod_files:
+            for leftover in (path, os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.stat')):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'git_commit': _git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'size_mb': args.size_mb,
+            'raw_bytes': raw_size,
+            'streams': args.streams,
+            'chunk_mb': args.chunk_mb,
+        },
+        'results': results,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f'bench_{stamp}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.keep:
+        print(f"Work dir kept: {work_dir}")
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline_path, report):
+    """Print MB/s, wall time and peak RSS of ``report`` relative to a previous run."""
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+    before = {r['stage']: r for r in baseline['results']}
+    if baseline['meta'].get('raw_bytes') != report['meta']['raw_bytes']:
+        print(f"\nWarning: baseline used a {baseline['meta'].get('size_mb')} MB dump, this run {report['meta']['size_mb']} MB.")
+    print(f"\nCompared with {baseline_path} ({baseline['meta'].get('git_commit')}, {baseline['meta'].get('timestamp')}):")
+    for result in report['results']:
+        old = before.get(result['stage'])
+        if not old or not old.get('mb_per_s'):
+            print(f"  {result['stage']:<21} (no baseline)")
+            continue
+        speed = (result['mb_per_s'] - old['mb_per_s']) / old['mb_per_s'] * 100
+        rss = result['peak_rss_mb'] - old['peak_rss_mb']
+        print(
+            f"  {result['stage']:<21} {old['mb_per_s']:>9.1f} -> {result['mb_per_s']:>9.1f} MB/s ({speed:+.1f}%), "
+            f"wall {old['wall_s']:.2f}s -> {result['wall_s']:.2f}s, rss {rss:+.1f} MB"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark backuptool / logtool stages against local stand-ins")
+    parser.add_argument('--size-mb', type=float, default=64, help="Size of the synthetic SQL dump (default 64)")
+    parser.add_argument('--codecs', nargs='+', choices=list(COMPRESSION_CODECS), help="Codecs to benchmark (default: all installed)")
+    parser.add_argument('--streams', type=int, default=4, help="SFTP streams for download/upload (default 4)")
+    parser.add_argument('--chunk-mb', type=float, default=8, help="Transfer range size in MB (default 8)")
+    parser.add_argument('--log-files', type=int, default=5, help="Rotated log files for the logtool stage (0 = skip)")
+    parser.add_argument('--log-size-mb', type=float, default=8, help="Size of each synthetic log file")
+    parser.add_argument('--output', help="Result JSON path (default benchmarks/results/bench_<timestamp>.json)")
+    parser.add_argument('--compare', help="Previous result JSON to compare against")
+    parser.add_argument('--keep', action='store_true', help="Keep the temporary work dir (configs, bench.log)")
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.compare:
+        compare(args.compare, report)
+    if not all(r['ok'] for r in report['results']):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
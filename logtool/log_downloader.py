@@ -3,6 +3,18 @@ import yaml
 import os
 import sys
 import datetime
+import json
+import time
+import fnmatch
+import hashlib
+import shlex
+import subprocess
+import zlib
+import re
+import stat
+import queue
+import threading
+import paramiko
 from fabric import Connection
 
 # Vietnamese comment: Load configuration
@@ -39,9 +51,313 @@ def get_connection(server_config):
         connect_kwargs=connect_kwargs
     )
 
+# Giá trị label Prometheus: escape \, " và xuống dòng (giống backuptool/metrics.py)
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# Vietnamese comment: Ghi metrics dạng JSON lines (mỗi file 1 dòng + 1 dòng tổng kết)
+class Metrics:
+    def __init__(self, metrics_conf, local_dir):
+        metrics_conf = metrics_conf or {}
+        enabled = metrics_conf.get('enabled', True)
+        self.jsonl_path = metrics_conf.get('jsonl', os.path.join(local_dir, 'metrics.jsonl')) if enabled else None
+        self.textfile_path = metrics_conf.get('prometheus_textfile') if enabled else None
+        self.labels = metrics_conf.get('labels') or {}
+
+    def emit(self, record):
+        if not self.jsonl_path:
+            return
+        record = dict(self.labels, **record)
+        try:
+            with open(self.jsonl_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        except OSError as e:
+            print(f"  [METRICS] Warning: cannot write {self.jsonl_path}: {e}")
+
+    def write_textfile(self, summary):
+        """Gauges of the last run for the node_exporter textfile collector."""
+        if not self.textfile_path:
+            return
+        labels = ','.join(f'{k}="{_escape(v)}"' for k, v in sorted(self.labels.items()))
+        gauges = [
+            ('logtool_run_duration_seconds', 'duration_s', 'Duration of the last run.'),
+            ('logtool_last_run_timestamp_seconds', 'end_ts', 'Unix time the last run finished.'),
+            ('logtool_success', 'success', '1 if the last run had no errors.'),
+            ('logtool_files_downloaded', 'files_downloaded', 'Files downloaded in the last run.'),
+            ('logtool_files_failed', 'files_failed', 'Files that failed in the last run.'),
+            ('logtool_bytes_downloaded', 'bytes_in', 'Bytes downloaded in the last run.'),
+            ('logtool_throughput_bytes_per_second', 'throughput_bytes_per_s', 'Download throughput of the last run.'),
+        ]
+        lines = []
+        for name, field, help_text in gauges:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name}{{{labels}}} {summary[field]}")
+        try:
+            with open(self.textfile_path + '.tmp', 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(self.textfile_path + '.tmp', self.textfile_path)
+        except OSError as e:
+            print(f"  [METRICS] Warning: cannot write {self.textfile_path}: {e}")
+
+DEFAULT_CONCURRENCY = 4
+STATE_FILENAME = '.sync_state.json'
+
+# Vietnamese comment: Liệt kê thư mục trên server 1 lần (tên, kích thước, mtime)
+def list_remote(sftp, remote_dir):
+    """Regular files of ``remote_dir`` as ``{name: {'size':..., 'mtime':...}}`` from one SFTP listing."""
+    return {
+        entry.filename: {'size': entry.st_size, 'mtime': int(entry.st_mtime)}
+        for entry in sftp.listdir_attr(remote_dir)
+        if stat.S_ISREG(entry.st_mode or 0)
+    }
+
+def compile_patterns(patterns):
+    """Shell-style globs (``*.log.[0-9]``); entries starting with ``re:`` are regular
+    expressions matched against the whole name (``re:.*\\.log\\.[0-9]+``)."""
+    return [re.compile(p[3:]) if p.startswith('re:') else re.compile(fnmatch.translate(p)) for p in patterns]
+
+def matches(name, compiled):
+    return any(regex.fullmatch(name) for regex in compiled)
+
+# Vietnamese comment: File trạng thái: những file đã tải (tên + size + mtime) để lần sau không cần hỏi lại server
+def load_state(path, remote_dir):
+    try:
+        with open(path, 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    # State của thư mục khác (đổi remote_path) thì bỏ
+    return state.get('files', {}) if state.get('remote_path') == remote_dir else {}
+
+def save_state(path, remote_dir, files):
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'remote_path': remote_dir, 'files': files}, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+# Nén trên server khi tải: (lệnh nén, đuôi file local)
+COMPRESSORS = {
+    'gzip': ('gzip -c', '.gz'),
+    'zstd': ('zstd -c -q', '.zst'),
+}
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+class RawVerifier:
+    """Decompress a gzip / zstd stream on the fly and hash the original content.
+
+    zstd uses the optional ``zstandard`` package when installed, otherwise
+    the ``zstd`` command line tool.
+    """
+
+    def __init__(self, codec):
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self._proc = None
+        if codec == 'gzip':
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            return
+        try:
+            import zstandard
+            self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+        except ImportError:
+            self._decompressor = None
+            self._proc = subprocess.Popen(['zstd', '-dc', '-q'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self._reader = threading.Thread(target=self._read_proc, daemon=True)
+            self._reader.start()
+
+    def _update(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+
+    def _read_proc(self):
+        for block in iter(lambda: self._proc.stdout.read(STREAM_CHUNK_SIZE), b''):
+            self._update(block)
+
+    def feed(self, data):
+        if self._proc is not None:
+            self._proc.stdin.write(data)
+        else:
+            self._update(self._decompressor.decompress(data))
+
+    def finish(self):
+        """``(raw size, sha256 hex)`` of everything fed."""
+        if self._proc is not None:
+            self._proc.stdin.close()
+            self._reader.join()
+            if self._proc.wait() != 0:
+                raise IOError("zstd -d failed on the received data")
+        elif hasattr(self._decompressor, 'flush'):
+            self._update(self._decompressor.flush())
+        return self.size, self.digest.hexdigest()
+
+def fetch_compressed(sftp, remote_file, part_file, codec, level=None):
+    """Stream ``remote_file`` compressed on the server into ``part_file``.
+
+    The server prints the file's SHA-256 (stderr) before compressing it to
+    stdout; the stream is decompressed locally while it is written and the
+    content compared with that digest. Returns ``(compressed, raw)`` sizes.
+    """
+    command, _ = COMPRESSORS[codec]
+    level = f" -{int(level)}" if level else ''
+    path = shlex.quote(remote_file)
+    channel = sftp.get_channel().get_transport().open_session()
+    try:
+        channel.exec_command(f"sha256sum -- {path} >&2 && {command}{level} -- {path}")
+        verifier = RawVerifier(codec)
+        compressed = 0
+        with open(part_file, 'wb') as f:
+            for data in iter(lambda: channel.recv(STREAM_CHUNK_SIZE), b''):
+                f.write(data)
+                verifier.feed(data)
+                compressed += len(data)
+        status = channel.recv_exit_status()
+        errors = b''
+        while channel.recv_stderr_ready():
+            errors += channel.recv_stderr(STREAM_CHUNK_SIZE)
+    finally:
+        channel.close()
+    errors = errors.decode(errors='replace')
+    if status != 0:
+        raise IOError(f"remote {command.split()[0]} exited with code {status}: {errors.strip()}")
+    raw_size, digest = verifier.finish()
+    expected = errors.split()[0] if errors.split() else None
+    if digest != expected:
+        raise IOError(f"content check failed: server SHA-256 {expected}, received {digest} ({raw_size} bytes)")
+    return compressed, raw_size
+
+def local_name(filename, mtime):
+    """``name.<YYYYmmdd_HHMMSS of the remote mtime>``."""
+    return f"{filename}.{datetime.datetime.fromtimestamp(mtime).strftime('%Y%m%d_%H%M%S')}"
+
+# Vietnamese comment: Xử lý 1 file: tải về (bỏ qua nếu đã có), xóa trên server nếu config yêu cầu
+def process_file(sftp, remote_dir, filename, info, local_dir, settings, run_id, fetched=False):
+    """Download one rotated log as ``name.<mtime>`` over ``sftp`` and return its metrics record.
+
+    ``info`` is the file's listing entry (size, mtime); ``fetched`` means the
+    sync state already has this exact file. The file is written to ``.part``
+    and renamed once its size matches the listing, so an interrupted
+    download is never taken for a finished one. With ``settings.compress``
+    the file is compressed on the server while it streams, stored
+    compressed, and its content checked against the server's SHA-256 first.
+    """
+    remote_file = f"{remote_dir}/{filename}"
+    codec = settings.get('compress')
+    # New local filename: name.timestamp (mtime on the server), + .gz / .zst when compressed
+    plain_filename = local_name(filename, info['mtime'])
+    local_filename = plain_filename + (COMPRESSORS[codec][1] if codec else '')
+    local_file = os.path.join(local_dir, local_filename)
+    file_start = time.time()
+    record = {'stage': 'download_log', 'run_id': run_id, 'file': filename, 'status': 'failed', 'bytes_in': 0, 'deleted': False}
+    try:
+        if not fetched and not os.path.exists(local_file) and os.path.exists(os.path.join(local_dir, plain_filename)):
+            # Bản không nén từ lần chạy trước (trước khi bật compress)
+            local_filename, local_file = plain_filename, os.path.join(local_dir, plain_filename)
+        if fetched or os.path.exists(local_file):
+            print(f"  [SKIP] {'Already fetched' if fetched else 'File exists'}: {local_filename}")
+            # Same name = same file and same mtime, already backed up
+            record['status'] = 'skipped'
+            if settings.get('after_download') == 'delete':
+                print(f"  [DELETE] Removing remote file {filename} (already backed up)...")
+                sftp.remove(remote_file)
+                record['deleted'] = True
+            return record
+
+        print(f"Downloading {filename} as {local_filename}...")
+        part_file = local_file + '.part'
+        if codec:
+            try:
+                size, raw_size = fetch_compressed(sftp, remote_file, part_file, codec, settings.get('compress_level'))
+            except Exception:
+                if os.path.exists(part_file):
+                    os.remove(part_file)
+                raise
+            record['raw_bytes'] = raw_size
+        else:
+            sftp.get(remote_file, part_file)
+            size = raw_size = os.path.getsize(part_file)
+        if raw_size != info['size']:
+            os.remove(part_file)
+            raise IOError(f"incomplete download: {raw_size} of {info['size']} bytes")
+        os.replace(part_file, local_file)
+        record['status'] = 'downloaded'
+        record['bytes_in'] = size
+        if codec:
+            print(f"  [OK] Downloaded to {local_file} ({raw_size} -> {size} bytes, {codec}, content verified)")
+        else:
+            print(f"  [OK] Downloaded to {local_file}")
+        if settings.get('after_download') == 'delete':
+            # Vietnamese comment: Xóa file sau khi tải xong nếu config cho phép
+            print(f"  [DELETE] Removing remote file {filename}...")
+            sftp.remove(remote_file)
+            record['deleted'] = True
+    except Exception as e:
+        print(f"  [ERROR] Failed to process {filename}: {e}")
+        record['error'] = str(e)
+    finally:
+        record['local_file'] = local_filename if record['status'] != 'failed' else None
+        record['duration_s'] = round(time.time() - file_start, 3)
+        if record['bytes_in'] and record['duration_s'] > 0:
+            record['throughput_bytes_per_s'] = round(record['bytes_in'] / record['duration_s'], 1)
+    return record
+
+# Vietnamese comment: Tải nhiều file song song, mỗi worker 1 SFTP channel trên cùng 1 kết nối SSH
+def download_files(conn, remote_dir, files, local_dir, settings, run_id, on_record, concurrency, fetched=()):
+    """Run ``process_file`` for ``files`` (name -> listing entry) on ``concurrency`` SFTP channels of ``conn``.
+
+    ``on_record(record)`` is called (under a lock) as each file finishes.
+    A worker that cannot open its channel (e.g. above sshd's ``MaxSessions``)
+    leaves its files to the others; files no worker could take are recorded
+    as failed. Returns the number of channels that worked.
+    """
+    filenames = list(files)
+    conn.open()
+    transport = conn.client.get_transport()
+    pending = queue.Queue()
+    for filename in filenames:
+        pending.put(filename)
+    lock = threading.Lock()
+    channel_errors = []
+
+    def worker():
+        try:
+            sftp = paramiko.SFTPClient.from_transport(transport)
+        except Exception as e:
+            with lock:
+                channel_errors.append(str(e) or type(e).__name__)
+            return
+        try:
+            while True:
+                try:
+                    filename = pending.get_nowait()
+                except queue.Empty:
+                    return
+                record = process_file(sftp, remote_dir, filename, files[filename], local_dir, settings, run_id,
+                                      fetched=filename in fetched)
+                with lock:
+                    on_record(record)
+        finally:
+            sftp.close()
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(min(concurrency, len(filenames)), 1))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    opened = len(threads) - len(channel_errors)
+    if channel_errors:
+        print(f"  [WARN] {len(channel_errors)} of {len(threads)} SFTP channel(s) could not be opened: {channel_errors[0]}")
+    # Không còn worker nào chạy -> file còn lại trong hàng đợi tính là lỗi
+    while not pending.empty():
+        filename = pending.get_nowait()
+        print(f"  [ERROR] Failed to process {filename}: no SFTP channel available")
+        on_record({'stage': 'download_log', 'run_id': run_id, 'file': filename, 'status': 'failed', 'bytes_in': 0,
+                   'deleted': False, 'error': f"no SFTP channel: {channel_errors[0]}", 'local_file': None, 'duration_s': 0})
+    return opened
+
 def main():
     parser = argparse.ArgumentParser(description="Log Downloader Tool")
     parser.add_argument('--config', help="Path to config file")
+    parser.add_argument('--concurrency', type=int, help="Files downloaded at the same time (default: settings.concurrency or 4)")
     args = parser.parse_args()
 
     config = load_config(args.config)
@@ -49,6 +365,10 @@ def main():
     server_conf = config['server']
     log_conf = config['logs']
     settings = config.get('settings', {})
+    concurrency = max(int(args.concurrency or settings.get('concurrency') or DEFAULT_CONCURRENCY), 1)
+    if settings.get('compress') and settings['compress'] not in COMPRESSORS:
+        print(f"Error: unknown settings.compress '{settings['compress']}' (use {', '.join(COMPRESSORS)})")
+        sys.exit(1)
     
     # Check local download directory
     local_dir = log_conf.get('local_path', 'logs')
@@ -57,94 +377,99 @@ def main():
         print(f"Created local directory: {local_dir}")
 
     remote_dir = log_conf['remote_path']
-    patterns = log_conf.get('import_patterns', ['*.1.log', '*.2.log', '*.3.log', '*.4.log', '*.5.log'])
+    patterns = compile_patterns(log_conf.get('import_patterns', ['*.1.log', '*.2.log', '*.3.log', '*.4.log', '*.5.log']))
+    state_path = log_conf.get('state_file') or os.path.join(local_dir, STATE_FILENAME)
+    state = load_state(state_path, remote_dir)
+    listing = None
     
+    metrics = Metrics(config.get('metrics'), local_dir)
+    run_id = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    run_start = time.time()
+    counts = {'downloaded': 0, 'skipped': 0, 'failed': 0, 'deleted': 0}
+    total_bytes = 0
+    raw_bytes = 0
+    run_error = None
+    workers = 0
+
+    def on_record(record):
+        nonlocal total_bytes, raw_bytes
+        if record['status'] != 'failed':
+            info = listing[record['file']]
+            state[record['file']] = {'size': info['size'], 'mtime': info['mtime'], 'local': record['local_file']}
+        counts[record['status']] += 1
+        counts['deleted'] += 1 if record['deleted'] else 0
+        total_bytes += record['bytes_in']
+        raw_bytes += record.get('raw_bytes', record['bytes_in'])
+        metrics.emit(record)
+
     conn = get_connection(server_conf)
     
     try:
-        # 1. List files
+        # 1. List files (name, size, mtime in one call)
         # Vietnamese comment: Liệt kê file trên server
         print(f"Scanning remote directory: {remote_dir}")
-        result = conn.run(f"ls -1 {remote_dir}", hide=True)
-        files = result.stdout.strip().split('\n')
-        
+        listing = list_remote(conn.sftp(), remote_dir)
+
         # 2. Filter files
-        to_download = []
-        for f in files:
-            f = f.strip()
-            if not f: continue
-            
-            # Check if file matches any pattern
-            match = False
-            for p in patterns:
-                # Convert glob pattern to simple string check if possible
-                if p.startswith('*'):
-                    suffix = p[1:]
-                    if f.endswith(suffix):
-                        match = True
-                        break
-                elif p == f:
-                    match = True
-                    break
-            
-            if match:
-                to_download.append(f)
-        
-        print(f"Found {len(to_download)} files to download: {to_download}")
-        
+        candidates = {name: info for name, info in sorted(listing.items()) if matches(name, patterns)}
+        # Đã có trong state với đúng size + mtime -> không cần tải lại
+        fetched = {name for name, info in candidates.items()
+                   if name in state and (state[name]['size'], state[name]['mtime']) == (info['size'], info['mtime'])}
+        to_download = [name for name in candidates if name not in fetched]
+        print(f"Found {len(candidates)} matching files, {len(to_download)} to download: {to_download}")
+
         # 3. Download and Delete
-        for filename in to_download:
-            remote_file = f"{remote_dir}/{filename}"
-            
-            try:
-                # Get remote file attributes for timestamp
-                # Vietnamese comment: Lấy thời gian sửa đổi file trên server để làm timestamp
-                stat_result = conn.run(f"stat -c %Y {remote_file}", hide=True)
-                timestamp = int(stat_result.stdout.strip())
-                dt_str = datetime.datetime.fromtimestamp(timestamp).strftime('%Y%m%d_%H%M%S')
-                
-                # New local filename: name.timestamp
-                local_filename = f"{filename}.{dt_str}"
-                local_file = os.path.join(local_dir, local_filename)
-
-                if os.path.exists(local_file):
-                    print(f"  [SKIP] File exists: {local_filename}")
-                    
-                    # Logic for deletion if configured (even if we skipped download, we might want to delete if it's "safe")
-                    # But safest is: only delete if we successfully downloaded OR if we verify it's the exact same content.
-                    # For now, let's assume if it exists with same timestamp name, it's backed up.
-                    
-                    if settings.get('after_download') == 'delete':
-                        # Optional: check size or hash if paranoid
-                        print(f"  [DELETE] Removing remote file {filename} (already backed up)...")
-                        conn.run(f"rm {remote_file}")
-                        print("  [OK] Deleted.")
-
-                    continue
-
-                print(f"Downloading {filename} as {local_filename}...")
-                conn.get(remote_file, local_file)
-                print(f"  [OK] Downloaded to {local_file}")
-                
-                # Check existence
-                if os.path.exists(local_file):
-                    if settings.get('after_download') == 'delete':
-                        # Vietnamese comment: Xóa file sau khi tải xong nếu config cho phép
-                        print(f"  [DELETE] Removing remote file {filename}...")
-                        conn.run(f"rm {remote_file}")
-                        print("  [OK] Deleted.")
-                    else:
-                        print("  [KEEP] Keeping remote file (config not set to delete).")
-                else:
-                    print("  [ERROR] Local file missing. Skipping delete.")
-                    
-            except Exception as e:
-                print(f"  [ERROR] Failed to process {filename}: {e}")
+        if settings.get('after_download') == 'delete':
+            # File đã tải trước đó nhưng còn trên server -> vẫn phải xóa
+            work = candidates
+        else:
+            work = {name: candidates[name] for name in to_download}
+            for name in sorted(fetched):
+                on_record(process_file(None, remote_dir, name, candidates[name], local_dir, settings, run_id, fetched=True))
+        if work:
+            workers = download_files(conn, remote_dir, work, local_dir, settings, run_id, on_record, concurrency, fetched)
 
     except Exception as e:
         print(f"Error: {e}")
+        run_error = str(e)
     finally:
         conn.close()
+        if listing is not None:
+            # Chỉ giữ state của file còn trên server (file đã xóa / đã xoay vòng thì bỏ)
+            save_state(state_path, remote_dir, {name: entry for name, entry in state.items() if name in listing})
+        end = time.time()
+        duration = end - run_start
+        summary = {
+            'stage': 'log_downloader',
+            'run_id': run_id,
+            'start': datetime.datetime.fromtimestamp(run_start).isoformat(timespec='seconds'),
+            'end': datetime.datetime.fromtimestamp(end).isoformat(timespec='seconds'),
+            'end_ts': round(end, 3),
+            'duration_s': round(duration, 3),
+            'status': 'failed' if run_error or counts['failed'] else 'ok',
+            'success': 0 if run_error or counts['failed'] else 1,
+            'files_downloaded': counts['downloaded'],
+            'files_skipped': counts['skipped'],
+            'files_failed': counts['failed'],
+            'files_deleted': counts['deleted'],
+            'bytes_in': total_bytes,
+            'throughput_bytes_per_s': round(total_bytes / duration, 1) if duration > 0 else 0,
+            'concurrency': workers,
+        }
+        if settings.get('compress'):
+            summary['compress'] = settings['compress']
+            summary['raw_bytes'] = raw_bytes
+        if run_error:
+            summary['error'] = run_error
+        print(
+            f"[SUMMARY] {counts['downloaded']} downloaded, {counts['skipped']} skipped, {counts['failed']} failed, "
+            f"{counts['deleted']} deleted; {total_bytes / (1024 * 1024):.1f} MB in {duration:.1f}s "
+            f"({summary['throughput_bytes_per_s'] / (1024 * 1024):.2f} MB/s, {workers} channel(s))"
+            + (f"; {raw_bytes / (1024 * 1024):.1f} MB of logs, {settings['compress']} ratio {raw_bytes / total_bytes:.1f}x"
+               if settings.get('compress') and total_bytes else '')
+        )
+        metrics.emit(summary)
+        metrics.write_textfile(summary)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,81 @@
+"""Tests for log_downloader.py (chạy: python -m pytest logtool)."""
+import gzip
+import hashlib
+import json
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+import log_downloader
+
+DATA = b''.join(f"2026-01-01 00:00:{i % 60:02d} INFO request {i} ok\n".encode() for i in range(20000))
+
+
+def test_compile_patterns_globs_and_regex():
+    compiled = log_downloader.compile_patterns(['*.log', r're:app\.log\.[0-9]+'])
+    assert log_downloader.matches('error.log', compiled)
+    assert log_downloader.matches('app.log.12', compiled)
+    assert not log_downloader.matches('app.log.x', compiled)
+    # Regex phải khớp cả tên, không chỉ một phần
+    assert not log_downloader.matches('old_app.log.1.gz', compiled)
+    assert not log_downloader.matches('anything', log_downloader.compile_patterns([]))
+
+
+def test_state_round_trip(tmp_path):
+    path = str(tmp_path / log_downloader.STATE_FILENAME)
+    files = {'app.log.1': {'size': 10, 'mtime': 1700000000}}
+    log_downloader.save_state(path, '/var/log/app', files)
+    assert log_downloader.load_state(path, '/var/log/app') == files
+    assert not (tmp_path / (log_downloader.STATE_FILENAME + '.tmp')).exists()
+    # Đổi remote_path thì state cũ bị bỏ
+    assert log_downloader.load_state(path, '/var/log/other') == {}
+
+
+def test_load_state_missing_or_corrupt(tmp_path):
+    path = tmp_path / log_downloader.STATE_FILENAME
+    assert log_downloader.load_state(str(path), '/var/log/app') == {}
+    path.write_text('{not json')
+    assert log_downloader.load_state(str(path), '/var/log/app') == {}
+    path.write_text(json.dumps({'files': {'a': {}}}))
+    assert log_downloader.load_state(str(path), '/var/log/app') == {}
+
+
+# --- RawVerifier ---
+def feed_in_pieces(verifier, data, size=7000):
+    for i in range(0, len(data), size):
+        verifier.feed(data[i:i + size])
+    return verifier.finish()
+
+
+def test_raw_verifier_gzip():
+    result = feed_in_pieces(log_downloader.RawVerifier('gzip'), gzip.compress(DATA))
+    assert result == (len(DATA), hashlib.sha256(DATA).hexdigest())
+
+
+@pytest.mark.skipif(shutil.which('zstd') is None, reason='zstd CLI not installed')
+def test_raw_verifier_zstd_cli(monkeypatch):
+    # Không có gói zstandard: dùng lệnh zstd
+    monkeypatch.setitem(sys.modules, 'zstandard', None)
+    packed = subprocess.run(['zstd', '-c', '-q'], input=DATA, stdout=subprocess.PIPE, check=True).stdout
+    result = feed_in_pieces(log_downloader.RawVerifier('zstd'), packed)
+    assert result == (len(DATA), hashlib.sha256(DATA).hexdigest())
+
+
+@pytest.mark.skipif(shutil.which('zstd') is None, reason='zstd CLI not installed')
+def test_raw_verifier_zstd_truncated(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'zstandard', None)
+    packed = subprocess.run(['zstd', '-c', '-q'], input=DATA, stdout=subprocess.PIPE, check=True).stdout
+    with pytest.raises(IOError, match='zstd'):
+        feed_in_pieces(log_downloader.RawVerifier('zstd'), packed[:len(packed) // 2])
+
+
+# --- Metrics ---
+def test_textfile_escapes_label_values(tmp_path):
+    path = tmp_path / 'logtool.prom'
+    metrics = log_downloader.Metrics({'prometheus_textfile': str(path), 'labels': {'job': 'a"b\\c\nd'}}, str(tmp_path))
+    summary = dict(duration_s=1, end_ts=2, success=1, files_downloaded=3, files_failed=0, bytes_in=4,
+                   throughput_bytes_per_s=4.0)
+    metrics.write_textfile(summary)
+    assert 'logtool_success{job="a\\"b\\\\c\\nd"} 1\n' in path.read_text()